@@ -17,15 +17,10 @@ from datetime import timedelta
 import alpsdoocslib
 import os
 import os.path
-from example_data import *
+import example_data
 from pathlib import Path
-import matplotlib.pyplot as plt
-from gwpy.timeseries import TimeSeries
-from gwpy.frequencyseries import FrequencySeries
-
-root = Tk()
-root.title('ALPS DOOCS Autoplotter')
-#root.geometry("400x600")
+### matplotlib and gwpy (through alpsdoocslib.signal_process) are imported on
+### the first plot, not at start up
 
 class saveConfig(object):
     pass
@@ -66,10 +61,11 @@ def UpdateConfig():
 #        if myConfig.channels[3] != "None":
 #            numChannels += 1
             
-        myConfig.decimation=decimation.get()
-        myConfig.decimationFactor = 16000 / decimationVal[decimation.get()]
+        myConfig.fs = alpsdoocslib.parse_rate(decimation.get())
+        myConfig.decimation = alpsdoocslib.rate_name(myConfig.fs)
+        myConfig.decimationFactor = 16000 / myConfig.fs
         
-        myConfig.filesize = decimationVal[decimation.get()]*8*myConfig.mytimedelta.total_seconds()*numChannels/1e6 ## in MB
+        myConfig.filesize = myConfig.fs*8*myConfig.mytimedelta.total_seconds()*numChannels/1e6 ## in MB
         myConfig.configSummary = (
                                     f"\n###########################################################"
                                     f"\nPlot data preview."
@@ -102,29 +98,189 @@ def UpdateConfig():
         
     myConfig.daqchannels=[value for value in myConfig.channels if value != 'None']
 
-def makePlot():
-    fs = 16000
-    ch1data = getdata_sample4[0]['data'][0]
-    ch1TimeSeries = TimeSeries(data=ch1data,dt=1/fs)
-    print(f'{filtfreqEntry.get()} Hz')
-    if filtertype1.get() == "lowpass":
-        print("hello")
-        ch1TimeSeries = ch1TimeSeries.lowpass(float(filtfreqEntry.get()))
-    ch1psd = ch1TimeSeries.psd()
-    newWindow=Toplevel(root)
-    newWindow.title("Plot window")
-    newWindow.geometry("600x600")
-    Label(newWindow,text="This is a new window").pack()
+########################### channel1Data() #####################################
+### (fs, data, scale a, scale b) of the channel to plot, downsampled to the
+### rate chosen under "Downsample to:" (any rate, e.g. 250Hz or 2048Hz; the
+### exact up/down ratio is used) when that is below the rate of the source
+def channel1Data():
+    fs, data, scale_a, scale_b = channel1Source()
+    rate = alpsdoocslib.parse_rate(decimation.get())
+    if rate < fs:
+        data, fs = alpsdoocslib.resample_data(data, fs, rate), rate
+    return fs, data, scale_a, scale_b
+
+
+########################### channel1Source() ###################################
+### (fs, raw data, scale a, scale b) of the channel to plot: from a file saved
+### by the save tool, from the recording it shared when its name is entered,
+### otherwise the sample data. The shared recording stays attached (zero-copy)
+### until another is chosen.
+def channel1Source():
+    global pltConfig
+    if savedEntry.get().strip():
+        return savedData(savedEntry.get().strip())
+    name = sharedEntry.get().strip()
+    if not name:
+        return 16000, example_data.getdata_sample4[0]['data'][0], float(scaleA.get()), float(scaleB.get())
+    shared = getattr(pltConfig,'shared',None)
+    if shared is None or shared.name != name:
+        if shared is not None:
+            shared.release()
+        pltConfig.shared = shared = alpsdoocslib.attach_recording(name)
+    recording = shared.recording
+    i = recording.names.index(channel1select.get()) if channel1select.get() in recording.names else 0
+    return recording.fs, recording.channel(i), recording.scale_a[i]*float(scaleA.get()), recording.scale_b[i]*float(scaleA.get()) + float(scaleB.get())
+
+
+########################### savedData() ########################################
+### Channel 1 from a saved .mat/.csv file, read lazily (alpsdoocslib.SavedRecording):
+### only the window given by the start date/time and duration entries is read,
+### or the first `duration` of the file when that start is outside of it. The
+### file stays open until another one is entered.
+def savedData(path):
+    global pltConfig
+    saved = getattr(pltConfig,'saved',None)
+    if saved is None or saved.path != path:
+        if saved is not None:
+            saved.close()
+        pltConfig.saved = saved = alpsdoocslib.SavedRecording(path)
+    i = saved.names.index(channel1select.get()) if channel1select.get() in saved.names else 0
+    duration = timedelta(days=int(duration_d.get()),hours=int(duration_h.get()),minutes=int(duration_m.get()),
+                         seconds=int(duration_s.get())).total_seconds()
+    tstart = datetime.strptime(startdate.get()+starttime.get(), "%Y-%m-%d%H:%M:%S").timestamp()
+    if not saved.t0 <= tstart < saved.t0 + saved.nsamples[i]/saved.fs:
+        tstart = saved.t0
+    t0, data = saved.time_window(i, tstart, tstart + duration)
+    return saved.fs, data, saved.scale_a[i]*float(scaleA.get()), saved.scale_b[i]*float(scaleA.get()) + float(scaleB.get())
 
 
-    t = np.arange(0, len(ch1TimeSeries)/fs, 1/fs)
+def makePlot():
+    if plot_options[plottype.get()] == "trend":
+        return makeTrendPlot()
+    if plot_options[plottype.get()] == "demod":
+        return makeDemodPlot()
+    if plot_options[plottype.get()] == "zoom":
+        return makeZoomPlot()
+    if plot_options[plottype.get()] == "hist":
+        return makeHistogramPlot()
+    import matplotlib.pyplot as plt
+    fs, data, scale_a, scale_b = channel1Data()
+    datas = [data]
+    filtertype = "None"
+    filterfreq = 0
+    if filtertype1.get() in ("lowpass","highpass"):
+        filtertype = filtertype1.get()
+        filterfreq = float(filtfreqEntry.get())
+    ### filtering and PSD run per channel, in parallel when several channels are plotted
+    ### the polynomial scale is applied inside signal_process, on the fly
+    psds = alpsdoocslib.map_channels(alpsdoocslib.signal_process, datas, fs=fs, process="PSD",
+                                     filtertype=filtertype, filterfreq=filterfreq,
+                                     scale_a=scale_a, scale_b=scale_b)
+    ch1psd = psds[0]
+
+    t = np.arange(0, len(datas[0])/fs, 1/fs)
     fig = plt.figure(figsize=(5, 4), dpi=100)
 #    fig.add_subplot(111).plot(t, ch1TimeSeries)
     fig.add_subplot(111)
     plt.plot(ch1psd)
     plt.xscale('log')
-    
-    
+    showFigure(fig)
+
+
+########################### makeTrendPlot() ###################################
+### Plots the per-minute min/max envelope, mean and RMS of channel 1 from the
+### trend side tables written by the save tools (<filename>_trend.npz). Only
+### these small tables are read, so weeks of data plot in a moment. The trend
+### file entry takes a glob pattern, e.g. /data/alps/*_trend.npz
+def makeTrendPlot():
+    import matplotlib.pyplot as plt
+    trend = alpsdoocslib.load_trend(trendfileEntry.get(),'ALPS.DIAG/ALPS.ADC.'+channel1select.get(),interval=60)
+    t = [datetime.fromtimestamp(x) for x in trend['t']]
+    fig = plt.figure(figsize=(5, 4), dpi=100)
+    ax = fig.add_subplot(111)
+    ax.fill_between(t,trend['min'],trend['max'],alpha=0.3,label='min/max')
+    ax.plot(t,trend['mean'],label='mean')
+    ax.plot(t,trend['rms'],label='RMS')
+    ax.legend()
+    fig.autofmt_xdate()
+    showFigure(fig)
+
+
+########################### makeDemodPlot() ###################################
+### Lock-in view of channel 1: amplitude and phase of the line at the
+### demodulation frequency, in a band of the given bandwidth around it.
+def makeDemodPlot():
+    import matplotlib.pyplot as plt
+    fs, data, scale_a, scale_b = channel1Data()
+    fs_out, amplitude, phase = alpsdoocslib.demodulate(data,float(demodfreqEntry.get()),float(demodbwEntry.get()),fs=fs,
+                                                       output='polar',scale_a=scale_a,scale_b=scale_b)
+    t = np.arange(len(amplitude))/fs_out
+    fig = plt.figure(figsize=(5, 4), dpi=100)
+    ax1 = fig.add_subplot(211)
+    ax1.plot(t,amplitude)
+    ax1.set_ylabel('amplitude')
+    ax2 = fig.add_subplot(212,sharex=ax1)
+    ax2.plot(t,np.unwrap(phase))
+    ax2.set_ylabel('phase (rad)')
+    ax2.set_xlabel('time (s)')
+    showFigure(fig)
+
+
+############################ makeZoomPlot() ###################################
+### Narrowband ASD of channel 1 around a center frequency at a resolution far
+### finer than the full-band spectrum can afford (see alpsdoocslib.ZoomSpectrum).
+def makeZoomPlot():
+    import matplotlib.pyplot as plt
+    fs, data, scale_a, scale_b = channel1Data()
+    try:
+        freqs, psd = alpsdoocslib.zoom_spectrum(data,float(zoomcenterEntry.get()),float(zoomspanEntry.get()),
+                                                float(zoomresEntry.get()),fs=fs,scale_a=scale_a,scale_b=scale_b)
+    except ValueError as e:
+        consoleBox.tag_config('warning',foreground="red")
+        consoleBox.config(state=NORMAL)
+        consoleBox.insert(END,f"\n\nZoom spectrum: {e}\n",'warning')
+        consoleBox.config(state=DISABLED)
+        consoleBox.see(END)
+        return
+    fig = plt.figure(figsize=(5, 4), dpi=100)
+    ax = fig.add_subplot(111)
+    ax.plot(freqs,np.sqrt(psd))
+    ax.set_yscale('log')
+    ax.set_xlabel('frequency (Hz)')
+    showFigure(fig)
+
+
+########################## makeHistogramPlot() ################################
+### Amplitude distribution of channel 1, calibrated, with its quantiles marked.
+### The data goes through alpsdoocslib.AmplitudeStats a chunk at a time, so a
+### long (memory mapped) channel is never copied whole: raw int16 data is
+### counted exactly per ADC code, resampled or float data goes into a sketch.
+def makeHistogramPlot():
+    import matplotlib.pyplot as plt
+    fs, data, scale_a, scale_b = channel1Data()
+    stats = alpsdoocslib.AmplitudeStats([channel1select.get()],scales=[(scale_a,scale_b)])
+    for block in alpsdoocslib.read_chunks(data):
+        stats.append(channel1select.get(),None,0,block)
+    edges, counts = stats.histogram(0)
+    quantiles = scale_a*stats.quantiles(0) + scale_b
+    fig = plt.figure(figsize=(5, 4), dpi=100)
+    ax = fig.add_subplot(111)
+    ax.stairs(counts,scale_a*edges + scale_b,fill=True)
+    for q, value in zip(alpsdoocslib.amplitudeQuantiles,quantiles):
+        ax.axvline(value,color='k',lw=0.5,ls='--' if q != 0.5 else '-')
+    ax.set_yscale('log')
+    ax.set_xlabel('amplitude')
+    ax.set_ylabel('samples')
+    ax.set_title(stats.summary()[0],fontsize=7)
+    showFigure(fig)
+
+
+def showFigure(fig):
+    from matplotlib.backends.backend_tkagg import (FigureCanvasTkAgg, NavigationToolbar2Tk)
+    newWindow=Toplevel(root)
+    newWindow.title("Plot window")
+    newWindow.geometry("600x600")
+
     canvas = FigureCanvasTkAgg(fig, master=newWindow)  # A tk.DrawingArea.
     canvas.draw()
     canvas.get_tk_widget().pack(side=TOP, fill=BOTH, expand=1)
@@ -132,134 +288,6 @@ def makePlot():
     toolbar = NavigationToolbar2Tk(canvas, newWindow)
     toolbar.update()
     canvas.get_tk_widget().pack(side=TOP, fill=BOTH, expand=1)
-########################################################################
-########################################################################
-########################################################################
-
-### entry field labels
-scaleLabel = Label(root,text="polynomial scale factor (a*x + b):")
-plotTypeLabel = Label(root,text="Plot type:")
-channelsLabel = Label(root,text="channel 1 y-axis")
-channel1Label = Label(root,text="Channel select:")
-channel2Label = Label(root,text="Channel 2:")
-channel3Label = Label(root,text="Channel 3:")
-channel4Label = Label(root,text="Channel 4:")
-startdateLabel = Label(root,text="Data start date: ")
-starttimeLabel = Label(root,text="Data start time: ")
-durationLabel = Label(root,text="Duration: ")
-daysLabel = Label(root,text="Days:")
-hoursLabel = Label(root,text="Hours:")
-minutesLabel = Label(root,text="Minutes:")
-secondsLabel = Label(root,text="Seconds:")
-usercommentsLabel = Label(root,text="Enter additional user comments about this measurement/data. \nThese additional comments will be saved as a .txt file in the destination directory.")
-channel1commentLabel = Label(root,text="channel 1 legend:")
-channel2commentLabel = Label(root,text="y-axis 2 label")
-channel3commentLabel = Label(root,text="y-axis 3 label")
-channel4commentLabel = Label(root,text="y-axis 4 label")
-
-### Channel selection dropdown menus
-### Channel selection dropdown menus
-channel_options = [
-        'None',
-        'NR/CH_1.00',
-        'NR/CH_1.01',
-        'NR/CH_1.02',
-        'NR/CH_1.03',
-        'NR/CH_1.04',
-        'NR/CH_1.05',
-        'NR/CH_1.06',
-        'NR/CH_1.07',
-        'NL/CH_1.00',
-        'NL/CH_1.01',
-        'HN/CH_1.00',
-        ]
-channel1select = StringVar()
-channel2select = StringVar()
-channel3select = StringVar()
-channel4select = StringVar()
-channel1_drop = OptionMenu(root, channel1select, channel_options[0], *channel_options)
-channel2_drop = OptionMenu(root, channel2select, channel_options[0], *channel_options)
-channel3_drop = OptionMenu(root, channel3select, channel_options[0], *channel_options)
-channel4_drop = OptionMenu(root, channel4select, channel_options[0], *channel_options)
-channel1_drop.config(width=10)
-channel2_drop.config(width=10)
-channel3_drop.config(width=10)
-channel4_drop.config(width=10)
-
-### channel user comments
-channel1Comment = Entry(root,width=15)
-channel1Comment.insert(0,"")
-channel2Comment = Entry(root,width=10)
-channel2Comment.insert(0,"")
-channel3Comment = Entry(root,width=10)
-channel3Comment.insert(0,"")
-channel4Comment = Entry(root,width=10)
-channel4Comment.insert(0,"")
-
-### start date entry field
-startdate = Entry(root,width=10)
-startdate.insert(0,datetime.today().strftime('%Y-%m-%d'))
-### 
-
-### start time entry field
-starttime = Entry(root,width=10)
-starttime.insert(0,datetime.today().strftime('%H:%M:%S'))
-### 
-
-### duration days entry field
-duration_d = Entry(root,width=5)
-duration_d.insert(0,0)
-
-### duration hours entry field
-duration_h = Entry(root,width=5)
-duration_h.insert(0,0)
-
-### duration minutes entry field
-duration_m = Entry(root,width=5)
-duration_m.insert(0,0)
-
-### duration seconds entry field
-duration_s = Entry(root,width=5)
-duration_s.insert(0,10)
-
-mytimedelta=timedelta(days=int(duration_d.get()),hours=int(duration_h.get()),minutes=int(duration_m.get()),seconds=int(duration_s.get()))
-mystarttime=datetime.strptime(startdate.get()+starttime.get(), "%Y-%m-%d%H:%M:%S")
-
-myStartDateLabel = Label(root,text=mystarttime)
-myTimeDeltaLabel = Label(root,text=mytimedelta)
-myEndDateLabel = Label(root,text=mystarttime+mytimedelta)
-
-scaleA = Entry(root,width=5)
-scaleA.insert(0,1)
-scaleB = Entry(root,width=5)
-scaleB.insert(0,0)
-
-myDecimationLabel = Label(root,text="Downsample to:")
-myPlotTypeLabel = Label(root,text="Select type of plot to generate:")
-
-####
-decimation = StringVar()
-decimationVal = {
-        "16kHz": 16000,
-        "8kHz": 8000,
-        "4kHz": 4000,
-        "2kHz": 2000,
-        "1kHz": 1000,
-        "500Hz": 500,
-        "100Hz": 100,
-        "64Hz": 64,
-        "32Hz": 32
-        }
-decimation_drop = OptionMenu(root, decimation, list(decimationVal.keys())[0], *list(decimationVal.keys()))
-###
-
-plottype = StringVar()
-plot_options = {
-        "Amplitude Spectral Density (ASD)":"asd",
-        "Power Spectral Density (PSD)":"psd",
-        "Time Series":"ts"
-        }
-plottype_drop = OptionMenu(root, plottype, list(plot_options.keys())[2], *list(plot_options.keys()))
 
 def OptionMenu_SelectionEvent(event): # I'm not sure on the arguments here, it works though
     if filtertype1.get() == "lowpass":
@@ -285,83 +313,281 @@ def OptionMenu_SelectionEvent(event): # I'm not sure on the arguments here, it w
         print("None")
     pass
 
-filtfreqLabel = Label(root,text="Corner frequency:")
-filtfreqEntry = Entry(root,width=10)
-
-filterLabel = Label(root,text="Select optional signal filter:")
-filtertype1,filtertype2,filtertype3,filtertype4=StringVar(),StringVar(),StringVar(),StringVar()
-filter_options = [
-        "None",
-        "lowpass",
-        "highpass",
-        "notch",
-        "bandpass",
-        "custom filter (zpk)"
-        ]
-filtertype1_drop = OptionMenu(root, filtertype1, filter_options[0], *filter_options, command = OptionMenu_SelectionEvent)
-filtertype2_drop = OptionMenu(root, filtertype2, filter_options[0], *filter_options)
-filtertype3_drop = OptionMenu(root, filtertype3, filter_options[0], *filter_options)
-filtertype4_drop = OptionMenu(root, filtertype4, filter_options[0], *filter_options)
-
-
-
-############ GUI LAYOUT ################
-plotTypeLabel.grid(row=0,column=0,sticky=W,pady=2)
-plottype_drop.grid(row=0,column=1,columnspan=3,sticky=EW,pady=2)
-
-### Labels
-startdateLabel.grid(row=3,column=0,sticky=W,pady=2)
-starttimeLabel.grid(row=4,column=0,sticky=W,pady=2)
-durationLabel.grid(row=5,column=0,sticky=W,pady=2)
-daysLabel.grid(row=5,column=1,sticky=W,pady=2)
-hoursLabel.grid(row=5,column=2,sticky=W,pady=2)
-minutesLabel.grid(row=5,column=3,sticky=W,pady=2)
-secondsLabel.grid(row=5,column=4,sticky=W,pady=2)
-
-### Entry fields
-startdate.grid(row=3,column=1,sticky=EW,pady=2,columnspan=2)
-starttime.grid(row=4,column=1,sticky=EW,pady=2,columnspan=2)
-duration_d.grid(row=6,column=1,sticky=EW,pady=2)
-duration_h.grid(row=6,column=2,sticky=EW,pady=2)
-duration_m.grid(row=6,column=3,sticky=EW,pady=2)
-duration_s.grid(row=6,column=4,sticky=EW,pady=2)
-
-### y1 configuration
-channelsLabel.grid(row=14,column=0,sticky=W,pady=5,columnspan=1)
-channel1Label.grid(row=15,column=1,sticky=W,pady=2,columnspan=2)
-channel1_drop.grid(row=16,column=1,sticky=EW,pady=2,columnspan=2)
-channel1commentLabel.grid(row=15,column=4,sticky=EW, padx=5)
-channel1Comment.grid(row=16,column=4,sticky=W,pady=2, padx=5,columnspan=1)
-myDecimationLabel.grid(row=15,column=3,sticky=EW,pady=2,columnspan=1)
-decimation_drop.grid(row=16,column=3,sticky=EW,pady=2,columnspan=1)
-filterLabel.grid(row=19,column=1,sticky=EW,pady=2,columnspan=2)
-filtertype1_drop.grid(row=20,column=1,sticky=EW,pady=2,columnspan=2)
-
-
-scaleLabel.grid(row=30,column=1,sticky=EW,columnspan=3)
-scaleA.grid(row=30,column=3)
-scaleB.grid(row=30,column=4)
-
-
-Separator(root,orient=HORIZONTAL).grid(row=2,columnspan=10,sticky="ew",pady=5)
-Separator(root,orient=HORIZONTAL).grid(row=8,columnspan=10,sticky="ew",pady=5)
-Separator(root,orient=HORIZONTAL).grid(row=18,column=1,columnspan=10,sticky="ew",pady=5)
-Separator(root,orient=HORIZONTAL).grid(row=8,columnspan=10,sticky="ew")
-
-
-### configuration logging space
-consoleFrame = Frame(root,height=30)
-consoleFrame.grid(row=50,column=0,sticky=W,pady=2,columnspan=10)
-
-consoleBox = scrolledtext.ScrolledText(consoleFrame,wrap=WORD)
-consoleBox.grid(row=51,column=0)
-consoleBox.config(state=DISABLED)
-
-### Buttons
-updateConfigButton = Button(root, text="Update Plot Configuration", command=UpdateConfig)
-makePlotButton = Button(root,text="Generate Plot",command=makePlot)
-makePlotButton.grid(row=100,column=1)
-updateConfigButton.grid(row=52,column=1,sticky=W,pady=2,columnspan=4)
-
-root.mainloop()
 
+############################ build_window() ###################################
+### Builds the whole Tk window. Kept out of import time like the plotting
+### libraries, so starting the tool only pays for Tk; the widgets the plot
+### callbacks read stay module globals.
+###############################################################################
+def build_window():
+    global root, channel1select, channel1Comment, startdate, starttime, duration_d, duration_h
+    global duration_m, duration_s, scaleA, scaleB, decimation, decimationVal, plottype, plot_options
+    global filtfreqLabel, filtfreqEntry, filtertype1, trendfileEntry, demodfreqEntry, demodbwEntry
+    global zoomcenterEntry, zoomspanEntry, zoomresEntry, sharedEntry, savedEntry, consoleBox
+    root = Tk()
+    root.title('ALPS DOOCS Autoplotter')
+    #root.geometry("400x600")
+    ########################################################################
+    ########################################################################
+    ########################################################################
+
+    ### entry field labels
+    scaleLabel = Label(root,text="polynomial scale factor (a*x + b):")
+    plotTypeLabel = Label(root,text="Plot type:")
+    channelsLabel = Label(root,text="channel 1 y-axis")
+    channel1Label = Label(root,text="Channel select:")
+    channel2Label = Label(root,text="Channel 2:")
+    channel3Label = Label(root,text="Channel 3:")
+    channel4Label = Label(root,text="Channel 4:")
+    startdateLabel = Label(root,text="Data start date: ")
+    starttimeLabel = Label(root,text="Data start time: ")
+    durationLabel = Label(root,text="Duration: ")
+    daysLabel = Label(root,text="Days:")
+    hoursLabel = Label(root,text="Hours:")
+    minutesLabel = Label(root,text="Minutes:")
+    secondsLabel = Label(root,text="Seconds:")
+    usercommentsLabel = Label(root,text="Enter additional user comments about this measurement/data. \nThese additional comments will be saved as a .txt file in the destination directory.")
+    channel1commentLabel = Label(root,text="channel 1 legend:")
+    channel2commentLabel = Label(root,text="y-axis 2 label")
+    channel3commentLabel = Label(root,text="y-axis 3 label")
+    channel4commentLabel = Label(root,text="y-axis 4 label")
+
+    ### Channel selection dropdown menus
+    ### Channel selection dropdown menus
+    channel_options = [
+            'None',
+            'NR/CH_1.00',
+            'NR/CH_1.01',
+            'NR/CH_1.02',
+            'NR/CH_1.03',
+            'NR/CH_1.04',
+            'NR/CH_1.05',
+            'NR/CH_1.06',
+            'NR/CH_1.07',
+            'NL/CH_1.00',
+            'NL/CH_1.01',
+            'HN/CH_1.00',
+            ]
+    channel1select = StringVar()
+    channel2select = StringVar()
+    channel3select = StringVar()
+    channel4select = StringVar()
+    channel1_drop = OptionMenu(root, channel1select, channel_options[0], *channel_options)
+    channel2_drop = OptionMenu(root, channel2select, channel_options[0], *channel_options)
+    channel3_drop = OptionMenu(root, channel3select, channel_options[0], *channel_options)
+    channel4_drop = OptionMenu(root, channel4select, channel_options[0], *channel_options)
+    channel1_drop.config(width=10)
+    channel2_drop.config(width=10)
+    channel3_drop.config(width=10)
+    channel4_drop.config(width=10)
+
+    ### channel user comments
+    channel1Comment = Entry(root,width=15)
+    channel1Comment.insert(0,"")
+    channel2Comment = Entry(root,width=10)
+    channel2Comment.insert(0,"")
+    channel3Comment = Entry(root,width=10)
+    channel3Comment.insert(0,"")
+    channel4Comment = Entry(root,width=10)
+    channel4Comment.insert(0,"")
+
+    ### start date entry field
+    startdate = Entry(root,width=10)
+    startdate.insert(0,datetime.today().strftime('%Y-%m-%d'))
+    ### 
+
+    ### start time entry field
+    starttime = Entry(root,width=10)
+    starttime.insert(0,datetime.today().strftime('%H:%M:%S'))
+    ### 
+
+    ### duration days entry field
+    duration_d = Entry(root,width=5)
+    duration_d.insert(0,0)
+
+    ### duration hours entry field
+    duration_h = Entry(root,width=5)
+    duration_h.insert(0,0)
+
+    ### duration minutes entry field
+    duration_m = Entry(root,width=5)
+    duration_m.insert(0,0)
+
+    ### duration seconds entry field
+    duration_s = Entry(root,width=5)
+    duration_s.insert(0,10)
+
+    mytimedelta=timedelta(days=int(duration_d.get()),hours=int(duration_h.get()),minutes=int(duration_m.get()),seconds=int(duration_s.get()))
+    mystarttime=datetime.strptime(startdate.get()+starttime.get(), "%Y-%m-%d%H:%M:%S")
+
+    myStartDateLabel = Label(root,text=mystarttime)
+    myTimeDeltaLabel = Label(root,text=mytimedelta)
+    myEndDateLabel = Label(root,text=mystarttime+mytimedelta)
+
+    scaleA = Entry(root,width=5)
+    scaleA.insert(0,1)
+    scaleB = Entry(root,width=5)
+    scaleB.insert(0,0)
+
+    myDecimationLabel = Label(root,text="Downsample to:")
+    myPlotTypeLabel = Label(root,text="Select type of plot to generate:")
+
+    ####
+    decimation = StringVar()
+    decimationVal = {
+            "16kHz": 16000,
+            "8kHz": 8000,
+            "4kHz": 4000,
+            "2kHz": 2000,
+            "1kHz": 1000,
+            "500Hz": 500,
+            "100Hz": 100,
+            "64Hz": 64,
+            "32Hz": 32
+            }
+    ### pick one of the list or type any other rate
+    decimation_drop = Combobox(root, textvariable=decimation, values=list(decimationVal.keys()), width=8)
+    decimation.set(list(decimationVal.keys())[0])
+    ###
+
+    plottype = StringVar()
+    plot_options = {
+            "Amplitude Spectral Density (ASD)":"asd",
+            "Power Spectral Density (PSD)":"psd",
+            "Time Series":"ts",
+            "Trend (min/max/mean/RMS per minute)":"trend",
+            "Lock-in amplitude/phase (demodulation)":"demod",
+            "Narrowband zoom ASD":"zoom",
+            "Amplitude histogram and quantiles":"hist"
+            }
+    plottype_drop = OptionMenu(root, plottype, list(plot_options.keys())[2], *list(plot_options.keys()))
+
+    filtfreqLabel = Label(root,text="Corner frequency:")
+    filtfreqEntry = Entry(root,width=10)
+
+    filterLabel = Label(root,text="Select optional signal filter:")
+    filtertype1,filtertype2,filtertype3,filtertype4=StringVar(),StringVar(),StringVar(),StringVar()
+    filter_options = [
+            "None",
+            "lowpass",
+            "highpass",
+            "notch",
+            "bandpass",
+            "custom filter (zpk)"
+            ]
+    filtertype1_drop = OptionMenu(root, filtertype1, filter_options[0], *filter_options, command = OptionMenu_SelectionEvent)
+    filtertype2_drop = OptionMenu(root, filtertype2, filter_options[0], *filter_options)
+    filtertype3_drop = OptionMenu(root, filtertype3, filter_options[0], *filter_options)
+    filtertype4_drop = OptionMenu(root, filtertype4, filter_options[0], *filter_options)
+
+
+
+    ############ GUI LAYOUT ################
+    plotTypeLabel.grid(row=0,column=0,sticky=W,pady=2)
+    plottype_drop.grid(row=0,column=1,columnspan=3,sticky=EW,pady=2)
+
+    ### Labels
+    startdateLabel.grid(row=3,column=0,sticky=W,pady=2)
+    starttimeLabel.grid(row=4,column=0,sticky=W,pady=2)
+    durationLabel.grid(row=5,column=0,sticky=W,pady=2)
+    daysLabel.grid(row=5,column=1,sticky=W,pady=2)
+    hoursLabel.grid(row=5,column=2,sticky=W,pady=2)
+    minutesLabel.grid(row=5,column=3,sticky=W,pady=2)
+    secondsLabel.grid(row=5,column=4,sticky=W,pady=2)
+
+    ### Entry fields
+    startdate.grid(row=3,column=1,sticky=EW,pady=2,columnspan=2)
+    starttime.grid(row=4,column=1,sticky=EW,pady=2,columnspan=2)
+    duration_d.grid(row=6,column=1,sticky=EW,pady=2)
+    duration_h.grid(row=6,column=2,sticky=EW,pady=2)
+    duration_m.grid(row=6,column=3,sticky=EW,pady=2)
+    duration_s.grid(row=6,column=4,sticky=EW,pady=2)
+
+    ### y1 configuration
+    channelsLabel.grid(row=14,column=0,sticky=W,pady=5,columnspan=1)
+    channel1Label.grid(row=15,column=1,sticky=W,pady=2,columnspan=2)
+    channel1_drop.grid(row=16,column=1,sticky=EW,pady=2,columnspan=2)
+    channel1commentLabel.grid(row=15,column=4,sticky=EW, padx=5)
+    channel1Comment.grid(row=16,column=4,sticky=W,pady=2, padx=5,columnspan=1)
+    myDecimationLabel.grid(row=15,column=3,sticky=EW,pady=2,columnspan=1)
+    decimation_drop.grid(row=16,column=3,sticky=EW,pady=2,columnspan=1)
+    filterLabel.grid(row=19,column=1,sticky=EW,pady=2,columnspan=2)
+    filtertype1_drop.grid(row=20,column=1,sticky=EW,pady=2,columnspan=2)
+
+
+    scaleLabel.grid(row=30,column=1,sticky=EW,columnspan=3)
+    scaleA.grid(row=30,column=3)
+    scaleB.grid(row=30,column=4)
+
+    trendfileLabel = Label(root,text="Trend files (for trend plots):")
+    trendfileEntry = Entry(root,width=30)
+    trendfileEntry.insert(0,os.path.join(os.getcwd(),"*_trend.npz"))
+    trendfileLabel.grid(row=31,column=1,sticky=EW,columnspan=2)
+    trendfileEntry.grid(row=31,column=3,sticky=EW,columnspan=2)
+
+    demodLabel = Label(root,text="Demodulation frequency, bandwidth (Hz):")
+    demodfreqEntry = Entry(root,width=10)
+    demodfreqEntry.insert(0,1000)
+    demodbwEntry = Entry(root,width=5)
+    demodbwEntry.insert(0,10)
+    demodLabel.grid(row=32,column=1,sticky=EW,columnspan=2)
+    demodfreqEntry.grid(row=32,column=3)
+    demodbwEntry.grid(row=32,column=4)
+
+    zoomLabel = Label(root,text="Zoom center, span, resolution (Hz):")
+    zoomcenterEntry = Entry(root,width=10)
+    zoomcenterEntry.insert(0,1000)
+    zoomspanEntry = Entry(root,width=5)
+    zoomspanEntry.insert(0,10)
+    zoomresEntry = Entry(root,width=5)
+    zoomresEntry.insert(0,0.1)
+    zoomLabel.grid(row=33,column=0,sticky=EW,columnspan=2)
+    zoomcenterEntry.grid(row=33,column=2)
+    zoomspanEntry.grid(row=33,column=3)
+    zoomresEntry.grid(row=33,column=4)
+
+    sharedLabel = Label(root,text="Shared recording from the save tool (empty: sample data):")
+    sharedEntry = Entry(root,width=15)
+    sharedLabel.grid(row=34,column=0,sticky=EW,columnspan=3)
+    sharedEntry.grid(row=34,column=3,sticky=EW,columnspan=2)
+
+    savedLabel = Label(root,text="Saved .mat/.csv file (plots the start/duration window):")
+    savedEntry = Entry(root,width=30)
+    savedLabel.grid(row=35,column=0,sticky=EW,columnspan=3)
+    savedEntry.grid(row=35,column=3,sticky=EW,columnspan=2)
+
+
+    Separator(root,orient=HORIZONTAL).grid(row=2,columnspan=10,sticky="ew",pady=5)
+    Separator(root,orient=HORIZONTAL).grid(row=8,columnspan=10,sticky="ew",pady=5)
+    Separator(root,orient=HORIZONTAL).grid(row=18,column=1,columnspan=10,sticky="ew",pady=5)
+    Separator(root,orient=HORIZONTAL).grid(row=8,columnspan=10,sticky="ew")
+
+
+    ### configuration logging space
+    consoleFrame = Frame(root,height=30)
+    consoleFrame.grid(row=50,column=0,sticky=W,pady=2,columnspan=10)
+
+    consoleBox = scrolledtext.ScrolledText(consoleFrame,wrap=WORD)
+    consoleBox.grid(row=51,column=0)
+    consoleBox.config(state=DISABLED)
+
+    ### Buttons
+    updateConfigButton = Button(root, text="Update Plot Configuration", command=UpdateConfig)
+    makePlotButton = Button(root,text="Generate Plot",command=makePlot)
+    makePlotButton.grid(row=100,column=1)
+    updateConfigButton.grid(row=52,column=1,sticky=W,pady=2,columnspan=4)
+    return root
+
+
+############################### main() ########################################
+def main():
+    build_window()
+    root.mainloop()
+    if getattr(pltConfig,'shared',None) is not None:
+        pltConfig.shared.release()
+    if getattr(pltConfig,'saved',None) is not None:
+        pltConfig.saved.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,827 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Headless command line / batch runner for the ALPS DOOCS save pipeline.
+
+Runs the same extraction as the "Save File" button of alpsdoocs_save.py, but
+without Tk, so it can be used on a compute node or from cron. A single job can
+be given on the command line, or a list of jobs as a JSON file:
+
+    [
+      {"channels": ["NR/CH_1.00", "NR/CH_1.01"],
+       "labels": ["PD trans", "PD refl"],
+       "start": "2022-01-03 12:23:00",
+       "duration": {"hours": 1},
+       "decimation": "1kHz",
+       "filetype": ".mat",
+       "dtype": "float32",
+       "directory": "/data/alps/",
+       "filename": "run42",
+       "scales": [[0.5, 0.0], [1.0, -3.2]]}
+    ]
+
+Long pulls are checkpointed: if a job fails part way, running it again with
+the same channels and time range continues where it stopped. With
+--memory-budget (or "memory_budget" in MB in a job spec) a pull too large for
+the budget is decimated and written from the checkpoint files in chunks
+instead of in memory. "demodulate": {"frequency": 4500, "bandwidth": 10,
+"output": "polar"} additionally writes <filename>_demod with the lock-in
+amplitude and phase (or I/Q) of every channel at a low rate. "trigger":
+{"channel": "NR/CH_1.00", "threshold": 5000, "edge": "falling", "pre": 2,
+"post": 10} keeps only the windows around threshold crossings, one file per
+window, indexed in <filename>_triggers.json (triggered jobs are not
+checkpointed; rerunning one starts over). "archive": "/data/alps/archive"
+also adds the raw data to a time-partitioned archive (hourly chunk files per
+channel plus index.csv) that alpsdoocslib.Archive(root).query(channel,
+t_start, t_stop) reads back by time range.
+
+One pull can feed several files: "outputs": [{"filename": "run42_1kHz",
+"filetype": ".csv", "decimation": "1kHz", "channels": ["NR/CH_1.00"],
+"filter": {"filtertype": "lowpass", "filterfreq": 100}}] writes each extra
+output with its own format, rate, precision, filter and channel subset from
+the same fetched blocks (--also FILETYPE DECIMATION on the command line).
+
+"decimation" is any output rate, not only the named ones: "250Hz", "300",
+"2.048kHz" are resampled from 16 kHz by the exact rational ratio (3/160 for
+300 Hz) with a streaming polyphase filter, and the ratio is saved with the
+data ("fs_raw", "resample_up", "resample_down").
+
+Every job also keeps the amplitude distribution of the raw data per channel
+(an exact histogram over the 65,536 ADC codes, in constant memory) and saves
+it with its quantiles in the .mat file ("channeln_histogram",
+"channeln_amplitude_quantiles"); "amplitude": false (--no-amplitude) skips it.
+
+"correlate": {"pairs": [["NR/CH_1.00", "NL/CH_1.00"]], "max_lag": 0.005}
+(--correlate CHANNEL CHANNEL, --max-lag SECONDS) measures the relative delay
+of channel pairs, e.g. between the NR, NL and HN crates: the cross-correlation
+of the raw 16 kHz data over the whole range for lags up to max_lag seconds
+(default 0.01; all pairs of the job's channels when "pairs" is left out),
+with the peak lag to a fraction of a sample and the correlation coefficient.
+The results go into the summary and the .mat file ("xcorrk_...").
+
+Exit status is 0 when every job succeeded, 1 when at least one job failed,
+2 for bad arguments or an unreadable job file and 3 when a job ran but the DAQ
+stopped delivering before the end of its range.
+"""
+import argparse
+import importlib
+import json
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from datetime import datetime
+from datetime import timedelta
+
+import numpy as np
+
+import alpsdoocslib
+
+EXIT_OK = 0
+EXIT_FAILED = 1
+EXIT_USAGE = 2
+EXIT_INCOMPLETE = 3
+
+
+### job configuration object, carrying the same attributes as myConfig in the save GUI
+class batchConfig(object):
+    pass
+
+
+############################### parse_duration ################################
+### accepts a number of seconds, a [days,hours,minutes,seconds] list as in
+### myConfig.time, or a dict with any of the keys days/hours/minutes/seconds
+###############################################################################
+def parse_duration(duration):
+    if isinstance(duration, dict):
+        return timedelta(**{k: float(v) for k, v in duration.items()})
+    if isinstance(duration, (list, tuple)):
+        d, h, m, s = [int(x) for x in duration]
+        return timedelta(days=d, hours=h, minutes=m, seconds=s)
+    return timedelta(seconds=float(duration))
+
+
+############################### parse_start ###################################
+def parse_start(start):
+    for fmt in ("%Y-%m-%dT%H:%M:%S", "%Y-%m-%d %H:%M:%S"):
+        try:
+            return datetime.strptime(start, fmt)
+        except ValueError:
+            pass
+    raise ValueError(f"start time '{start}' is not in the format YYYY-MM-DDTHH:MM:SS")
+
+
+############################### make_config ###################################
+### Builds a configuration object from a job spec (a dict as read from the job
+### file or the command line). Mirrors UpdateConfig() in alpsdoocs_save.py.
+###############################################################################
+def make_config(spec):
+    config = batchConfig()
+    config.channels = [c for c in spec['channels'] if c != 'None']
+    if not 1 <= len(config.channels) <= 4:
+        raise ValueError("between 1 and 4 channels must be given")
+    config.channelcomments = list(spec.get('labels', []))
+    config.channelcomments += [""]*(len(config.channels) - len(config.channelcomments))
+    config.daqchannels = config.channels
+    config.scales = [tuple(float(x) for x in scale) for scale in spec.get('scales', [])]
+    config.scales += [(1.0, 0.0)]*(len(config.channels) - len(config.scales))
+    config.filetype = spec.get('filetype', '.mat')
+    if config.filetype not in (".mat", ".csv"):
+        raise ValueError(f"unknown filetype '{config.filetype}'")
+    config.filename = spec.get('filename', 'default_filename')
+    config.dirpath = spec.get('directory', os.getcwd())
+    config.path = os.path.join(config.dirpath, config.filename + config.filetype)
+    config.mytimedelta = parse_duration(spec['duration'])
+    config.start_datetime = parse_start(spec['start'])
+    config.stop_datetime = config.start_datetime + config.mytimedelta
+    config.input_start = config.start_datetime.strftime('%Y-%m-%dT%H:%M:%S')
+    config.input_stop = config.stop_datetime.strftime('%Y-%m-%dT%H:%M:%S')
+    if datetime.now() <= config.stop_datetime:
+        raise ValueError("the measurement end time has not yet been reached")
+    config.fs = alpsdoocslib.parse_rate(spec.get('decimation', '16kHz'))
+    config.decimation = alpsdoocslib.rate_name(config.fs)
+    config.decimationFactor = 16000 / config.fs
+    config.dtype = spec.get('dtype', np.dtype(alpsdoocslib.floatDtype).name)
+    if config.dtype not in ('float32', 'float64'):
+        raise ValueError(f"dtype must be float32 or float64, not '{config.dtype}'")
+    config.usercomment = spec.get('comment', '')
+    config.overwrite = bool(spec.get('overwrite', False))
+    config.checkpoint_interval = spec.get('checkpoint_interval', 60)
+    config.report_interval = spec.get('report_interval', 10)
+    config.idle_timeout = spec.get('idle_timeout', 300)
+    config.processing_workers = spec.get('processing_workers', alpsdoocslib.processingWorkers)
+    config.memory_budget = float(spec.get('memory_budget', 0))
+    config.trend = bool(spec.get('trend', True))
+    config.quality = bool(spec.get('quality', True))
+    config.amplitude = bool(spec.get('amplitude', True))
+    config.archive = spec.get('archive')
+    config.archive_chunk = float(spec.get('archive_chunk', 3600))
+    config.trigger = spec.get('trigger')
+    if config.trigger is not None:
+        config.trigger = {'channel': config.trigger.get('channel', config.channels[0]),
+                          'threshold': float(config.trigger['threshold']),
+                          'edge': config.trigger.get('edge', 'rising'),
+                          'pre': float(config.trigger.get('pre', 1)), 'post': float(config.trigger.get('post', 1)),
+                          'max_window': float(config.trigger.get('max_window', 60))}
+        if config.trigger['channel'] not in config.channels:
+            raise ValueError(f"trigger channel {config.trigger['channel']} is not one of the job's channels")
+        if config.trigger['edge'] not in alpsdoocslib.TriggeredCapture.edges:
+            raise ValueError(f"trigger edge must be one of {alpsdoocslib.TriggeredCapture.edges}")
+    config.demodulate = spec.get('demodulate')
+    if config.demodulate is not None:
+        config.demodulate = {'frequency': float(config.demodulate['frequency']),
+                             'bandwidth': float(config.demodulate.get('bandwidth', 10)),
+                             'output': config.demodulate.get('output', 'iq')}
+        if config.demodulate['output'] not in ('iq', 'polar'):
+            raise ValueError(f"demodulation output must be 'iq' or 'polar', not '{config.demodulate['output']}'")
+    config.outputs = [make_output(config, output) for output in spec.get('outputs', [])]
+    if config.outputs and config.trigger is not None:
+        raise ValueError("extra outputs cannot be combined with a trigger")
+    config.correlate = spec.get('correlate')
+    if config.correlate is not None:
+        pairs = config.correlate.get('pairs', [[a, b] for k, a in enumerate(config.channels) for b in config.channels[k+1:]])
+        for pair in pairs:
+            if len(pair) != 2 or any(channel not in config.channels for channel in pair):
+                raise ValueError(f"correlation pair {pair} is not two of the job's channels")
+        config.correlate = {'pairs': [tuple(config.channels.index(channel) for channel in pair) for pair in pairs],
+                            'max_lag': float(config.correlate.get('max_lag', 0.01))}
+        if config.trigger is not None:
+            raise ValueError("correlation cannot be combined with a trigger")
+    config.filesize = config.fs*np.dtype(config.dtype).itemsize*config.mytimedelta.total_seconds()*len(config.channels)/1e6
+    config.configSummary = (
+                            f"\n###########################################################"
+                            f"\nFile save configuration overview."
+                            f"\n   This will save data to: {config.path}"
+                            f"\n   Data start time: {config.start_datetime}"
+                            f"\n   Data stop time: {config.stop_datetime}"
+                            f"\n   Data Duration: {config.mytimedelta}"
+                            f"\n   Sampling rate: {config.decimation}"
+                            f"\n   Processing precision: {config.dtype}"
+                           )
+    if config.fs != 16000:
+        config.configSummary += "\n   Resampling: 16000 Hz x {}/{}".format(*alpsdoocslib.resample_ratio(16000, config.fs))
+    for i, channel in enumerate(config.channels):
+        config.configSummary += f"\n   Saving on Channel {i+1}: {channel} ..... channel label: {config.channelcomments[i]}"
+        if config.scales[i] != (1.0, 0.0):
+            config.configSummary += f" ..... calibration: {config.scales[i][0]}*x + {config.scales[i][1]}"
+    if config.archive is not None:
+        config.configSummary += f"\n   Archiving into {config.archive} in chunks of {config.archive_chunk:g} s"
+    if config.trigger is not None:
+        config.configSummary += (f"\n   Triggered capture on {config.trigger['channel']}: {config.trigger['edge']} edge through"
+                                 f" {config.trigger['threshold']:g}, {config.trigger['pre']:g} s before to {config.trigger['post']:g} s after"
+                                 f" ..... {config.filename}_event####{config.filetype}, index {config.filename}_triggers.json")
+    if config.correlate is not None:
+        config.configSummary += (f"\n   Correlating {', '.join(config.channels[i] + ' x ' + config.channels[j] for i, j in config.correlate['pairs'])}"
+                                 f" for lags up to {config.correlate['max_lag']:g} s")
+    if config.demodulate is not None:
+        config.configSummary += (f"\n   Demodulation at {config.demodulate['frequency']:g} Hz, bandwidth {config.demodulate['bandwidth']:g} Hz,"
+                                 f" output {config.demodulate['output']} ..... {config.filename}_demod{config.filetype}")
+    for output in config.outputs:
+        config.configSummary += (f"\n   Also saving {', '.join(output['channels'])} at {output['decimation']}"
+                                 f" ({output['dtype']}) to: {output['path']}")
+        if output['filter']:
+            config.configSummary += f" ..... filter: {output['filter']}"
+    config.configSummary += "\n"
+    return config
+
+
+############################### make_output ###################################
+### Builds one extra output of a job from its spec, e.g.
+###   {"filename": "run42_1kHz", "filetype": ".csv", "decimation": "1kHz",
+###    "channels": ["NR/CH_1.00"], "filter": {"filtertype": "lowpass", "filterfreq": 100}}
+### Anything left out is taken from the job. The filter takes the arguments of
+### alpsdoocslib.filter_data ("lowpass"/"highpass" with "filterfreq",
+### "bandpass" with "flow" and "fhigh").
+###############################################################################
+def make_output(config, spec):
+    fs = alpsdoocslib.parse_rate(spec.get('decimation', config.decimation))
+    output = {'filename': spec.get('filename', f"{config.filename}_{alpsdoocslib.rate_name(fs)}"),
+              'filetype': spec.get('filetype', config.filetype),
+              'decimation': alpsdoocslib.rate_name(fs),
+              'dtype': spec.get('dtype', config.dtype),
+              'channels': [c for c in spec.get('channels', config.channels) if c != 'None'],
+              'filter': spec.get('filter')}
+    if output['filetype'] not in (".mat", ".csv"):
+        raise ValueError(f"unknown filetype '{output['filetype']}'")
+    if output['dtype'] not in ('float32', 'float64'):
+        raise ValueError(f"dtype must be float32 or float64, not '{output['dtype']}'")
+    for channel in output['channels']:
+        if channel not in config.channels:
+            raise ValueError(f"output channel {channel} is not one of the job's channels")
+    if output['filter'] is not None:
+        output['filter'] = dict(output['filter'])
+        if output['filter'].get('filtertype') not in ('lowpass', 'highpass', 'bandpass'):
+            raise ValueError("output filter type must be lowpass, highpass or bandpass")
+    output['fs'] = fs
+    output['indices'] = [config.channels.index(c) for c in output['channels']]
+    output['path'] = os.path.join(config.dirpath, output['filename'] + output['filetype'])
+    if output['path'] == config.path:
+        raise ValueError(f"output {output['path']} is the job's own output file")
+    return output
+
+
+############################### run_job #######################################
+### Pulls the data for one job through the streaming path, decimates, writes the
+### output file and the configuration text file. Returns a short summary dict;
+### raises on failure.
+### With checkpointing on (the default) blocks go straight to a CheckpointedSpill
+### in <filename>_partial/ next to the output. If a job fails or the machine goes
+### down, rerunning the same job continues from the last checkpoint instead of
+### fetching everything again. Otherwise blocks are collected in memory into a
+### time-aligned Recording. Either way the channels written share one t0, with
+### skipped frames zero-filled and a channel that got no data saved as zeros.
+### If the DAQ stops before the stop time a checkpointed job raises
+### IncompleteRangeError and keeps its checkpoint, so a rerun fetches only the
+### rest; an in-memory job saves what it got and returns completed=False.
+### With a memory budget (MB) the job switches to streaming mode when the
+### projected in-memory footprint would not fit: the spill files are decimated
+### and written chunk by chunk (see plan_memory). `backend` replaces pydaq,
+### e.g. with example_data.FakeDAQ.
+### A job with a trigger keeps only the windows around the trigger crossings
+### (TriggeredCapture), writing each through write_event as it completes. It is
+### not checkpointed: the capture keeps only seconds of history, so a failed
+### triggered job is rerun from the start and rewrites its event files.
+### Each way of acquiring is one acquire_* context manager giving (datas,
+### starttime, samples, events, scheduler) and cleaning up after its own mode
+### when the job has been written; write_job decimates and writes for all three.
+###############################################################################
+def run_job(config, backend=None):
+    for path in [config.path] + [output['path'] for output in config.outputs]:
+        if os.path.exists(path) and not config.overwrite:
+            raise FileExistsError(f"{path} already exists, set 'overwrite' to replace it")
+    chans = ['ALPS.DIAG/ALPS.ADC.'+s for s in config.daqchannels]
+    stats = alpsdoocslib.AcquisitionStats(reporter=lambda line: print(f"{config.filename}: {line}"),
+                                          interval=config.report_interval)
+    summaries = make_summaries(config, chans)
+    chunk = plan_memory(config) if config.trigger is None else 0
+    if config.trigger is not None:
+        acquire = acquire_triggered
+    elif config.checkpoint_interval or chunk:
+        acquire = acquire_spilled
+    else:
+        acquire = acquire_in_memory
+    with acquire(config, chans, stats, summaries, chunk, backend) as (datas, starttime, samples, events, scheduler):
+        samples, correlations = write_job(config, chans, stats, summaries, datas, starttime, samples, events, chunk)
+        if 'trend' in summaries:
+            summaries['trend'].save(os.path.join(config.dirpath, config.filename+'_trend.npz'))
+        if 'archive' in summaries:
+            summaries['archive'].close()
+        if 'demod' in summaries:
+            summaries['demod'].save(os.path.join(config.dirpath, config.filename+'_demod'+config.filetype), config.demodulate['output'])
+        save_config_file(config)
+        stats.report(force=True)
+        stats.save_json(os.path.join(config.dirpath, config.filename+'_stats.json'))
+        peak = alpsdoocslib.peak_rss_mb()
+        if config.memory_budget:
+            print(f"{config.filename}: peak memory {peak:.0f} MB of {config.memory_budget:g} MB budget")
+    return {'path': config.path, 'events': events, 'samples': samples, 'peak_rss_mb': peak,
+            'outputs': [output['path'] for output in config.outputs],
+            'correlations': [{'channels': result['channels'], 'peak_lag': float(result['peak_lag']),
+                              'peak_coefficient': float(result['peak_coefficient'])} for result in correlations], 'completed': scheduler.completed, 'range': scheduler.describe()}
+
+
+### the spill directory of a checkpointed or streaming job, also used for its decimated files
+def partial_dir(config):
+    return os.path.join(config.dirpath, config.filename+'_partial')
+
+
+def report_missing(config, missing):
+    if missing:
+        config.configSummary += f"\n   No data received for {', '.join(missing)}, saved as zeros\n"
+        print(f"{config.filename}: no data received for {', '.join(missing)}, saved as zeros")
+
+
+########################### acquire_triggered #################################
+### Triggered job: the trigger windows are written as they complete, so there
+### are no channel datas to write afterwards (datas is None). Writes the
+### trigger index <filename>_triggers.json once the job has been written.
+###############################################################################
+@contextmanager
+def acquire_triggered(config, chans, stats, summaries, chunk, backend):
+    index = []
+    trigger = config.trigger
+    scheduler = alpsdoocslib.PollScheduler(alpsdoocslib.daq_timestamp(config.input_stop), idle_timeout=config.idle_timeout)
+    capture = alpsdoocslib.TriggeredCapture(chans, 'ALPS.DIAG/ALPS.ADC.'+trigger['channel'], trigger['threshold'],
+                                            trigger['pre'], trigger['post'], trigger['edge'],
+                                            scale=config.scales[config.channels.index(trigger['channel'])],
+                                            max_window=trigger['max_window'],
+                                            sink=lambda event: index.append(write_event(config, event, len(index) + 1)))
+    for daqname, macropulse, timestamp, data in alpsdoocslib.iter_doocs_data(chans, config.input_start, config.input_stop, stats=stats,
+                                                                             scheduler=scheduler, backend=backend):
+        if daqname in chans:
+            with stats.stage('buffer'):
+                capture.append(daqname, macropulse, timestamp, data)
+            with stats.stage('summarize'):
+                for summary in summaries.values():
+                    summary.append(daqname, macropulse, timestamp, data)
+    capture.flush()
+    samples = [sum(entry['samples'] for entry in index)]*len(chans)
+    yield None, None, samples, stats.counts['events'], scheduler
+    with stats.stage('write'):
+        with open(os.path.join(config.dirpath, config.filename+'_triggers.json'), 'w') as f:
+            json.dump({'channel': trigger['channel'], 'threshold': trigger['threshold'],
+                       'edge': trigger['edge'], 'pre': trigger['pre'], 'post': trigger['post'],
+                       'range': [alpsdoocslib.daq_timestamp(config.input_start), alpsdoocslib.daq_timestamp(config.input_stop)],
+                       'events': index, 'quality': summaries['quality'].summary() if 'quality' in summaries else [],
+                       'amplitude': summaries['amplitude'].summary() if 'amplitude' in summaries else []},
+                      f, indent=1)
+    print(f"{config.filename}: {len(index)} trigger windows, {samples[0]/16000:.1f} s of the {config.mytimedelta.total_seconds():g} s range kept")
+
+
+############################ acquire_spilled ##################################
+### Checkpointed or streaming job: blocks go to a CheckpointedSpill in
+### partial_dir(config), resuming from its checkpoint. A resumed job rebuilds
+### the side tables from the spill files. The aligned channels are the spill
+### files themselves (streaming, `chunk` > 0) or memory maps of them; the spill
+### is removed once the job has been written.
+###############################################################################
+@contextmanager
+def acquire_spilled(config, chans, stats, summaries, chunk, backend):
+    spill = alpsdoocslib.CheckpointedSpill(partial_dir(config), chans,
+                                           key=f"{chans}|{config.input_start}|{config.input_stop}",
+                                           interval=config.checkpoint_interval or 60)
+    ### channels that never committed anything start over, the others continue from their checkpoints
+    stop = alpsdoocslib.daq_timestamp(config.input_stop)
+    try:
+        for start, group in spill.resume_groups(alpsdoocslib.daq_timestamp(config.input_start)):
+            scheduler = alpsdoocslib.PollScheduler(stop, idle_timeout=config.idle_timeout)
+            if start + 2*scheduler.period >= stop:
+                scheduler.got_data(start)
+                continue
+            start = alpsdoocslib.daq_timestring(start)
+            if spill.resumed:
+                print(f"Resuming {config.path} from {start} for {', '.join(group)}")
+            for daqname, macropulse, timestamp, data in alpsdoocslib.iter_doocs_data(group, start, config.input_stop, stats=stats,
+                                                                                     scheduler=scheduler, backend=backend):
+                if daqname in group:
+                    with stats.stage('write'):
+                        if not spill.write(daqname, macropulse, timestamp, data):
+                            continue
+                    with stats.stage('summarize'):
+                        for summary in summaries.values():
+                            summary.append(daqname, macropulse, timestamp, data)
+            if not scheduler.completed:
+                raise alpsdoocslib.IncompleteRangeError(scheduler.describe() + ", rerun the job to resume")
+    finally:
+        spill.close()
+    if spill.resumed:
+        ### the blocks before the restart were never seen here, so rebuild the side tables from the
+        ### spill files, a minute at a time, timed by the spill's blocks
+        ### the live archive is kept: its rows are flushed and it only fills in what is still missing
+        archive = summaries.get('archive')
+        if archive is not None:
+            archive.close()
+        summaries.update(make_summaries(config, chans, archive))
+        with stats.stage('summarize'):
+            for i, c in enumerate(chans):
+                for timestamp, data in spill.runs(i, 16000*60):
+                    for summary in summaries.values():
+                        summary.append(c, None, timestamp, data)
+    ### common t0, skipped frames zero-filled: the same layout as an in-memory Recording
+    with stats.stage('write'):
+        starttime, nsamples, gaps, missing = spill.align(chunk or 1 << 20)
+    report_missing(config, missing)
+    datas = spill.aligned_paths() if chunk else spill.arrays()
+    ### events including the blocks committed before a restart
+    yield datas, starttime, [nsamples]*len(chans), spill.events, scheduler
+    spill.remove()
+
+
+########################### acquire_in_memory #################################
+### In-memory job: the blocks are collected into a time-aligned Recording.
+###############################################################################
+@contextmanager
+def acquire_in_memory(config, chans, stats, summaries, chunk, backend):
+    scheduler = alpsdoocslib.PollScheduler(alpsdoocslib.daq_timestamp(config.input_stop), idle_timeout=config.idle_timeout)
+    builder = alpsdoocslib.RecordingBuilder(chans, config.channelcomments, capacity=16000*config.mytimedelta.total_seconds())
+    for daqname, macropulse, timestamp, data in alpsdoocslib.iter_doocs_data(chans, config.input_start, config.input_stop, stats=stats,
+                                                                             scheduler=scheduler, backend=backend):
+        if daqname in chans:
+            with stats.stage('buffer'):
+                builder.append(daqname, macropulse, timestamp, data)
+            with stats.stage('summarize'):
+                for summary in summaries.values():
+                    summary.append(daqname, macropulse, timestamp, data)
+    recording = builder.build()
+    report_missing(config, builder.missing)
+    datas = list(recording.data)
+    yield datas, recording.t0, [len(d) for d in datas], stats.counts['events'], scheduler
+
+
+############################### write_job #####################################
+### The part of run_job shared by all modes: correlates, decimates (chunk by
+### chunk through files in partial_dir(config) when streaming, `chunk` > 0),
+### adds the side tables' metadata and writes the job's file and its extra
+### outputs. datas is None for a triggered job, whose windows are already
+### written. Returns the samples per channel written and the correlations.
+###############################################################################
+def write_job(config, chans, stats, summaries, datas, starttime, samples, events, chunk):
+    correlations = []
+    if config.correlate is not None and datas is not None:
+        ### on the raw 16 kHz channels, before any decimation
+        with stats.stage('summarize'):
+            correlations = alpsdoocslib.cross_correlate(datas, config.correlate['pairs'], config.correlate['max_lag'],
+                                                        names=chans, chunk=chunk or 1 << 20)
+    raw_dtype = np.int16
+    outputs = []
+    if datas is None:
+        pass
+    elif chunk:
+        if config.outputs:
+            with stats.stage('decimate'):
+                outputs = [[output_to_file(datas[i], i, output, partial_dir(config), chunk) for i in output['indices']]
+                           for output in config.outputs]
+        if config.fs != 16000:
+            with stats.stage('decimate'):
+                datas = [decimate_to_file(data, os.path.join(partial_dir(config), f'channel{i+1}.decimated'), config, chunk)
+                         for i, data in enumerate(datas)]
+            raw_dtype = np.dtype(config.dtype)
+            samples = [alpsdoocslib.resampled_length(n, 16000, config.fs) for n in samples]
+    else:
+        ### with a memory budget the data must not depend on whether the job had to stream,
+        ### so the in-memory path uses the streaming filters as well
+        stream = bool(config.memory_budget)
+        if config.outputs:
+            ### one pass over the fetched channels for the job's own file and every extra output
+            sinks = [{'rate': config.fs, 'dtype': config.dtype, 'stream': stream}]
+            sinks += [{'channels': output['indices'], 'rate': output['fs'], 'dtype': output['dtype'],
+                       'filter': output['filter'], 'stream': stream} for output in config.outputs]
+            with stats.stage('decimate'):
+                results = alpsdoocslib.fan_out(datas, sinks, workers=config.processing_workers)
+            datas, outputs = results[0], results[1:]
+        elif config.fs != 16000:
+            with stats.stage('decimate'):
+                datas = alpsdoocslib.map_channels(alpsdoocslib.resample_chunked if stream else alpsdoocslib.resample_data, datas,
+                                                  workers=config.processing_workers, fs_in=16000, fs_out=config.fs, dtype=config.dtype)
+        samples = [len(d) for d in datas]
+
+    metadata = alpsdoocslib.resample_metadata(16000, config.fs)
+    for key in ('quality', 'amplitude'):
+        if key in summaries:
+            metadata.update(summaries[key].metadata())
+            config.configSummary += "".join("\n   " + line for line in summaries[key].summary()) + "\n"
+            for line in summaries[key].summary():
+                print(f"{config.filename}: {line}")
+    if correlations:
+        metadata.update(alpsdoocslib.correlation_metadata(correlations))
+        config.configSummary += "".join("\n   " + line for line in alpsdoocslib.correlation_summary(correlations)) + "\n"
+        for line in alpsdoocslib.correlation_summary(correlations):
+            print(f"{config.filename}: {line}")
+    if datas is None:
+        return samples, correlations
+    with stats.stage('write'):
+        if config.filetype == ".csv":
+            if chunk:
+                alpsdoocslib.save_channels_to_csv_chunked(datas, config.path, chunk, dtype=raw_dtype)
+            else:
+                alpsdoocslib.save_channels_to_csv(datas, config.path)
+        elif config.filetype == ".mat":
+            if chunk:
+                ### savemat needs whole arrays; plan_memory checked that the output alone fits
+                datas = [np.fromfile(data, dtype=raw_dtype) if isinstance(data, str) else data for data in datas]
+            alpsdoocslib.save_to_mat(datas=datas, channels=config.daqchannels, path=config.path, events=events,
+                                     labels=config.channelcomments, fs=config.fs, starttime=starttime,
+                                     scales=config.scales, dtype=config.dtype, metadata=metadata)
+        for output, output_datas in zip(config.outputs, outputs):
+            write_output(config, output, output_datas, starttime, events, metadata)
+    return samples, correlations
+
+
+############################### write_event ###################################
+### Writes one trigger window of a triggered job as <filename>_event0001.mat
+### (or .csv), decimated like a normal job, and returns its entry for the
+### trigger index <filename>_triggers.json.
+###############################################################################
+def write_event(config, event, number):
+    path = os.path.join(config.dirpath, f"{config.filename}_event{number:04d}{config.filetype}")
+    datas = event['datas']
+    metadata = dict(alpsdoocslib.resample_metadata(16000, config.fs), trigger_times=event['triggers'])
+    if config.fs != 16000:
+        datas = [alpsdoocslib.resample_data(data, 16000, config.fs, dtype=config.dtype) for data in datas]
+    if config.filetype == ".csv":
+        alpsdoocslib.save_channels_to_csv(datas, path)
+    else:
+        alpsdoocslib.save_to_mat(datas=datas, channels=config.daqchannels, path=path, events=len(event['triggers']),
+                                 labels=config.channelcomments, fs=config.fs, starttime=event['t_start'],
+                                 scales=config.scales, dtype=config.dtype, metadata=metadata)
+    return {'file': os.path.basename(path), 't_start': event['t_start'], 't_stop': event['t_stop'],
+            'triggers': event['triggers'], 'samples': len(event['datas'][0])}
+
+
+############################### write_output ##################################
+### Writes one extra output of a job (see make_output) from its processed
+### channels: arrays, or raw files of the output dtype (int16 at 16 kHz) in
+### streaming mode. The per channel tables (quality, amplitude) are renumbered
+### to the output's channels.
+###############################################################################
+def write_output(config, output, datas, starttime, events, metadata):
+    raw_dtype = np.int16 if output['fs'] == 16000 and not output['filter'] else np.dtype(output['dtype'])
+    if output['filetype'] == ".csv":
+        if any(isinstance(data, str) for data in datas):
+            alpsdoocslib.save_channels_to_csv_chunked(datas, output['path'], dtype=raw_dtype)
+        else:
+            alpsdoocslib.save_channels_to_csv(datas, output['path'])
+        return
+    datas = [np.fromfile(data, dtype=raw_dtype) if isinstance(data, str) else data for data in datas]
+    renumbered = {key: value for key, value in metadata.items() if not key.startswith(('channel', 'fs_raw', 'resample_'))}
+    renumbered.update(alpsdoocslib.resample_metadata(16000, output['fs']))
+    for j, i in enumerate(output['indices']):
+        prefix = f'channel{i+1}_'
+        for key, value in metadata.items():
+            if key.startswith(prefix):
+                renumbered[f'channel{j+1}_' + key[len(prefix):]] = value
+    alpsdoocslib.save_to_mat(datas=datas, channels=output['channels'], path=output['path'], events=events,
+                             labels=[config.channelcomments[i] for i in output['indices']], fs=output['fs'],
+                             starttime=starttime, scales=[config.scales[i] for i in output['indices']],
+                             dtype=output['dtype'], metadata=renumbered)
+
+
+############################### plan_memory ###################################
+### Decides whether a job fits its memory budget. Returns 0 for the normal
+### in-memory processing, or the chunk length (samples) for streaming mode
+### when the current RSS plus the projected footprint (estimate_memory_mb)
+### exceeds config.memory_budget. Streaming decimation uses a FIR anti-alias
+### filter (StreamDecimator) instead of the IIR one of decimate_data; a job
+### with a budget uses it in memory too, so its data does not depend on the
+### mode. Rates that are not a whole factor of 16 kHz use StreamResampler.
+### Raises MemoryError up front, before anything is fetched, for a .mat job
+### whose output alone cannot fit, since savemat needs whole arrays, and for
+### extra outputs that are filtered (filter_data works on whole channels).
+###############################################################################
+def plan_memory(config):
+    if not config.memory_budget:
+        return 0
+    seconds = config.mytimedelta.total_seconds()
+    ### the decimation needs scipy.signal either way; load it before measuring, since
+    ### its ~70 MB count against the budget just like the data
+    importlib.import_module('scipy.signal')
+    current = alpsdoocslib.current_rss_mb()
+    projected = current + alpsdoocslib.estimate_memory_mb(len(config.channels), seconds, config.decimationFactor,
+                                                          config.dtype, workers=config.processing_workers)
+    ### in memory every extra output holds its processed channels as well
+    sizes = [len(extra['indices'])*extra['fs']*seconds*(2 if extra['fs'] == 16000 and not extra['filter']
+                                                        else np.dtype(extra['dtype']).itemsize)/1e6
+             for extra in config.outputs]
+    projected += sum(sizes)
+    if projected <= config.memory_budget:
+        config.configSummary += f"\n   Memory budget: {config.memory_budget:g} MB, in memory (FIR decimation)\n"
+        return 0
+    headroom = config.memory_budget - current
+    if headroom <= 0:
+        raise MemoryError(f"the {config.memory_budget:g} MB budget is below the {current:.0f} MB this process already uses")
+    itemsize = 2 if config.fs == 16000 else np.dtype(config.dtype).itemsize
+    output = len(config.channels)*16000*seconds/config.decimationFactor*itemsize/1e6
+    if config.filetype == ".mat" and output > 0.8*headroom:
+        raise MemoryError(f"{output:.0f} MB of .mat output does not fit the {config.memory_budget:g} MB budget "
+                          f"({current:.0f} MB in use), use .csv or a larger budget")
+    ### a chunk costs a few float copies when decimating; CSV formatting adds a fixed
+    ### few MB (save_channels_to_csv_chunked formats in bounded batches). The chunk
+    ### gets a quarter of what is left after that, the rest is slack for transient
+    ### copies and the allocator
+    cost = 4*np.dtype(config.dtype).itemsize
+    reserve = 16
+    if headroom <= 2*reserve:
+        raise MemoryError(f"the {config.memory_budget:g} MB budget leaves too little above the {current:.0f} MB "
+                          f"this process already uses")
+    for extra, size in zip(config.outputs, sizes):
+        if extra['filter']:
+            raise MemoryError(f"the filtered output {extra['path']} needs whole channels in memory, "
+                              f"which does not fit the {config.memory_budget:g} MB budget")
+        if extra['filetype'] == ".mat" and size > 0.8*headroom:
+            raise MemoryError(f"{size:.0f} MB of .mat output {extra['path']} does not fit the {config.memory_budget:g} MB budget "
+                              f"({current:.0f} MB in use), use .csv or a larger budget")
+    chunk = int(np.clip((headroom - reserve)*1e6/(4*cost), 16000, 16000*64))//16000*16000
+    print(f"{config.filename}: projected {projected:.0f} MB exceeds the {config.memory_budget:g} MB budget, "
+          f"streaming in chunks of {chunk//16000} s")
+    config.configSummary += f"\n   Memory budget: {config.memory_budget:g} MB, streaming mode (FIR decimation)\n"
+    return chunk
+
+
+############################ decimate_to_file #################################
+### resamples one spill channel file chunk by chunk into a raw file of
+### config.dtype and returns its path (or an empty array for an empty channel)
+###############################################################################
+def decimate_to_file(data, path, config, chunk):
+    if not isinstance(data, str):
+        ### a channel without data: zeros, without allocating them
+        return np.broadcast_to(np.zeros((), dtype=config.dtype), (alpsdoocslib.resampled_length(len(data), 16000, config.fs),))
+    with open(path, 'wb') as f:
+        alpsdoocslib.resample_chunked(data, 16000, config.fs, config.dtype, chunk, out=f)
+    return path
+
+
+############################ output_to_file ###################################
+### streaming mode counterpart of fan_out for one channel of an extra output:
+### the spill file itself at 16 kHz, else resampled chunk by chunk into a raw
+### file that outputs with the same rate and dtype share
+###############################################################################
+def output_to_file(data, i, output, directory, chunk):
+    if output['fs'] == 16000:
+        return data
+    if not isinstance(data, str):
+        return np.broadcast_to(np.zeros((), dtype=output['dtype']), (alpsdoocslib.resampled_length(len(data), 16000, output['fs']),))
+    path = os.path.join(directory, f"channel{i+1}_{output['decimation']}_{output['dtype']}.decimated")
+    if not os.path.exists(path):
+        with open(path, 'wb') as f:
+            alpsdoocslib.resample_chunked(data, 16000, output['fs'], output['dtype'], chunk, out=f)
+    return path
+
+
+########################## make_summaries #####################################
+### the side tables fed with every block as it arrives, as enabled in the config
+### (trend table, quality flags, amplitude statistics, archive, lock-in
+### demodulation); an already open `archive` is reused rather than reopened
+###############################################################################
+def make_summaries(config, chans, archive=None):
+    summaries = {}
+    if config.trend:
+        summaries['trend'] = alpsdoocslib.TrendTable(chans, config.channelcomments, scales=config.scales)
+    if config.quality:
+        summaries['quality'] = alpsdoocslib.QualityFlags(chans)
+    if config.amplitude:
+        summaries['amplitude'] = alpsdoocslib.AmplitudeStats(chans, config.channelcomments, scales=config.scales)
+    if config.archive is not None:
+        summaries['archive'] = archive or alpsdoocslib.Archive(config.archive, chunk=config.archive_chunk)
+    if config.demodulate is not None:
+        summaries['demod'] = alpsdoocslib.LockIn(chans, config.demodulate['frequency'], config.demodulate['bandwidth'],
+                                                 config.channelcomments, scales=config.scales, dtype=config.dtype)
+    return summaries
+
+
+######################### save_config_file ####################################
+### same text file as saveConfigFile() in the save GUI
+###############################################################################
+def save_config_file(config):
+    with open(os.path.join(config.dirpath, config.filename+'_config_file.txt'), 'w') as f:
+        f.write(config.configSummary)
+        f.write("\n\nUser Comments: \n  ")
+        f.write(config.usercomment)
+
+
+############################### run_jobs ######################################
+### Runs a list of job configs with at most `workers` running at once. Each
+### worker is a separate process, since pydaq holds one connection per process.
+### Returns a list of (config, result, error) in the order the jobs were given.
+###############################################################################
+def run_jobs(configs, workers=1):
+    results = []
+    if workers <= 1:
+        for config in configs:
+            try:
+                results.append((config, run_job(config), None))
+            except Exception as e:
+                results.append((config, None, e))
+        return results
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(run_job, config) for config in configs]
+        for config, future in zip(configs, futures):
+            try:
+                results.append((config, future.result(), None))
+            except Exception as e:
+                results.append((config, None, e))
+    return results
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description="Save ALPS DOOCS DAQ data without the GUI.")
+    parser.add_argument('--jobs', help="JSON file containing a list of job specs")
+    parser.add_argument('--workers', type=int, default=1, help="number of jobs run in parallel (default 1)")
+    parser.add_argument('--channels', nargs='+', help="channels, e.g. NR/CH_1.00 NR/CH_1.01")
+    parser.add_argument('--labels', nargs='+', default=[], help="one label per channel")
+    parser.add_argument('--start', help="start time, YYYY-MM-DDTHH:MM:SS")
+    parser.add_argument('--duration', type=float, help="duration in seconds")
+    parser.add_argument('--decimation', default='16kHz',
+                        help=f"output rate: {', '.join(alpsdoocslib.decimationVal)} or any other, e.g. 250Hz, 2.048kHz (default 16kHz)")
+    parser.add_argument('--filetype', default='.mat', choices=['.mat', '.csv'])
+    parser.add_argument('--dtype', default='float64', choices=['float32', 'float64'],
+                        help="precision of decimation and of the saved data (default float64)")
+    parser.add_argument('--directory', default=os.getcwd())
+    parser.add_argument('--filename', default='default_filename')
+    parser.add_argument('--comment', default='')
+    parser.add_argument('--overwrite', action='store_true')
+    parser.add_argument('--no-trend', dest='trend', action='store_false',
+                        help="do not write the per second / per minute trend table <filename>_trend.npz")
+    parser.add_argument('--no-quality', dest='quality', action='store_false',
+                        help="skip the clipping / flat-line / gap / DC jump flags")
+    parser.add_argument('--no-amplitude', dest='amplitude', action='store_false',
+                        help="skip the amplitude histograms and quantiles of the raw data")
+    parser.add_argument('--processing-workers', type=int, default=alpsdoocslib.processingWorkers,
+                        help="cores used per job for decimation (default: all)")
+    parser.add_argument('--idle-timeout', type=float, default=300,
+                        help="give up when the DAQ delivers nothing for this many seconds (default 300)")
+    parser.add_argument('--checkpoint-interval', type=float, default=60,
+                        help="seconds between checkpoints of a running pull, 0 disables resuming (default 60)")
+    parser.add_argument('--archive', metavar='DIRECTORY',
+                        help="also add the raw data to the time-partitioned archive in DIRECTORY")
+    parser.add_argument('--archive-chunk', type=float, default=3600, help="seconds per archive chunk file (default 3600)")
+    parser.add_argument('--trigger', nargs=2, metavar=('CHANNEL', 'THRESHOLD'),
+                        help="only keep windows around threshold crossings of CHANNEL (calibrated units)")
+    parser.add_argument('--trigger-edge', default='rising', choices=list(alpsdoocslib.TriggeredCapture.edges))
+    parser.add_argument('--pre', type=float, default=1, help="seconds kept before each trigger (default 1)")
+    parser.add_argument('--post', type=float, default=1, help="seconds kept after each trigger (default 1)")
+    parser.add_argument('--demodulate', nargs=2, type=float, metavar=('FREQUENCY', 'BANDWIDTH'),
+                        help="also write <filename>_demod: every channel demodulated at FREQUENCY Hz to BANDWIDTH Hz")
+    parser.add_argument('--demod-output', default='iq', choices=['iq', 'polar'],
+                        help="demodulated channels as I/Q or amplitude/phase (default iq)")
+    parser.add_argument('--also', nargs=2, action='append', default=[], metavar=('FILETYPE', 'DECIMATION'),
+                        help="also write <filename>_<DECIMATION><FILETYPE> from the same pull (repeatable)")
+    parser.add_argument('--correlate', nargs=2, action='append', default=[], metavar=('CHANNEL', 'CHANNEL'),
+                        help="cross-correlate this pair of channels for their delay and correlation (repeatable)")
+    parser.add_argument('--max-lag', type=float, default=0.01,
+                        help="largest lag in seconds searched by --correlate (default 0.01)")
+    parser.add_argument('--memory-budget', type=float, default=0,
+                        help="peak memory in MB a job may use; larger pulls are streamed through disk (default: no limit)")
+    args = parser.parse_args(argv)
+    if args.jobs is None and (args.channels is None or args.start is None or args.duration is None):
+        parser.error("either --jobs or --channels, --start and --duration are required")
+    return args
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    try:
+        if args.jobs is not None:
+            with open(args.jobs) as f:
+                specs = json.load(f)
+        else:
+            specs = [{'channels': args.channels, 'labels': args.labels, 'start': args.start,
+                      'duration': args.duration, 'decimation': args.decimation, 'filetype': args.filetype, 'dtype': args.dtype,
+                      'directory': args.directory, 'filename': args.filename, 'comment': args.comment,
+                      'overwrite': args.overwrite, 'checkpoint_interval': args.checkpoint_interval,
+                      'idle_timeout': args.idle_timeout, 'processing_workers': args.processing_workers,
+                      'trend': args.trend, 'quality': args.quality,
+                      'amplitude': args.amplitude, 'memory_budget': args.memory_budget}]
+            if args.also:
+                specs[0]['outputs'] = [{'filetype': filetype, 'decimation': decimation} for filetype, decimation in args.also]
+            if args.correlate:
+                specs[0]['correlate'] = {'pairs': args.correlate, 'max_lag': args.max_lag}
+            if args.archive:
+                specs[0]['archive'] = args.archive
+                specs[0]['archive_chunk'] = args.archive_chunk
+            if args.trigger:
+                specs[0]['trigger'] = {'channel': args.trigger[0], 'threshold': float(args.trigger[1]),
+                                       'edge': args.trigger_edge, 'pre': args.pre, 'post': args.post}
+            if args.demodulate:
+                specs[0]['demodulate'] = {'frequency': args.demodulate[0], 'bandwidth': args.demodulate[1],
+                                          'output': args.demod_output}
+        configs = [make_config(spec) for spec in specs]
+    except (OSError, ValueError, KeyError) as e:
+        print(f"Error in job specification: {e}", file=sys.stderr)
+        return EXIT_USAGE
+
+    status = EXIT_OK
+    for config, result, error in run_jobs(configs, workers=args.workers):
+        if error is None and result['completed']:
+            print(f"OK     {config.path}: {result['events']} events, samples per channel {result['samples']}")
+        elif error is None or isinstance(error, alpsdoocslib.IncompleteRangeError):
+            print(f"INCOMPLETE {config.path}: {result['range'] if error is None else error}", file=sys.stderr)
+            if status == EXIT_OK:
+                status = EXIT_INCOMPLETE
+        else:
+            print(f"FAILED {config.path}: {error}", file=sys.stderr)
+            status = EXIT_FAILED
+    return status
+
+
+if __name__ == "__main__":
+    sys.exit(main())
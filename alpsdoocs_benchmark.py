@@ -0,0 +1,331 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Performance regression benchmarks for the alpsdoocslib hot paths.
+
+Runs each case on synthetic data from example_data (sine + noise, as raw 16 bit
+DAQ frames) of realistic length, and records the wall time (best of
+--repeat runs) and the peak traced memory of every case as JSON:
+
+    python alpsdoocs_benchmark.py --duration 3600 --output results.json
+    python alpsdoocs_benchmark.py --save-baseline            # write benchmark_baseline.json
+    python alpsdoocs_benchmark.py --compare                  # flag slowdowns against it
+
+With --compare the exit status is 1 when any case is slower than the baseline
+by more than --threshold (default 25%), or uses that much more memory, and
+also when the baseline was recorded with another --duration.
+
+The FFT cases time single threaded against multi threaded (processingWorkers)
+transforms of the typical segment sizes, batched like welch_psd does, so the
+gain of alpsdoocslib.set_fft_workers can be read off directly.
+
+Start up is tracked as well: the import time of every module and, where a
+display is available, the time to the first drawn window of both GUIs, each
+in a fresh interpreter (cases "import <module>" and "first window <module>").
+
+--memory-harness HOURS instead runs a whole batch job of that many hours on
+four channels against example_data.FakeDAQ in a fresh process, with
+--budget MB as its memory budget, and exits with 1 if the peak RSS of the job
+process went over the budget:
+
+    python alpsdoocs_benchmark.py --memory-harness 4 --budget 256
+"""
+import argparse
+import importlib.util
+import json
+import multiprocessing
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+import alpsdoocslib
+from example_data import synthetic_adc, synthetic_signal
+
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'benchmark_baseline.json')
+
+
+############################### benchmark cases ###############################
+### Each case is (name, setup, run): setup(duration) builds the input outside
+### the measurement, run(input) is timed and memory-traced.
+###############################################################################
+def _convert_scalar(raw):
+    out = np.zeros(len(raw), int)
+    for i, x in enumerate(raw):
+        out[i] = alpsdoocslib.unsigned_to_signed(x, 16)
+    return out
+
+
+def _buffer_blocks(raw):
+    buffer = alpsdoocslib.ChannelBuffer()
+    for k in range(0, len(raw), 500):
+        buffer.append(raw[k:k+500])
+    return buffer.array()
+
+
+def _amplitude_blocks(data):
+    stats = alpsdoocslib.AmplitudeStats(['bench'])
+    for k in range(0, len(data), 16000):
+        stats.append('bench', None, 0, data[k:k+16000])
+    return stats.quantiles(0)
+
+
+def _np_append_blocks(raw):
+    out = []
+    for k in range(0, len(raw), 500):
+        out = np.append(out, raw[k:k+500])
+    return out
+
+
+def _save_mat(data):
+    with tempfile.TemporaryDirectory() as d:
+        alpsdoocslib.save_to_mat([data], ['HN/CH_1.01'], os.path.join(d, 'bench.mat'), 0, ['bench'])
+
+
+def _save_csv(data):
+    with tempfile.TemporaryDirectory() as d:
+        alpsdoocslib.save_channels_to_csv([data], os.path.join(d, 'bench.csv'))
+
+
+### the FFT sizes the spectra actually use: 1 s segments at 16 kHz and at the
+### decimated 1 kHz, a power of two, and a prime length (as an odd decimated
+### record gives) next to its padded fast length
+fftSizes = (1000, 16000, 16384, 15991)
+
+def _fft_rows(n, rows):
+    return lambda: np.random.default_rng(0).standard_normal((rows, n))
+
+
+def _fft_cases(duration):
+    rows = min(max(int(duration), 16), 256)
+    result = []
+    for n in fftSizes:
+        fast = alpsdoocslib.fast_length(n)
+        for workers in sorted({1, alpsdoocslib.processingWorkers}):
+            result.append((f'rfft {rows}x{n} workers={workers}', _fft_rows(n, rows),
+                           lambda x, workers=workers: alpsdoocslib.rfft(x, workers=workers)))
+            if fast != n:
+                result.append((f'rfft {rows}x{n} padded to {fast} workers={workers}', _fft_rows(n, rows),
+                               lambda x, fast=fast, workers=workers: alpsdoocslib.rfft(x, fast, workers=workers)))
+    for workers in sorted({1, alpsdoocslib.processingWorkers}):
+        result.append((f'welch_psd 1s segments {duration:g}s workers={workers}', lambda: synthetic_signal(duration),
+                       lambda x, workers=workers: alpsdoocslib.welch_psd(x, 16000, 16000, workers=workers)))
+    return result
+
+
+def cases(duration):
+    ### the per sample Python loops and CSV text output are far slower than the
+    ### rest, so they run on a shorter stretch to keep the suite usable
+    short = min(duration, 10)
+    csv_length = min(duration, 60)
+    raw = lambda seconds: (lambda: synthetic_adc(seconds))
+    signed = lambda seconds: (lambda: alpsdoocslib.convert_to_signed(synthetic_adc(seconds)))
+    result = [
+        (f'unsigned_to_signed loop {short:g}s', lambda: synthetic_adc(short).astype(np.int64), _convert_scalar),
+        (f'convert_to_signed {duration:g}s', raw(duration), alpsdoocslib.convert_to_signed),
+        (f'ChannelBuffer growth {duration:g}s', signed(duration), _buffer_blocks),
+        (f'np.append growth {short:g}s', signed(short), _np_append_blocks),
+    ]
+    for name, rate in alpsdoocslib.decimationVal.items():
+        if rate != 16000:
+            result.append((f'decimate_data to {name} {duration:g}s', signed(duration),
+                           lambda x, factor=16000//rate: alpsdoocslib.decimate_data(x, factor)))
+    ### rates that are not a whole factor of 16 kHz go through StreamResampler
+    for rate in ('300Hz', '2048Hz'):
+        result.append((f'resample_data to {rate} {duration:g}s', signed(duration),
+                       lambda x, rate=rate: alpsdoocslib.resample_data(x, 16000, rate)))
+    result += [
+        (f'save_to_mat {duration:g}s', signed(duration), _save_mat),
+        (f'save_to_csv {csv_length:g}s', signed(csv_length), _save_csv),
+        (f'welch_psd 1s segments {duration:g}s', lambda: synthetic_signal(duration),
+         lambda x: alpsdoocslib.welch_psd(x, 16000, 16000)),
+    ]
+    result += [
+        (f'AmplitudeStats histogram {duration:g}s', signed(duration), _amplitude_blocks),
+        (f'AmplitudeStats sketch {duration:g}s', lambda: synthetic_signal(duration), _amplitude_blocks),
+        (f'cross_correlate 1 pair 10ms lags {duration:g}s', lambda: [synthetic_adc(duration), synthetic_adc(duration)],
+         lambda datas: alpsdoocslib.cross_correlate(datas, [(0, 1)], 0.01)),
+    ]
+    result += _fft_cases(duration)
+    if importlib.util.find_spec('gwpy') is not None:
+        result.append((f'signal_process PSD {duration:g}s', lambda: synthetic_signal(duration),
+                       lambda x: alpsdoocslib.signal_process(x, process="PSD", fftlength=1)))
+    return result
+
+
+############################### measure #######################################
+### best wall time over `repeat` runs, then one more run under tracemalloc for
+### the peak memory allocated by the case (numpy buffers included)
+###############################################################################
+def measure(setup, run, repeat=3):
+    data = setup()
+    times = []
+    for i in range(repeat):
+        t = time.perf_counter()
+        run(data)
+        times.append(time.perf_counter() - t)
+    tracemalloc.start()
+    run(data)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return {'time_s': min(times), 'peak_mb': peak/1e6}
+
+
+############################### startup #######################################
+### Import time of a module, or with window=True the time from the import of
+### a GUI module to its first drawn window (build_window() plus one update),
+### in a fresh interpreter so nothing is cached. Best of `repeat` runs; peak_mb
+### is the peak RSS of that interpreter. Returns None when the child fails,
+### e.g. without a display or without the GUI dependencies.
+###############################################################################
+startupModules = ['alpsdoocslib', 'alpsdoocs_batch', 'alpsdoocs_service', 'example_data', 'alpsdoocs_save', 'alpsdoocs_analyze']
+startupWindows = ['alpsdoocs_save', 'alpsdoocs_analyze']
+
+_startupScript = '''
+import resource, sys, time
+t = time.perf_counter()
+import {module}
+{window}
+t = time.perf_counter() - t
+peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+print(t, peak/1e6 if sys.platform == 'darwin' else peak/1e3)
+'''
+
+
+def startup(module, window=False, repeat=3):
+    script = _startupScript.format(module=module, window=f"root = {module}.build_window(); root.update(); root.destroy()"
+                                   if window else "")
+    times, peak = [], 0
+    for i in range(repeat):
+        child = subprocess.run([sys.executable, '-c', script], capture_output=True, text=True,
+                               cwd=os.path.dirname(os.path.abspath(__file__)))
+        if child.returncode:
+            return None
+        t, rss = child.stdout.split()[-2:]
+        times.append(float(t))
+        peak = max(peak, float(rss))
+    return {'time_s': min(times), 'peak_mb': peak}
+
+
+def run_suite(duration, repeat=3, select=None, report=print):
+    results = {}
+    for name, setup, run in cases(duration):
+        if select and select not in name:
+            continue
+        results[name] = measure(setup, run, repeat)
+        report(f"{name:45s} {results[name]['time_s']*1e3:10.1f} ms {results[name]['peak_mb']:10.1f} MB")
+    starts = [(f'import {module}', module, False) for module in startupModules]
+    starts += [(f'first window {module}', module, True) for module in startupWindows]
+    for name, module, window in starts:
+        if select and select not in name:
+            continue
+        result = startup(module, window, repeat)
+        if result is None:
+            report(f"{name:45s}    skipped (no display or missing GUI dependencies)")
+            continue
+        results[name] = result
+        report(f"{name:45s} {results[name]['time_s']*1e3:10.1f} ms {results[name]['peak_mb']:10.1f} MB")
+    return results
+
+
+############################### compare #######################################
+### returns a list of regressions: cases slower (or using more memory) than the
+### baseline by more than `threshold` (0.25 = 25%). Cases missing from either
+### side are ignored, so adding a case does not break the comparison, but a run
+### sharing no case with the baseline raises ValueError instead of passing.
+###############################################################################
+def compare(results, baseline, threshold=0.25):
+    if not set(results) & set(baseline):
+        raise ValueError("no case of this run is in the baseline")
+    regressions = []
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        for key in ('time_s', 'peak_mb'):
+            before, now = baseline[name][key], result[key]
+            if before > 0 and now > before*(1 + threshold):
+                regressions.append(f"{name}: {key} {before:.4g} -> {now:.4g} (+{100*(now/before - 1):.0f}%)")
+    return regressions
+
+
+############################# memory harness ##################################
+### Runs one batch job (alpsdoocs_batch.run_job) over `hours` of FakeDAQ data
+### with the given memory budget in a spawned process, so the peak RSS is that
+### of the job alone and not of this process. Returns the job's peak RSS in MB.
+###############################################################################
+def _memory_job(hours, budget, directory, filetype, decimation):
+    import alpsdoocs_batch
+    from example_data import FakeDAQ
+    spec = {'channels': ['NR/CH_1.00', 'NR/CH_1.01', 'NR/CH_1.02', 'NR/CH_1.03'],
+            'start': '2022-01-03 00:00:00', 'duration': {'hours': hours}, 'decimation': decimation,
+            'filetype': filetype, 'directory': directory, 'filename': 'memory_harness', 'overwrite': True,
+            'memory_budget': budget, 'report_interval': 60}
+    return alpsdoocs_batch.run_job(alpsdoocs_batch.make_config(spec), backend=FakeDAQ())['peak_rss_mb']
+
+
+def memory_harness(hours, budget, filetype='.csv', decimation='1kHz'):
+    with tempfile.TemporaryDirectory() as d:
+        with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn')) as pool:
+            return pool.submit(_memory_job, hours, budget, d, filetype, decimation).result()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the alpsdoocslib hot paths.")
+    parser.add_argument('--duration', type=float, default=600, help="seconds of 16 kHz data per case (default 600)")
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--select', help="only run cases whose name contains this text")
+    parser.add_argument('--output', help="write the results as JSON to this file")
+    parser.add_argument('--baseline', default=BASELINE)
+    parser.add_argument('--save-baseline', action='store_true', help="store the results as the new baseline")
+    parser.add_argument('--compare', action='store_true', help="compare against the baseline and flag slowdowns")
+    parser.add_argument('--threshold', type=float, default=0.25, help="allowed slowdown fraction (default 0.25)")
+    parser.add_argument('--memory-harness', type=float, metavar='HOURS',
+                        help="run a batch job over this many hours of FakeDAQ data and check its peak memory")
+    parser.add_argument('--budget', type=float, default=256, help="memory budget in MB for --memory-harness (default 256)")
+    parser.add_argument('--filetype', default='.csv', choices=['.mat', '.csv'], help="output of the --memory-harness job")
+    args = parser.parse_args(argv)
+
+    if args.memory_harness:
+        try:
+            peak = memory_harness(args.memory_harness, args.budget, args.filetype)
+        except MemoryError as e:
+            print(f"Job refused to run: {e}")
+            return 1
+        print(f"{args.memory_harness:g} h job: peak RSS {peak:.0f} MB, budget {args.budget:g} MB")
+        return 1 if peak > args.budget else 0
+
+    results = run_suite(args.duration, args.repeat, args.select)
+    document = {'machine': platform.node(), 'python': platform.python_version(), 'numpy': np.__version__,
+                'duration_s': args.duration, 'results': results}
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(document, f, indent=2)
+    if args.save_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump(document, f, indent=2)
+    if args.compare:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        ### case names carry the data length, and the import / window cases alone prove nothing
+        if baseline.get('duration_s') != args.duration:
+            print(f"Cannot compare: the baseline was recorded with --duration {baseline.get('duration_s')}")
+            return 1
+        try:
+            regressions = compare(results, baseline['results'], args.threshold)
+        except ValueError as e:
+            print(f"Cannot compare: {e}")
+            return 1
+        for line in regressions:
+            print("SLOWER " + line)
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
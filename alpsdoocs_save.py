@@ -20,10 +20,6 @@ import os.path
 from example_data import *
 from pathlib import Path
 
-root = Tk()
-root.title('ALPS DOOCS Save Data')
-#root.geometry("400x600")
-
 ### generate a class of configuration object
 class saveConfig(object):
     pass
@@ -35,6 +31,17 @@ class DateError(Exception):
     pass
 
 
+############################### parseScale() ##################################
+### reads a calibration entry "a, b" (or "a b"); empty means no calibration
+def parseScale(text):
+    values = text.replace(',',' ').split()
+    if not values:
+        return (1.0, 0.0)
+    if len(values) != 2:
+        raise ValueError(f"calibration '{text}' must be two numbers a, b")
+    return (float(values[0]), float(values[1]))
+
+
 ############################### UpdateConfig() ################################
 ### Function called when pressing the "Update Configuration" button. This function
 ### populates all the entry parameters provided by the user as attributes of "myConfig" object
@@ -43,6 +50,8 @@ def UpdateConfig():
         global myConfig
         myConfig.channels=[channel1select.get(),channel2select.get(),channel3select.get(),channel4select.get()]
         myConfig.channelcomments=[channel1Comment.get(),channel2Comment.get(),channel3Comment.get(),channel4Comment.get()]  
+        ### per-channel calibration a*x + b, as the 'scales' of a batch job
+        myConfig.channelscales=[parseScale(s.get()) for s in (channel1Scale,channel2Scale,channel3Scale,channel4Scale)]
         myConfig.filename=filename.get()
         myConfig.filetype=filetype.get()
         myConfig.time=[int(duration_d.get()),int(duration_h.get()),int(duration_m.get()),int(duration_s.get())]
@@ -70,11 +79,14 @@ def UpdateConfig():
         if myConfig.channels[3] != "None":
             numChannels += 1
                 
-        myConfig.decimation=decimation.get()
-        myConfig.decimationFactor = 16000 / decimationVal[decimation.get()] #calculates the factor by which data is decimated,
-                                                                            # e.g. for downsample from 16kHz to 8kHz, the factor is 2
+        ### any rate can be typed in, e.g. 250Hz or 2.048kHz, not only the listed ones
+        myConfig.fs = alpsdoocslib.parse_rate(decimation.get())
+        myConfig.decimation = alpsdoocslib.rate_name(myConfig.fs)
+        myConfig.decimationFactor = 16000 / myConfig.fs #calculates the factor by which data is decimated,
+                                                        # e.g. for downsample from 16kHz to 8kHz, the factor is 2
         
-        myConfig.filesize = decimationVal[decimation.get()]*8*myConfig.mytimedelta.total_seconds()*numChannels/1e6 ## estimates the output filesize in MB
+        myConfig.dtype = precisionVal[precision.get()]
+        myConfig.filesize = myConfig.fs*np.dtype(myConfig.dtype).itemsize*myConfig.mytimedelta.total_seconds()*numChannels/1e6 ## estimates the output filesize in MB
         myConfig.configSummary = (
                                     f"\n###########################################################"
                                     f"\nFile save configuration overview."
@@ -83,11 +95,24 @@ def UpdateConfig():
                                     f"\n   Data stop time: {myConfig.stop_datetime}"
                                     f"\n   Data Duration: {myConfig.mytimedelta}"
                                     f"\n   Sampling rate: {myConfig.decimation}"
-                                    f"\n   Saving on Channel 1: {myConfig.channels[0]} ..... channel label: {myConfig.channelcomments[0]}"
-                                    f"\n   Saving on Channel 2: {myConfig.channels[1]} ..... channel label: {myConfig.channelcomments[1]}"
-                                    f"\n   Saving on Channel 3: {myConfig.channels[2]} ..... channel label: {myConfig.channelcomments[2]}"
-                                    f"\n   Saving on Channel 4: {myConfig.channels[3]} ..... channel label: {myConfig.channelcomments[3]}\n"
+                                    f"\n   Processing precision: {myConfig.dtype}"
                                   )
+        for i in range(4):
+            myConfig.configSummary += f"\n   Saving on Channel {i+1}: {myConfig.channels[i]} ..... channel label: {myConfig.channelcomments[i]}"
+            if myConfig.channelscales[i] != (1.0, 0.0):
+                myConfig.configSummary += f" ..... calibration: {myConfig.channelscales[i][0]}*x + {myConfig.channelscales[i][1]}"
+        myConfig.configSummary += "\n"
+        if myConfig.fs != 16000:
+            myConfig.configSummary += "   Resampling: 16000 Hz x {}/{}\n".format(*alpsdoocslib.resample_ratio(16000,myConfig.fs))
+        ### the optional second output, <filename>_<rate><filetype>
+        myConfig.alsoFiletype = alsoFiletype.get()
+        myConfig.alsoFs = alpsdoocslib.parse_rate(alsoDecimation.get())
+        myConfig.alsoDecimation = alpsdoocslib.rate_name(myConfig.alsoFs)
+        myConfig.alsoPath = directory.get()+myConfig.filename+"_"+myConfig.alsoDecimation+myConfig.alsoFiletype
+        if myConfig.alsoFiletype != "None":
+            if myConfig.alsoPath == myConfig.path:
+                raise ValueError("the second output would overwrite the first")
+            myConfig.configSummary += f"   Also saving at {myConfig.alsoDecimation} to: {myConfig.alsoPath}\n"
         consoleBox.config(state=NORMAL)
         consoleBox.insert('insert',myConfig.configSummary)
         consoleBox.tag_config('warning',foreground="red")
@@ -113,6 +138,7 @@ def UpdateConfig():
 
     ### strips away channels left as "None" from the daqchannels list    
     myConfig.daqchannels=[value for value in myConfig.channels if value != 'None']
+    myConfig.scales=[scale for value,scale in zip(myConfig.channels,getattr(myConfig,'channelscales',[(1.0,0.0)]*4)) if value != 'None']
         
     
     
@@ -124,6 +150,7 @@ def UpdateConfig():
 ### oversized or overwriting another file without explicit permission.
 def SaveButtonClick():
     global myConfig
+    myConfig.stats = alpsdoocslib.AcquisitionStats(reporter=consoleReport)
     if oversizeCheck(myConfig.filesize):   
         if overwriteCheck(myConfig.path):
             print(f'Saving some data! filename: {myConfig.path}')
@@ -134,16 +161,44 @@ def SaveButtonClick():
             channels = ['ALPS.DIAG/ALPS.ADC.'+s for s in myConfig.daqchannels] ### generates channels names in the format desired by get_doocs_data
             start = myConfig.input_start  ### generates start time in the format desired by get_doocs_data
             stop = myConfig.input_stop    ### generates stop time in the format desired by get_doocs_data
-#            [ch1data,ch2data,ch3data,ch4data,stats] = alpsdoocslib.get_doocs_data(channels=channels,start=start,stop=stop)
+#            [ch1data,ch2data,ch3data,ch4data,stats] = alpsdoocslib.get_doocs_data(chans=channels,start=start,stop=stop,stats=myConfig.stats)
             datas=[ch1data,ch2data,ch3data,ch4data]   ### combines all data from all channels in single list-of-lists 
             datas=[x for x in datas if len(x)>0]      ### strips away all empty data channels
+
+            ### flags clipping, flat lines and DC jumps on the raw data and keeps its amplitude
+            ### histograms and quantiles, summarized in the console
+            quality = alpsdoocslib.QualityFlags(myConfig.daqchannels[:len(datas)])
+            amplitude = alpsdoocslib.AmplitudeStats(myConfig.daqchannels[:len(datas)],myConfig.channelcomments[:len(datas)],
+                                                    scales=myConfig.scales[:len(datas)])
+            with myConfig.stats.stage('summarize'):
+                for name,data in zip(quality.names,datas):
+                    signed = alpsdoocslib.convert_to_signed(data)
+                    quality.append(name,None,myConfig.start_datetime.timestamp(),signed)
+                    amplitude.append(name,None,myConfig.start_datetime.timestamp(),signed)
+            for line in quality.summary() + amplitude.summary():
+                consoleReport(line)
+            metadata = dict(quality.metadata(),**amplitude.metadata())
+
+            ### hands the raw pull to alpsdoocs_analyze.py through shared memory
+            if shareVar.get():
+                shareRecording(datas)
             
             
-            ### Calls to the decimate_data function in alpsdoocslib which applies
-            ### a decimation algorithm to reduce the data length
-            if myConfig.decimation != "16kHz":
-                for datas in datas:
-                    datas = alpsdoocslib.decimate_data(datas, int(myConfig.decimationFactor))
+            ### with a second output both are made from the same raw channels in one
+            ### fan_out pass, sharing the arrays instead of pulling from DAQ twice
+            alsoDatas = None
+            if myConfig.alsoFiletype != "None" and overwriteCheck(myConfig.alsoPath):
+                with myConfig.stats.stage('decimate'):
+                    datas, alsoDatas = alpsdoocslib.fan_out(datas,
+                                            [{'rate':myConfig.fs,'dtype':myConfig.dtype},
+                                             {'rate':myConfig.alsoFs,'dtype':myConfig.dtype}])
+
+            ### Calls to the resample_data function in alpsdoocslib which decimates
+            ### (or resamples, for rates that do not divide 16 kHz) the data, one channel per core
+            elif myConfig.fs != 16000:
+                with myConfig.stats.stage('decimate'):
+                    datas = alpsdoocslib.map_channels(alpsdoocslib.resample_data, datas,
+                                                      fs_in=16000,fs_out=myConfig.fs,dtype=myConfig.dtype)
 
                                                 
             if myConfig.filetype == ".csv":
@@ -154,14 +209,45 @@ def SaveButtonClick():
 
                 channels=myConfig.daqchannels
                 labels=myConfig.channelcomments
-                fs=decimationVal[decimation.get()]
+                fs=myConfig.fs
                 path=myConfig.path
                 events=10
-                alpsdoocslib.save_to_mat(datas=datas,labels=labels,channels=channels,fs=fs,path=path,events=events)
+                with myConfig.stats.stage('write'):
+                    alpsdoocslib.save_to_mat(datas=datas,labels=labels,channels=channels,fs=fs,path=path,events=events,dtype=myConfig.dtype,scales=myConfig.scales,
+                                             metadata=dict(metadata,**alpsdoocslib.resample_metadata(16000,fs)))
+            if alsoDatas is not None:
+                print(f'Also saving data to {myConfig.alsoPath}')
+                with myConfig.stats.stage('write'):
+                    if myConfig.alsoFiletype == ".csv":
+                        alpsdoocslib.save_channels_to_csv(alsoDatas,myConfig.alsoPath)
+                    else:
+                        alpsdoocslib.save_to_mat(datas=alsoDatas,labels=myConfig.channelcomments,channels=myConfig.daqchannels,
+                                                 fs=myConfig.alsoFs,path=myConfig.alsoPath,events=10,dtype=myConfig.dtype,scales=myConfig.scales,
+                                                 metadata=dict(metadata,**alpsdoocslib.resample_metadata(16000,myConfig.alsoFs)))
+    myConfig.stats.report(force=True)
     saveConfigFile()
     saveFileButton.config(state=DISABLED)
 
 
+######################### shareRecording() ####################################
+### publishes the raw channels on the shared-memory bus under the file name, so
+### the analyzer can plot them right away without reading the file back. The
+### previous shared pull of this window is released first.
+def shareRecording(datas):
+    global myConfig
+    if getattr(myConfig,'shared',None) is not None:
+        myConfig.shared.release()
+        myConfig.shared = None
+    recording = alpsdoocslib.Recording.from_channels([np.ravel(alpsdoocslib.convert_to_signed(d)) for d in datas],
+                                                     myConfig.daqchannels[:len(datas)],myConfig.channelcomments[:len(datas)],
+                                                     t0=myConfig.start_datetime.timestamp())
+    try:
+        myConfig.shared = alpsdoocslib.publish_recording(recording,myConfig.filename)
+        consoleReport(f"Shared as '{myConfig.filename}' for the analyzer")
+    except FileExistsError as e:
+        consoleReport(f"Not shared: {e}")
+
+
 ######################### saveConfigFile() ####################################
 ### saves a text file containing the configuration settings and user comments
 def saveConfigFile():
@@ -170,217 +256,304 @@ def saveConfigFile():
         f.write(myConfig.configSummary)
         f.write("\n\nUser Comments: \n  ")
         f.write(myConfig.usercomment)
+    myConfig.stats.save_json(myConfig.dirpath+myConfig.filename+'_stats.json')
     print('Saving configuration text file!')
 
-########################################################################
-########################################################################
-########################################################################
-
-### entry field labels
-channelsLabel = Label(root,text="Select channels ")
-channel1Label = Label(root,text="Channel 1:")
-channel2Label = Label(root,text="Channel 2:")
-channel3Label = Label(root,text="Channel 3:")
-channel4Label = Label(root,text="Channel 4:")
-filetypeLabel = Label(root,text="Filetype: ")
-directoryLabel = Label(root,text="Save Directory: ")
-filenameLabel = Label(root,text="Filename: ")
-startdateLabel = Label(root,text="Data start date: ")
-starttimeLabel = Label(root,text="Data start time: ")
-durationLabel = Label(root,text="Duration: ")
-daysLabel = Label(root,text="Days:")
-hoursLabel = Label(root,text="Hours:")
-minutesLabel = Label(root,text="Minutes:")
-secondsLabel = Label(root,text="Seconds:")
-usercommentsLabel = Label(root,text="Enter additional user comments about this measurement/data. \nThese additional comments will be saved as a .txt file in the destination directory.")
-
-### Channel selection dropdown menus
-channel_options = [
-        'None',
-        'NR/CH_1.00',
-        'NR/CH_1.01',
-        'NR/CH_1.02',
-        'NR/CH_1.03',
-        'NR/CH_1.04',
-        'NR/CH_1.05',
-        'NR/CH_1.06',
-        'NR/CH_1.07',
-        'NL/CH_1.00',
-        'NL/CH_1.01',
-        'HN/CH_1.00',
-        ]
-channel1select = StringVar()
-channel2select = StringVar()
-channel3select = StringVar()
-channel4select = StringVar()
-channel1_drop = OptionMenu(root, channel1select, channel_options[0], *channel_options)
-channel2_drop = OptionMenu(root, channel2select, channel_options[0], *channel_options)
-channel3_drop = OptionMenu(root, channel3select, channel_options[0], *channel_options)
-channel4_drop = OptionMenu(root, channel4select, channel_options[0], *channel_options)
-
-
-### filetype dropdown menu
-filetype = StringVar()
-filetype.set(".mat")
-filetype_options = [
-        ".mat",
-        ".csv"
-        ] 
-filetype_drop = OptionMenu(root, filetype, filetype_options[0], *filetype_options)
-###
-
-########### destination directory entry field #################################
-directory = Entry(root,width=50,justify='right')
-directory.insert(0,os.getcwd())
-directory.xview_moveto(1)
-###
-
-########### channel user comments #############################################
-channel1Comment = Entry(root,width=10)
-channel1Comment.insert(0,"")
-channel2Comment = Entry(root,width=10)
-channel2Comment.insert(0,"")
-channel3Comment = Entry(root,width=10)
-channel3Comment.insert(0,"")
-channel4Comment = Entry(root,width=10)
-channel4Comment.insert(0,"")
-###
-
-############### file name entry field #########################################
-filename = Entry(root,width=50)
-filename.insert(0,"default_filename")
-### 
-
-### start date entry field
-startdate = Entry(root,width=50)
-startdate.insert(0,datetime.today().strftime('%Y-%m-%d'))
-### 
-
-### start time entry field
-starttime = Entry(root,width=50)
-starttime.insert(0,datetime.today().strftime('%H:%M:%S'))
-### 
-
-### duration days entry field
-duration_d = Entry(root,width=10)
-duration_d.insert(0,0)
-
-### duration hours entry field
-duration_h = Entry(root,width=10)
-duration_h.insert(0,0)
-
-### duration minutes entry field
-duration_m = Entry(root,width=10)
-duration_m.insert(0,0)
-
-### duration seconds entry field
-duration_s = Entry(root,width=10)
-duration_s.insert(0,10)
-
-mytimedelta=timedelta(days=int(duration_d.get()),hours=int(duration_h.get()),minutes=int(duration_m.get()),seconds=int(duration_s.get()))
-mystarttime=datetime.strptime(startdate.get()+starttime.get(), "%Y-%m-%d%H:%M:%S")
-
-myFileLabel = Label(root,text=filename.get()+filetype.get())
-myStartDateLabel = Label(root,text=mystarttime)
-myTimeDeltaLabel = Label(root,text=mytimedelta)
-myEndDateLabel = Label(root,text=mystarttime+mytimedelta)
-
-myDecimationLabel = Label(root,text="Downsample to:")
-### filetype dropdown menu
-decimation=StringVar()
-decimationVal = {
-        "16kHz": 16000,
-        "16kHz": 16000,
-        "8kHz": 8000,
-        "4kHz": 4000,
-        "2kHz": 2000,
-        "1kHz": 1000,
-        "500Hz": 500,
-        "100Hz": 100,
-        "64Hz": 64,
-        "32Hz": 32
-        }
-decimation_drop = OptionMenu(root, decimation, list(decimationVal.keys())[0], *list(decimationVal.keys()))
-###
-##
-
-
-
-
-#input_stop = 
-#input_duration = 
-
-updateConfigButton = Button(root, text="Update Save Configuration", command=UpdateConfig)
-saveFileButton = Button(root, text="Save File",command=SaveButtonClick, state = DISABLED)
-
-### Labels
-filetypeLabel.grid(row=0,column=0,sticky=W,pady=2)
-directoryLabel.grid(row=1,column=0,sticky=W,pady=2)
-filenameLabel.grid(row=2,column=0,sticky=W,pady=2)
-startdateLabel.grid(row=3,column=0,sticky=W,pady=2)
-starttimeLabel.grid(row=4,column=0,sticky=W,pady=2)
-durationLabel.grid(row=5,column=0,sticky=W,pady=2)
-daysLabel.grid(row=5,column=1,sticky=W,pady=2)
-hoursLabel.grid(row=5,column=2,sticky=W,pady=2)
-minutesLabel.grid(row=5,column=3,sticky=W,pady=2)
-secondsLabel.grid(row=5,column=4,sticky=W,pady=2)
-
-### Entry fields
-filetype_drop.grid(row=0,column=1,sticky=W,pady=2)
-directory.grid(row=1,column=1,sticky=W,pady=2,columnspan=4)
-filename.grid(row=2,column=1,sticky=W,pady=2,columnspan=4)
-startdate.grid(row=3,column=1,sticky=W,pady=2,columnspan=4)
-starttime.grid(row=4,column=1,sticky=W,pady=2,columnspan=4)
-duration_d.grid(row=6,column=1,sticky=W,pady=2)
-duration_h.grid(row=6,column=2,sticky=W,pady=2)
-duration_m.grid(row=6,column=3,sticky=W,pady=2)
-duration_s.grid(row=6,column=4,sticky=W,pady=2)
-
-### Buttons
-updateConfigButton.grid(row=27,column=1,sticky=W,pady=2,columnspan=3)
-saveFileButton.grid(row=80,column=1,sticky=W,pady=2)
-
-### Channels info
-channelsLabel.grid(row=14,column=0,sticky=W,pady=2,columnspan=1)
-channel1Label.grid(row=15,column=1,sticky=W,pady=2,columnspan=1)
-channel2Label.grid(row=15,column=2,sticky=W,pady=2,columnspan=1)
-channel3Label.grid(row=15,column=3,sticky=W,pady=2,columnspan=1)
-channel4Label.grid(row=15,column=4,sticky=W,pady=2,columnspan=1)
-
-### Channel drops
-channel1_drop.grid(row=16,column=1,sticky=W,pady=2,columnspan=1)
-channel2_drop.grid(row=16,column=2,sticky=W,pady=2,columnspan=1)
-channel3_drop.grid(row=16,column=3,sticky=W,pady=2,columnspan=1)
-channel4_drop.grid(row=16,column=4,sticky=W,pady=2,columnspan=1)
-
-### Channel comments
-channelComments = Label(root,text="Channel label: ").grid(row=17,column=0,sticky=W,pady=2)
-
-channel1Comment.grid(row=17,column=1,sticky=W,pady=2,columnspan=1)
-channel2Comment.grid(row=17,column=2,sticky=W,pady=2,columnspan=1)
-channel3Comment.grid(row=17,column=3,sticky=W,pady=2,columnspan=1)
-channel4Comment.grid(row=17,column=4,sticky=W,pady=2,columnspan=1)
-
-### Decimation
-myDecimationLabel.grid(row=18,column=0,sticky=W,pady=2,columnspan=1)
-decimation_drop.grid(row=18,column=1,sticky=W,pady=2,columnspan=1)
-
-### user comments space
-usercommentsLabel.grid(row=47,column=0,sticky=W,pady=2,columnspan=5)
-usercommentFrame = Frame(root)
-usercommentFrame.grid(row=48,column=0,sticky=W,pady=2,columnspan=5)
-
-usercommentBox = Text(usercommentFrame,wrap=WORD,height=5)
-usercommentBox.grid(row=49,column=0)
-usercommentBox.config(state=NORMAL)
-
-### configuration logging space
-consoleFrame = Frame(root)
-consoleFrame.grid(row=50,column=0,sticky=W,pady=2,columnspan=5)
-
-consoleBox = scrolledtext.ScrolledText(consoleFrame,wrap=WORD)
-consoleBox.grid(row=51,column=0)
-consoleBox.config(state=DISABLED)
-
-root.mainloop()
 
+######################### consoleReport() #####################################
+### reporter for AcquisitionStats: appends the rate-limited progress line to the
+### console box and lets Tk redraw while the pull is running
+def consoleReport(line):
+    consoleBox.config(state=NORMAL)
+    consoleBox.insert(END,"\n   "+line)
+    consoleBox.see(END)
+    consoleBox.config(state=DISABLED)
+    root.update_idletasks()
+
+
+############################ build_window() ###################################
+### Builds the whole Tk window. Kept out of import time, so the functions of
+### this module can be imported without a display and the window only costs
+### when the tool is started; the widgets the callbacks use stay module globals.
+###############################################################################
+def build_window():
+    global root, channel1select, channel2select, channel3select, channel4select, filetype, directory
+    global channel1Comment, channel2Comment, channel3Comment, channel4Comment, filename, startdate
+    global channel1Scale, channel2Scale, channel3Scale, channel4Scale
+    global starttime, duration_d, duration_h, duration_m, duration_s, decimation, decimationVal
+    global precision, precisionVal, alsoFiletype, alsoDecimation, saveFileButton, shareVar
+    global usercommentBox, consoleBox
+    root = Tk()
+    root.title('ALPS DOOCS Save Data')
+    #root.geometry("400x600")
+
+    ########################################################################
+    ########################################################################
+    ########################################################################
+
+    ### entry field labels
+    channelsLabel = Label(root,text="Select channels ")
+    channel1Label = Label(root,text="Channel 1:")
+    channel2Label = Label(root,text="Channel 2:")
+    channel3Label = Label(root,text="Channel 3:")
+    channel4Label = Label(root,text="Channel 4:")
+    filetypeLabel = Label(root,text="Filetype: ")
+    directoryLabel = Label(root,text="Save Directory: ")
+    filenameLabel = Label(root,text="Filename: ")
+    startdateLabel = Label(root,text="Data start date: ")
+    starttimeLabel = Label(root,text="Data start time: ")
+    durationLabel = Label(root,text="Duration: ")
+    daysLabel = Label(root,text="Days:")
+    hoursLabel = Label(root,text="Hours:")
+    minutesLabel = Label(root,text="Minutes:")
+    secondsLabel = Label(root,text="Seconds:")
+    usercommentsLabel = Label(root,text="Enter additional user comments about this measurement/data. \nThese additional comments will be saved as a .txt file in the destination directory.")
+
+    ### Channel selection dropdown menus
+    channel_options = [
+            'None',
+            'NR/CH_1.00',
+            'NR/CH_1.01',
+            'NR/CH_1.02',
+            'NR/CH_1.03',
+            'NR/CH_1.04',
+            'NR/CH_1.05',
+            'NR/CH_1.06',
+            'NR/CH_1.07',
+            'NL/CH_1.00',
+            'NL/CH_1.01',
+            'HN/CH_1.00',
+            ]
+    channel1select = StringVar()
+    channel2select = StringVar()
+    channel3select = StringVar()
+    channel4select = StringVar()
+    channel1_drop = OptionMenu(root, channel1select, channel_options[0], *channel_options)
+    channel2_drop = OptionMenu(root, channel2select, channel_options[0], *channel_options)
+    channel3_drop = OptionMenu(root, channel3select, channel_options[0], *channel_options)
+    channel4_drop = OptionMenu(root, channel4select, channel_options[0], *channel_options)
+
+
+    ### filetype dropdown menu
+    filetype = StringVar()
+    filetype.set(".mat")
+    filetype_options = [
+            ".mat",
+            ".csv"
+            ] 
+    filetype_drop = OptionMenu(root, filetype, filetype_options[0], *filetype_options)
+    ###
+
+    ########### destination directory entry field #################################
+    directory = Entry(root,width=50,justify='right')
+    directory.insert(0,os.getcwd())
+    directory.xview_moveto(1)
+    ###
+
+    ########### channel user comments #############################################
+    channel1Comment = Entry(root,width=10)
+    channel1Comment.insert(0,"")
+    channel2Comment = Entry(root,width=10)
+    channel2Comment.insert(0,"")
+    channel3Comment = Entry(root,width=10)
+    channel3Comment.insert(0,"")
+    channel4Comment = Entry(root,width=10)
+    channel4Comment.insert(0,"")
+    ###
+
+    ########### channel calibration a, b (saved value = a*x + b) ##################
+    channel1Scale = Entry(root,width=10)
+    channel1Scale.insert(0,"1, 0")
+    channel2Scale = Entry(root,width=10)
+    channel2Scale.insert(0,"1, 0")
+    channel3Scale = Entry(root,width=10)
+    channel3Scale.insert(0,"1, 0")
+    channel4Scale = Entry(root,width=10)
+    channel4Scale.insert(0,"1, 0")
+    ###
+
+    ############### file name entry field #########################################
+    filename = Entry(root,width=50)
+    filename.insert(0,"default_filename")
+    ### 
+
+    ### start date entry field
+    startdate = Entry(root,width=50)
+    startdate.insert(0,datetime.today().strftime('%Y-%m-%d'))
+    ### 
+
+    ### start time entry field
+    starttime = Entry(root,width=50)
+    starttime.insert(0,datetime.today().strftime('%H:%M:%S'))
+    ### 
+
+    ### duration days entry field
+    duration_d = Entry(root,width=10)
+    duration_d.insert(0,0)
+
+    ### duration hours entry field
+    duration_h = Entry(root,width=10)
+    duration_h.insert(0,0)
+
+    ### duration minutes entry field
+    duration_m = Entry(root,width=10)
+    duration_m.insert(0,0)
+
+    ### duration seconds entry field
+    duration_s = Entry(root,width=10)
+    duration_s.insert(0,10)
+
+    mytimedelta=timedelta(days=int(duration_d.get()),hours=int(duration_h.get()),minutes=int(duration_m.get()),seconds=int(duration_s.get()))
+    mystarttime=datetime.strptime(startdate.get()+starttime.get(), "%Y-%m-%d%H:%M:%S")
+
+    myFileLabel = Label(root,text=filename.get()+filetype.get())
+    myStartDateLabel = Label(root,text=mystarttime)
+    myTimeDeltaLabel = Label(root,text=mytimedelta)
+    myEndDateLabel = Label(root,text=mystarttime+mytimedelta)
+
+    myDecimationLabel = Label(root,text="Downsample to:")
+    ### sampling rate: pick one of the list or type any other, e.g. 250Hz or 2048Hz
+    decimation=StringVar()
+    decimationVal = {
+            "16kHz": 16000,
+            "16kHz": 16000,
+            "8kHz": 8000,
+            "4kHz": 4000,
+            "2kHz": 2000,
+            "1kHz": 1000,
+            "500Hz": 500,
+            "100Hz": 100,
+            "64Hz": 64,
+            "32Hz": 32
+            }
+    decimation_drop = Combobox(root, textvariable=decimation, values=list(decimationVal.keys()), width=8)
+    decimation.set(list(decimationVal.keys())[0])
+    ###
+
+    myPrecisionLabel = Label(root,text="Precision:")
+    ### processing/output precision dropdown menu
+    precision=StringVar()
+    precisionVal = {
+            "float64 (double)": "float64",
+            "float32 (single)": "float32"
+            }
+    precision_drop = OptionMenu(root, precision, list(precisionVal.keys())[0], *list(precisionVal.keys()))
+    ###
+
+    myAlsoLabel = Label(root,text="Also save as:")
+    ### second output written from the same pull, e.g. a 1 kHz csv next to the raw .mat
+    alsoFiletype=StringVar()
+    alsoFiletype_drop = OptionMenu(root, alsoFiletype, "None", "None", ".mat", ".csv")
+    alsoDecimation=StringVar()
+    alsoDecimation_drop = Combobox(root, textvariable=alsoDecimation, values=list(decimationVal.keys()), width=8)
+    alsoDecimation.set("1kHz")
+    ##
+
+
+
+
+    #input_stop = 
+    #input_duration = 
+
+    updateConfigButton = Button(root, text="Update Save Configuration", command=UpdateConfig)
+    saveFileButton = Button(root, text="Save File",command=SaveButtonClick, state = DISABLED)
+
+    ### Labels
+    filetypeLabel.grid(row=0,column=0,sticky=W,pady=2)
+    directoryLabel.grid(row=1,column=0,sticky=W,pady=2)
+    filenameLabel.grid(row=2,column=0,sticky=W,pady=2)
+    startdateLabel.grid(row=3,column=0,sticky=W,pady=2)
+    starttimeLabel.grid(row=4,column=0,sticky=W,pady=2)
+    durationLabel.grid(row=5,column=0,sticky=W,pady=2)
+    daysLabel.grid(row=5,column=1,sticky=W,pady=2)
+    hoursLabel.grid(row=5,column=2,sticky=W,pady=2)
+    minutesLabel.grid(row=5,column=3,sticky=W,pady=2)
+    secondsLabel.grid(row=5,column=4,sticky=W,pady=2)
+
+    ### Entry fields
+    filetype_drop.grid(row=0,column=1,sticky=W,pady=2)
+    directory.grid(row=1,column=1,sticky=W,pady=2,columnspan=4)
+    filename.grid(row=2,column=1,sticky=W,pady=2,columnspan=4)
+    startdate.grid(row=3,column=1,sticky=W,pady=2,columnspan=4)
+    starttime.grid(row=4,column=1,sticky=W,pady=2,columnspan=4)
+    duration_d.grid(row=6,column=1,sticky=W,pady=2)
+    duration_h.grid(row=6,column=2,sticky=W,pady=2)
+    duration_m.grid(row=6,column=3,sticky=W,pady=2)
+    duration_s.grid(row=6,column=4,sticky=W,pady=2)
+
+    ### Buttons
+    updateConfigButton.grid(row=27,column=1,sticky=W,pady=2,columnspan=3)
+    saveFileButton.grid(row=80,column=1,sticky=W,pady=2)
+
+    ### Channels info
+    channelsLabel.grid(row=14,column=0,sticky=W,pady=2,columnspan=1)
+    channel1Label.grid(row=15,column=1,sticky=W,pady=2,columnspan=1)
+    channel2Label.grid(row=15,column=2,sticky=W,pady=2,columnspan=1)
+    channel3Label.grid(row=15,column=3,sticky=W,pady=2,columnspan=1)
+    channel4Label.grid(row=15,column=4,sticky=W,pady=2,columnspan=1)
+
+    ### Channel drops
+    channel1_drop.grid(row=16,column=1,sticky=W,pady=2,columnspan=1)
+    channel2_drop.grid(row=16,column=2,sticky=W,pady=2,columnspan=1)
+    channel3_drop.grid(row=16,column=3,sticky=W,pady=2,columnspan=1)
+    channel4_drop.grid(row=16,column=4,sticky=W,pady=2,columnspan=1)
+
+    ### Channel comments
+    channelComments = Label(root,text="Channel label: ").grid(row=17,column=0,sticky=W,pady=2)
+
+    channel1Comment.grid(row=17,column=1,sticky=W,pady=2,columnspan=1)
+    channel2Comment.grid(row=17,column=2,sticky=W,pady=2,columnspan=1)
+    channel3Comment.grid(row=17,column=3,sticky=W,pady=2,columnspan=1)
+    channel4Comment.grid(row=17,column=4,sticky=W,pady=2,columnspan=1)
+
+    ### Channel calibration
+    channelScales = Label(root,text="Calibration a, b: ").grid(row=21,column=0,sticky=W,pady=2)
+
+    channel1Scale.grid(row=21,column=1,sticky=W,pady=2,columnspan=1)
+    channel2Scale.grid(row=21,column=2,sticky=W,pady=2,columnspan=1)
+    channel3Scale.grid(row=21,column=3,sticky=W,pady=2,columnspan=1)
+    channel4Scale.grid(row=21,column=4,sticky=W,pady=2,columnspan=1)
+
+    ### Decimation
+    myDecimationLabel.grid(row=18,column=0,sticky=W,pady=2,columnspan=1)
+    decimation_drop.grid(row=18,column=1,sticky=W,pady=2,columnspan=1)
+    myPrecisionLabel.grid(row=18,column=2,sticky=W,pady=2,columnspan=1)
+    precision_drop.grid(row=18,column=3,sticky=W,pady=2,columnspan=2)
+    myAlsoLabel.grid(row=20,column=0,sticky=W,pady=2,columnspan=1)
+    alsoFiletype_drop.grid(row=20,column=1,sticky=W,pady=2,columnspan=1)
+    alsoDecimation_drop.grid(row=20,column=2,sticky=W,pady=2,columnspan=1)
+
+    ### shared-memory handoff to the analyzer
+    shareVar = BooleanVar(value=False)
+    shareCheck = Checkbutton(root,text="Share with analyzer (shared memory, by file name)",variable=shareVar)
+    shareCheck.grid(row=19,column=1,sticky=W,pady=2,columnspan=4)
+
+    ### user comments space
+    usercommentsLabel.grid(row=47,column=0,sticky=W,pady=2,columnspan=5)
+    usercommentFrame = Frame(root)
+    usercommentFrame.grid(row=48,column=0,sticky=W,pady=2,columnspan=5)
+
+    usercommentBox = Text(usercommentFrame,wrap=WORD,height=5)
+    usercommentBox.grid(row=49,column=0)
+    usercommentBox.config(state=NORMAL)
+
+    ### configuration logging space
+    consoleFrame = Frame(root)
+    consoleFrame.grid(row=50,column=0,sticky=W,pady=2,columnspan=5)
+
+    consoleBox = scrolledtext.ScrolledText(consoleFrame,wrap=WORD)
+    consoleBox.grid(row=51,column=0)
+    consoleBox.config(state=DISABLED)
+    return root
+
+
+############################### main() ########################################
+def main():
+    build_window()
+    root.mainloop()
+    if getattr(myConfig,'shared',None) is not None:
+        myConfig.shared.release()
+
+
+if __name__ == "__main__":
+    main()
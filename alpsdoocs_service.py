@@ -0,0 +1,346 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Local multi-user data service for the ALPS DOOCS DAQ.
+
+One daemon owns the DAQ sessions and a cache of recently pulled intervals, and
+clients on the same machine ask it for (channels, start, stop) over a Unix
+socket (or localhost TCP with --port):
+
+    python alpsdoocs_service.py --max-sessions 2 --cache-mb 2048 &
+
+    from alpsdoocs_service import iter_service_data
+    for daqname, macropulse, timestamp, data in iter_service_data(chans, start, stop):
+        ...
+
+iter_service_data yields the same blocks as alpsdoocslib.iter_doocs_data. A
+request is split per channel into the stretches already cached or being pulled
+for someone else (those are shared, not fetched again) and the missing ones,
+which start new upstream pulls. At most --max-sessions upstream pulls run at
+once; the others queue. Every client gets its blocks streamed as they arrive.
+
+With --fake the service serves example_data.FakeDAQ instead of pydaq, for
+testing without a DAQ server.
+"""
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import queue as queues
+import socket
+import sys
+import tempfile
+import threading
+import time
+
+import numpy as np
+
+import alpsdoocslib
+
+SOCKET = os.path.join(tempfile.gettempdir(), 'alpsdoocs_service.sock')
+
+
+################################# _Fetch ######################################
+### One upstream pull of `chans` over [start, stop) (whole unix seconds). Its
+### blocks are kept per channel in arrival (time) order, both while it runs,
+### for the clients streaming from it, and afterwards as cache.
+###############################################################################
+class _Fetch(object):
+    def __init__(self, chans, start, stop):
+        self.chans = list(chans)
+        self.start = start
+        self.stop = stop
+        self.blocks = {c: [] for c in self.chans}
+        self.nbytes = 0
+        self.readers = 0
+        self.used = time.monotonic()
+        self.done = False
+        self.completed = False
+        self.range = 'pending'
+        self.error = None
+        self.changed = asyncio.Condition()
+
+    async def add(self, daqname, macropulse, timestamp, data):
+        if daqname in self.blocks:
+            self.blocks[daqname].append((macropulse, timestamp, data))
+            self.nbytes += data.nbytes
+            async with self.changed:
+                self.changed.notify_all()
+
+    async def finish(self, completed=False, describe='', error=None):
+        self.done = True
+        self.completed = completed
+        self.range = describe
+        self.error = error
+        async with self.changed:
+            self.changed.notify_all()
+
+    def covers(self, channel, t):
+        return self.error is None and channel in self.blocks and self.start <= t < self.stop
+
+
+### upstream pull run in its own process, since pydaq keeps one connection per process
+def _upstream_process(chans, start, stop, daq, server, backend, queue):
+    scheduler = alpsdoocslib.PollScheduler(alpsdoocslib.daq_timestamp(stop))
+    try:
+        for block in alpsdoocslib.iter_doocs_data(chans, start, stop, daq, server, scheduler=scheduler, backend=backend):
+            queue.put(block)
+        queue.put((None, scheduler.completed, scheduler.describe(), None))
+    except Exception as e:
+        queue.put((None, False, '', f"{type(e).__name__}: {e}"))
+
+
+### in the DAQ's time zone, like the stop time the upstream scheduler is given
+def _timestring(t):
+    return alpsdoocslib.daq_timestring(t)
+
+
+############################### DataService ###################################
+### The daemon. backend_factory() makes the backend of one upstream session
+### (None: pydaq); with processes=True (the default) each session runs in a
+### spawned process, so the backend must be picklable. Finished pulls stay
+### cached until their blocks exceed cache_mb; the least recently requested
+### ones are dropped first. An upstream process that dies without a result
+### (or stops sending for `upstream_timeout` seconds while dead) ends its
+### pull with an error for every client streaming from it.
+###############################################################################
+class DataService(object):
+    def __init__(self, backend_factory=None, max_sessions=2, cache_mb=1024, processes=True,
+                 upstream_timeout=1.0, daq="/daq_data/alps", server="TTF2.DAQ/DAQ.SERVER5/DAQ.DATA.SVR/", log=print):
+        self.backend_factory = backend_factory
+        self.max_sessions = max_sessions
+        self.cache_mb = cache_mb
+        self.processes = processes
+        self.upstream_timeout = upstream_timeout
+        self.daq = daq
+        self.server = server
+        self.log = log
+        self.fetches = []
+        self.counts = {'requests': 0, 'upstream_sessions': 0, 'shared_segments': 0, 'blocks_sent': 0}
+        self._sessions = None
+
+    ### splits [start, stop) of every channel into segments [a, b, fetch], reusing
+    ### cached and in-flight pulls and starting new ones for the missing stretches
+    def plan(self, chans, start, stop):
+        plans, missing = {}, {}
+        for c in chans:
+            segments, t = [], start
+            while t < stop:
+                fetch = next((f for f in reversed(self.fetches) if f.covers(c, t)), None)
+                if fetch is not None:
+                    end = min(fetch.stop, stop)
+                    self.counts['shared_segments'] += 1
+                else:
+                    end = min([f.start for f in self.fetches if f.error is None and c in f.blocks and t < f.start < stop] + [stop])
+                    missing.setdefault((t, end), []).append(c)
+                segments.append([t, end, fetch])
+                t = end
+            plans[c] = segments
+        for (a, b), group in missing.items():
+            fetch = _Fetch(group, a, b)
+            self.fetches.append(fetch)
+            asyncio.ensure_future(self._run_upstream(fetch))
+            for c in group:
+                for segment in plans[c]:
+                    if segment[0] == a and segment[2] is None:
+                        segment[2] = fetch
+        return plans
+
+    async def _upstream_blocks(self, fetch):
+        start, stop = _timestring(fetch.start), _timestring(fetch.stop)
+        backend = self.backend_factory() if self.backend_factory is not None else None
+        if not self.processes:
+            scheduler = alpsdoocslib.PollScheduler(fetch.stop)
+            async for block in alpsdoocslib.aiter_doocs_data(fetch.chans, start, stop, self.daq, self.server,
+                                                             scheduler=scheduler, backend=backend):
+                yield block
+            yield (None, scheduler.completed, scheduler.describe(), None)
+            return
+        queue = multiprocessing.get_context('spawn').Queue()
+        process = multiprocessing.get_context('spawn').Process(
+            target=_upstream_process, args=(fetch.chans, start, stop, self.daq, self.server, backend, queue), daemon=True)
+        process.start()
+        try:
+            while True:
+                try:
+                    block = await asyncio.to_thread(queue.get, timeout=self.upstream_timeout)
+                except queues.Empty:
+                    if not process.is_alive():
+                        raise alpsdoocslib.DAQError(f"upstream process exited with code {process.exitcode} without a result")
+                    continue
+                yield block
+                if block[0] is None:
+                    return
+        finally:
+            process.join(timeout=5)
+
+    async def _run_upstream(self, fetch):
+        async with self._sessions:
+            self.counts['upstream_sessions'] += 1
+            self.log(f"upstream {len(fetch.chans)} channels {_timestring(fetch.start)} - {_timestring(fetch.stop)}")
+            try:
+                async for block in self._upstream_blocks(fetch):
+                    if block[0] is None:
+                        await fetch.finish(*block[1:])
+                    else:
+                        await fetch.add(*block)
+            except Exception as e:
+                await fetch.finish(error=f"{type(e).__name__}: {e}")
+            if not fetch.done:
+                await fetch.finish(error='upstream session ended without a result')
+        if fetch.error is not None:
+            self.log(f"upstream failed: {fetch.error}")
+            self.fetches.remove(fetch)
+        self._evict()
+
+    def _evict(self):
+        total = sum(f.nbytes for f in self.fetches)
+        for fetch in sorted(self.fetches, key=lambda f: f.used):
+            if total <= self.cache_mb*1e6:
+                break
+            if fetch.done and fetch.readers == 0:
+                self.fetches.remove(fetch)
+                total -= fetch.nbytes
+
+    ### streams one channel segment by segment, in time order, to send()
+    async def _stream_channel(self, c, segments, send):
+        completed, ranges = True, []
+        for a, b, fetch in segments:
+            i = 0
+            while True:
+                blocks = fetch.blocks[c]
+                if i >= len(blocks) and not fetch.done:
+                    async with fetch.changed:
+                        await fetch.changed.wait_for(lambda: len(fetch.blocks[c]) > i or fetch.done)
+                    continue
+                new, i = blocks[i:], len(blocks)
+                for macropulse, timestamp, data in new:
+                    if a <= timestamp < b:
+                        await send(c, macropulse, timestamp, data)
+                if fetch.done and i >= len(fetch.blocks[c]):
+                    break
+            if fetch.error is not None:
+                raise alpsdoocslib.DAQError(fetch.error)
+            if not fetch.completed:
+                completed = False
+                ranges.append(fetch.range)
+        return completed, ranges
+
+    async def stream(self, chans, start, stop, send):
+        self.counts['requests'] += 1
+        plans = self.plan(chans, start, stop)
+        fetches = {id(f): f for segments in plans.values() for a, b, f in segments}
+        for fetch in fetches.values():
+            fetch.readers += 1
+            fetch.used = time.monotonic()
+        try:
+            results = await asyncio.gather(*[self._stream_channel(c, plans[c], send) for c in chans])
+        finally:
+            for fetch in fetches.values():
+                fetch.readers -= 1
+            self._evict()
+        ranges = [r for completed, rs in results for r in rs]
+        return all(completed for completed, rs in results), "; ".join(dict.fromkeys(ranges)) or 'complete'
+
+    ### one client connection: a JSON request line in, frames out. Each block is
+    ### a JSON header line followed by its raw int16 samples; the last frame is
+    ### {"done": true, "completed": ..., "range": ...} or {"error": ...}
+    async def handle(self, reader, writer):
+        try:
+            request = json.loads(await reader.readline())
+            chans = list(request['channels'])
+            start = int(alpsdoocslib.daq_timestamp(request['start']))
+            stop = int(alpsdoocslib.daq_timestamp(request['stop']))
+
+            async def send(daqname, macropulse, timestamp, data):
+                header = {'daqname': daqname, 'macropulse': macropulse, 'timestamp': timestamp, 'samples': len(data)}
+                writer.write(json.dumps(header).encode() + b'\n' + np.asarray(data, dtype='<i2').tobytes())
+                self.counts['blocks_sent'] += 1
+                await writer.drain()
+
+            completed, describe = await self.stream(chans, start, stop, send)
+            writer.write(json.dumps({'done': True, 'completed': completed, 'range': describe}).encode() + b'\n')
+        except (ConnectionError, asyncio.IncompleteReadError):
+            return
+        except Exception as e:
+            writer.write(json.dumps({'error': f"{type(e).__name__}: {e}"}).encode() + b'\n')
+        try:
+            await writer.drain()
+            writer.close()
+        except ConnectionError:
+            pass
+
+    async def serve(self, path=SOCKET, port=None, ready=None):
+        self._sessions = asyncio.Semaphore(self.max_sessions)
+        if port is not None:
+            server = await asyncio.start_server(self.handle, '127.0.0.1', port)
+        else:
+            if os.path.exists(path):
+                os.remove(path)
+            server = await asyncio.start_unix_server(self.handle, path)
+        self.log(f"serving on {f'127.0.0.1:{port}' if port is not None else path}, at most {self.max_sessions} upstream sessions")
+        if ready is not None:
+            ready.set()
+        async with server:
+            await server.serve_forever()
+
+
+########################## iter_service_data ##################################
+### Client side: same blocks as alpsdoocslib.iter_doocs_data, pulled through
+### the service at `address` (a Unix socket path or a (host, port) pair). Pass
+### a dict as `status` to get {'completed', 'range'} of the request at the end.
+###############################################################################
+def iter_service_data(chans, start, stop, address=SOCKET, status=None):
+    family = socket.AF_INET if isinstance(address, tuple) else socket.AF_UNIX
+    with socket.socket(family, socket.SOCK_STREAM) as sock:
+        sock.connect(address)
+        sock.sendall(json.dumps({'channels': list(chans), 'start': start, 'stop': stop}).encode() + b'\n')
+        with sock.makefile('rb') as stream:
+            while True:
+                line = stream.readline()
+                if not line:
+                    raise alpsdoocslib.DAQError("connection to the data service closed unexpectedly")
+                header = json.loads(line)
+                if 'error' in header:
+                    raise alpsdoocslib.DAQError(header['error'])
+                if header.get('done'):
+                    if status is not None:
+                        status.update(completed=header['completed'], range=header['range'])
+                    return
+                data = np.frombuffer(stream.read(2*header['samples']), dtype='<i2').astype(np.int16)
+                yield header['daqname'], header['macropulse'], header['timestamp'], data
+
+
+### runs a DataService on a background thread (for tests and embedding) and
+### returns once it accepts connections
+def start_service_thread(service, path=SOCKET, port=None):
+    ready = threading.Event()
+    thread = threading.Thread(target=lambda: asyncio.run(service.serve(path, port, ready)), daemon=True)
+    thread.start()
+    ready.wait()
+    return thread
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Local data service sharing DAQ pulls between users.")
+    parser.add_argument('--socket', default=SOCKET, help=f"Unix socket to listen on (default {SOCKET})")
+    parser.add_argument('--port', type=int, help="listen on 127.0.0.1:PORT instead of a Unix socket")
+    parser.add_argument('--max-sessions', type=int, default=2, help="concurrent upstream DAQ sessions (default 2)")
+    parser.add_argument('--cache-mb', type=float, default=1024, help="MB of finished pulls kept for reuse (default 1024)")
+    parser.add_argument('--fake', action='store_true', help="serve example_data.FakeDAQ instead of pydaq")
+    args = parser.parse_args(argv)
+    backend_factory = None
+    if args.fake:
+        from example_data import FakeDAQ
+        backend_factory = FakeDAQ
+    service = DataService(backend_factory, max_sessions=args.max_sessions, cache_mb=args.cache_mb)
+    try:
+        asyncio.run(service.serve(args.socket, args.port))
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -8,12 +8,70 @@ Function library for ALPS - DOOCS python software
 @author: todd
 """
 import csv
-from scipy.io import savemat
-from scipy import signal
 import sys
+import os
+import time
+import json
+import shutil
+import tempfile
+import hashlib
+import bisect
+import struct
+import functools
+import re
+from fractions import Fraction
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from contextlib import contextmanager
+from datetime import datetime
 #import pydoocs
-#import pydaq
+try:
+    import pydaq
+except ImportError:     ### pydaq only exists on the DESY/NAF machines
+    pydaq = None
 import numpy as np
+### scipy, gwpy and asyncio are imported inside the functions that use them:
+### scipy.signal alone takes most of a second to import, and the GUIs, the batch
+### runner and the data service should start without paying for it
+
+
+### sampling rates offered for downsampling, shared by the GUIs and the batch runner;
+### any other rate can be given as well, see parse_rate
+decimationVal = {
+        "16kHz": 16000,
+        "8kHz": 8000,
+        "4kHz": 4000,
+        "2kHz": 2000,
+        "1kHz": 1000,
+        "500Hz": 500,
+        "100Hz": 100,
+        "64Hz": 64,
+        "32Hz": 32
+        }
+
+### default number of workers for per-channel post-processing (map_channels)
+processingWorkers = os.cpu_count() or 1
+
+### working float dtype of decimation, filtering, spectra and the writers.
+### float32 halves memory, cache traffic and file size and is plenty for 16 bit
+### ADC data; accumulations (Welch averaging) stay float64 regardless.
+floatDtype = np.float64
+
+def set_float_dtype(dtype):
+    global floatDtype
+    floatDtype = np.dtype(dtype).type
+
+### raised when the DAQ server refuses the connection request
+class DAQError(Exception):
+    """The DAQ server returned an error while connecting."""
+    pass
+
+### pydaq's own exception; without pydaq the connection can only fail with DAQError
+PyDaqException = getattr(pydaq, 'PyDaqException', DAQError)
+
+### raised when a pull ended before the requested stop time was reached
+class IncompleteRangeError(Exception):
+    """The DAQ stopped delivering data before the end of the requested range."""
+    pass
 
 ########################### save_to_csv #######################################
 ### This function
@@ -22,6 +80,15 @@ def save_to_csv(data,path):
     with open(path,'w') as f:
             writer = csv.writer(f)
             writer.writerow(data)
+
+
+###################### save_channels_to_csv ###################################
+### multi-channel version of save_to_csv, one row per channel
+###############################################################################
+def save_channels_to_csv(datas,path):
+    with open(path,'w',newline='') as f:
+        writer = csv.writer(f)
+        writer.writerows(datas)
      
         
 ########################### save_to_mat #######################################
@@ -32,25 +99,407 @@ def save_to_csv(data,path):
 ###  "channeln_label": label for each channel n
 ###  "channeln_channelname": the DAQ channel name for each channel n
 ###  "channeln_data": the full raw data for each channel n
+###  "channeln_scaleA", "channeln_scaleB": calibration a*x + b of channel n,
+###                                        not applied to channeln_data
+###  "float_dtype": the float precision used for processing ("float32"/"float64")
+###  plus any extra variables given in `metadata`, e.g. the "quality_flags" and
+###  "channeln_quality" segment tables of QualityFlags.metadata(), or "fs_raw",
+###  "resample_up" and "resample_down" of resample_metadata()
 ### }
 ###############################################################################
-def save_to_mat(datas,channels,path,events,labels,fs=16000,starttime=0):
-    matlabVariable = {"fs":fs,"t0":starttime}
+def save_to_mat(datas,channels,path,events,labels,fs=16000,starttime=0,scales=None,dtype=None,metadata=None):
+    from scipy.io import savemat
+    matlabVariable = {"fs":fs,"t0":starttime,"float_dtype":np.dtype(dtype or floatDtype).name}
+    matlabVariable.update(metadata or {})
     for i in range(len(datas)):
         matlabVariable[f'channel{i+1}_label'] = labels[i]
         matlabVariable[f'channel{i+1}_channelname'] = channels[i]
         matlabVariable[f'channel{i+1}_data'] = datas[i]        
+        a, b = scales[i] if scales is not None else (1.0, 0.0)
+        matlabVariable[f'channel{i+1}_scaleA'] = a
+        matlabVariable[f'channel{i+1}_scaleB'] = b
     savemat(path,matlabVariable)
 
 
 ###################### decimate_data ##########################################
-### decimates data using signal.decimate function
+### decimates data using signal.decimate function, working in `dtype`
+### (default floatDtype; signal.decimate keeps float32 input in float32)
+###############################################################################
+def decimate_data(data,decimation,dtype=None):
+    from scipy import signal
+    out = signal.decimate(np.asarray(data,dtype=dtype or floatDtype),decimation)
+    return out
+
+
+###################### filter_data ############################################
+### zero-phase Butterworth filter of one channel (sosfiltfilt) in `dtype`, with
+### the same filtertype/filterfreq/flow/fhigh arguments as signal_process but
+### without needing gwpy
+###############################################################################
+def filter_data(data,filtertype,fs=16000,filterfreq=0,flow=0,fhigh=0,order=4,dtype=None):
+    from scipy import signal
+    x = np.asarray(data,dtype=dtype or floatDtype)
+    if filtertype=="lowpass":
+        sos = signal.butter(order,filterfreq,'lowpass',fs=fs,output='sos')
+    elif filtertype=="highpass":
+        sos = signal.butter(order,filterfreq,'highpass',fs=fs,output='sos')
+    elif filtertype=="bandpass":
+        sos = signal.butter(order,[flow,fhigh],'bandpass',fs=fs,output='sos')
+    else:
+        raise ValueError(f"unknown filter type '{filtertype}'")
+    return signal.sosfiltfilt(sos.astype(x.dtype),x).astype(x.dtype,copy=False)
+
+
+############################## FFT backend ####################################
+### Every spectrum (welch_psd, ZoomSpectrum, the spectra of signal_process)
+### goes through rfft/cfft here, thin wrappers of scipy.fft that transform
+### many segments per call on `fftWorkers` threads (set_fft_workers; scipy
+### parallelizes over the segments, not within one transform). fast_length
+### gives the next length with only small prime factors: a segment of prime
+### length, as a decimated series easily has, transforms orders of magnitude
+### slower. scipy.fft caches its plans per length, and fft_window caches the
+### window arrays, so repeated calls and channels with the same segment length
+### set both up once.
+###############################################################################
+fftWorkers = processingWorkers
+
+def set_fft_workers(workers):
+    global fftWorkers
+    fftWorkers = max(int(workers), 1)
+
+
+def fast_length(n, real=True):
+    from scipy import fft
+    return fft.next_fast_len(int(n), real)
+
+
+@functools.lru_cache(maxsize=32)
+def _fft_window(window, n, dtype):
+    from scipy import signal
+    win = signal.get_window(window, n).astype(dtype)
+    win.flags.writeable = False
+    return win
+
+### window array of length n in `dtype`, shared between calls (read only)
+def fft_window(window, n, dtype=None):
+    if isinstance(window, np.ndarray):
+        return window.astype(dtype or floatDtype, copy=False)
+    return _fft_window(window, int(n), np.dtype(dtype or floatDtype).name)
+
+
+def rfft(x, n=None, axis=-1, workers=None):
+    from scipy import fft
+    return fft.rfft(x, n, axis, workers=workers or fftWorkers)
+
+
+def cfft(x, n=None, axis=-1, workers=None):
+    from scipy import fft
+    return fft.fft(x, n, axis, workers=workers or fftWorkers)
+
+
+############################## welch_psd ######################################
+### One-sided Welch PSD (constant detrend, like scipy.signal.welch) that does
+### the windowing and FFTs in `dtype` but sums the periodograms in float64, so
+### float32 processing does not lose precision over many averages. Segments
+### are taken as strided views of the data, a few at a time, and transformed
+### together through the FFT backend. Each segment is zero padded to nfft,
+### by default the next fast length (a no-op for the usual 1 s segments).
+### average='median' is the median of the periodograms with the bias
+### correction of scipy.signal.welch (the default of gwpy's psd/asd); it has
+### to keep every periodogram.
+### Returns (frequencies, psd), both float64.
+###############################################################################
+def welch_psd(data,fs=16000,nperseg=None,noverlap=None,window='hann',dtype=None,nfft=None,average='mean',workers=None):
+    dtype = np.dtype(dtype or floatDtype)
+    data = np.asarray(data)
+    nperseg = min(nperseg or len(data), len(data))
+    noverlap = nperseg//2 if noverlap is None else noverlap
+    nfft = max(nfft or fast_length(nperseg), nperseg)
+    step = nperseg - noverlap
+    win = fft_window(window, nperseg, dtype)
+    segments = np.lib.stride_tricks.sliding_window_view(data, nperseg)[::step]
+    total = np.zeros(nfft//2 + 1, dtype=np.float64)
+    periodograms = []
+    chunk = max(1, (1 << 22)//nfft)
+    for i in range(0, len(segments), chunk):
+        seg = segments[i:i+chunk].astype(dtype)
+        seg -= seg.mean(axis=1, keepdims=True)
+        spec = rfft(seg*win, nfft, axis=1, workers=workers)
+        power = spec.real**2 + spec.imag**2
+        if average == 'median':
+            periodograms.append(power.astype(np.float64))
+        else:
+            total += power.sum(axis=0, dtype=np.float64)
+    if average == 'median':
+        n = len(segments)
+        bias = 1 + np.sum(1/(2*np.arange(1, (n - 1)//2 + 1) + 1) - 1/(2*np.arange(1, (n - 1)//2 + 1)))
+        total = np.median(np.concatenate(periodograms), axis=0)*n/bias
+    psd = total/(len(segments)*fs*np.sum(win.astype(np.float64)**2))
+    psd[1:nfft - nfft//2] *= 2
+    return np.fft.rfftfreq(nfft, 1/fs), psd
+
+
+########################### StreamDecimator ###################################
+### Decimation by an integer factor that can be fed block by block, with the
+### filter state carried across blocks, so arbitrarily long data (e.g. a memory
+### mapped spill file) is decimated in bounded memory. Uses a linear phase FIR
+### anti-alias filter (as signal.decimate with ftype='fir') and removes its
+### group delay, so the output lines up with the input; call flush() after the
+### last block to get the final samples.
 ###############################################################################
-def decimate_data(data,decimation):
-    out = signal.decimate(data,decimation)
+class StreamDecimator(object):
+    def __init__(self, factor, dtype=None):
+        from scipy import signal
+        self.factor = int(factor)
+        self.dtype = np.dtype(dtype or floatDtype)
+        self.taps = signal.firwin(20*self.factor + 1, 1/self.factor, window='hamming').astype(self.dtype)
+        self.zi = np.zeros(len(self.taps) - 1, dtype=self.dtype)
+        self.delay = (len(self.taps) - 1)//2
+        self.count = 0          ### filtered samples produced so far
+        self.received = 0       ### input samples received so far
+        self.emitted = 0        ### output samples returned so far
+
+    def process(self, block):
+        block = np.asarray(block, dtype=self.dtype)
+        self.received += len(block)
+        return self._filter(block)
+
+    def _filter(self, block):
+        from scipy import signal
+        if len(block) == 0:
+            return np.zeros(0, dtype=self.dtype)
+        filtered, self.zi = signal.lfilter(self.taps, 1.0, block, zi=self.zi)
+        ### keep the samples at delay, delay + factor, delay + 2*factor, ... of the filtered stream
+        first = self.delay - self.count if self.count <= self.delay else (self.delay - self.count) % self.factor
+        out = filtered[first::self.factor]
+        self.count += len(filtered)
+        self.emitted += len(out)
+        return out.astype(self.dtype, copy=False)
+
+    def flush(self):
+        ### push the last `delay` samples out of the filter, keeping only outputs
+        ### that belong to real input samples
+        wanted = -(-self.received//self.factor) - self.emitted
+        return self._filter(np.zeros(self.delay, dtype=self.dtype))[:max(wanted, 0)]
+
+
+############################# read_chunks #####################################
+### Yields `data` `chunk` samples at a time. `data` is an array or the path of a
+### raw binary file of `dtype` (e.g. a CheckpointedSpill channel file), which is
+### read with plain file reads so that, unlike a np.memmap, the pages read do
+### not stay resident in this process.
+###############################################################################
+def read_chunks(data, chunk=1 << 20, dtype=np.int16):
+    if isinstance(data, (str, os.PathLike)):
+        with open(data, 'rb') as f:
+            while True:
+                block = np.fromfile(f, dtype=dtype, count=chunk)
+                if len(block) == 0:
+                    return
+                yield block
+    else:
+        for start in range(0, len(data), chunk):
+            yield data[start:start+chunk]
+
+
+########################### decimate_chunked ##################################
+### Decimates a channel (array or raw file, see read_chunks) through a
+### StreamDecimator `chunk` samples at a time. The output goes to `out`: an
+### array of the output length, an open binary file, or (default) a new array.
+### Peak extra memory is a few chunks.
+###############################################################################
+def decimate_chunked(data, factor, dtype=None, chunk=1 << 20, out=None, raw_dtype=np.int16):
+    decimator = StreamDecimator(factor, dtype)
+    return _stream_chunked(decimator, lambda n: -(-n//decimator.factor), data, chunk, out, raw_dtype)
+
+
+### runs the chunks of `data` through a stream (process/flush) into `out`
+def _stream_chunked(stream, length, data, chunk, out, raw_dtype):
+    if out is None:
+        n = os.path.getsize(data)//np.dtype(raw_dtype).itemsize if isinstance(data, (str, os.PathLike)) else len(data)
+        out = np.empty(length(n), dtype=stream.dtype)
+    i = 0
+    for block in read_chunks(data, chunk, raw_dtype):
+        i = _put(out, i, stream.process(block))
+    _put(out, i, stream.flush())
     return out
 
 
+def _put(out, i, y):
+    if isinstance(out, np.ndarray):
+        out[i:i+len(y)] = y
+    else:
+        y.tofile(out)
+    return i + len(y)
+
+
+############################ sampling rates ###################################
+### Output rates are given by name or in Hz: "1kHz", "250Hz", "2.048kHz",
+### "300" or 300. parse_rate returns the rate in Hz (an int when it is whole),
+### rate_name the name the GUIs and config files show for it. resample_ratio
+### is the exact, reduced up/down ratio between two rates, e.g. 16 kHz to
+### 300 Hz is 3/160, to 2048 Hz 16/125, to 1 kHz 1/16.
+###############################################################################
+def parse_rate(rate):
+    if rate in decimationVal:
+        return decimationVal[rate]
+    if isinstance(rate, str):
+        match = re.fullmatch(r'\s*([0-9]*\.?[0-9]+)\s*(k?)(hz)?\s*', rate, re.IGNORECASE)
+        if match is None:
+            raise ValueError(f"unknown sampling rate '{rate}'")
+        value = Fraction(match.group(1))*(1000 if match.group(2) else 1)
+    else:
+        value = Fraction(str(rate))
+    if value <= 0:
+        raise ValueError(f"sampling rate must be positive, not '{rate}'")
+    return int(value) if value.denominator == 1 else float(value)
+
+
+def rate_name(rate):
+    rate = parse_rate(rate)
+    for name, value in decimationVal.items():
+        if value == rate:
+            return name
+    return f"{rate:g}Hz"
+
+
+def resample_ratio(fs_in, fs_out):
+    ratio = Fraction(str(parse_rate(fs_out)))/Fraction(str(parse_rate(fs_in)))
+    return ratio.numerator, ratio.denominator
+
+
+### the saved record of how a file's rate was made from the raw rate (empty
+### when the rate is unchanged)
+def resample_metadata(fs_in, fs_out):
+    up, down = resample_ratio(fs_in, fs_out)
+    if up == down:
+        return {}
+    return {'fs_raw': parse_rate(fs_in), 'resample_up': up, 'resample_down': down}
+
+
+### number of samples n input samples give at the new rate
+def resampled_length(n, fs_in, fs_out):
+    up, down = resample_ratio(fs_in, fs_out)
+    return -(-n*up//down)
+
+
+########################### StreamResampler ###################################
+### Resampling by the exact rational ratio up/down between two rates (see
+### resample_ratio), fed block by block with the filter state carried across
+### blocks, like StreamDecimator. The anti-alias filter is the Kaiser windowed
+### FIR of signal.resample_poly, run as a polyphase filter bank: an output
+### sample only touches the 1/up of the taps that meet real input samples, so
+### the zero stuffed up-sampled stream is never built. The group delay is
+### removed, so the output lines up with the input and matches resample_poly
+### away from the ends; call flush() after the last block.
+###############################################################################
+class StreamResampler(object):
+    def __init__(self, fs_in, fs_out, dtype=None):
+        from scipy import signal
+        self.up, self.down = resample_ratio(fs_in, fs_out)
+        self.dtype = np.dtype(dtype or floatDtype)
+        rate = max(self.up, self.down)
+        taps = signal.firwin(20*rate + 1, 1/rate, window=('kaiser', 5.0))*self.up if rate > 1 else np.ones(1)
+        self.delay = 10*rate if rate > 1 else 0     ### in samples of the up-sampled stream
+        self.ntaps = -(-len(taps)//self.up)
+        ### row p holds the taps p, p + up, p + 2*up, ... reversed, to be dotted with the input in time order
+        bank = np.zeros(self.ntaps*self.up)
+        bank[:len(taps)] = taps
+        self.bank = np.ascontiguousarray(bank.reshape(self.ntaps, self.up).T[:, ::-1], dtype=self.dtype)
+        self.history = np.zeros(self.ntaps - 1, dtype=self.dtype)
+        self.start = 1 - self.ntaps  ### input index of history[0], the zeros before the first sample
+        self.received = 0       ### input samples received so far
+        self.emitted = 0        ### output samples returned so far
+
+    def process(self, block):
+        block = np.asarray(block, dtype=self.dtype)
+        self.received += len(block)
+        return self._filter(block)
+
+    def _filter(self, block):
+        buffer = np.concatenate([self.history, block])
+        end = self.start + len(buffer)
+        ### output k is centred on input sample (k*down + delay)//up and needs it buffered
+        stop = max((end*self.up - 1 - self.delay)//self.down + 1, self.emitted)
+        position = np.arange(self.emitted, stop, dtype=np.int64)*self.down + self.delay
+        rows = position//self.up - (self.ntaps - 1) - self.start
+        phases = position % self.up
+        out = np.empty(len(rows), dtype=self.dtype)
+        windows = np.lib.stride_tricks.sliding_window_view(buffer, self.ntaps) if len(rows) else None
+        batch = max(1, (1 << 21)//self.ntaps)
+        for i in range(0, len(rows), batch):
+            r, p = rows[i:i+batch], phases[i:i+batch]
+            for phase in np.unique(p):
+                selected = p == phase
+                out[i:i+batch][selected] = windows[r[selected]] @ self.bank[phase]
+        self.emitted = stop
+        ### keep the input from where the window of the next output starts
+        keep = min(max((stop*self.down + self.delay)//self.up - (self.ntaps - 1) - self.start, 0), len(buffer))
+        self.history = buffer[keep:].copy()
+        self.start += keep
+        return out
+
+    def flush(self):
+        ### pushes zeros through until every output belonging to real input is out
+        wanted = -(-self.received*self.up//self.down) - self.emitted
+        if wanted <= 0:
+            return np.zeros(0, dtype=self.dtype)
+        last = (self.emitted + wanted - 1)*self.down + self.delay
+        zeros = max(last//self.up + 1 - (self.start + len(self.history)), 0)
+        return self._filter(np.zeros(zeros, dtype=self.dtype))[:wanted]
+
+
+############################ resample_data ####################################
+### One channel from fs_in to fs_out, in `dtype`. Whole factors (the rates of
+### decimationVal) go through decimate_data as before, any other ratio through
+### a StreamResampler. resample_chunked is the counterpart of decimate_chunked
+### (array or raw file in, array or open binary file out, bounded memory).
+###############################################################################
+def resample_data(data, fs_in, fs_out, dtype=None):
+    up, down = resample_ratio(fs_in, fs_out)
+    dtype = dtype or floatDtype
+    ### one channel; getdata() blocks come as (1, n) images
+    data = np.ravel(data)
+    if up == down:
+        return np.asarray(data, dtype=dtype)
+    if up == 1 and len(data) > 27:
+        ### the filtfilt inside signal.decimate needs more samples than its padding (27)
+        return decimate_data(data, down, dtype)
+    return resample_chunked(data, fs_in, fs_out, dtype)
+
+
+def resample_chunked(data, fs_in, fs_out, dtype=None, chunk=1 << 20, out=None, raw_dtype=np.int16):
+    up, down = resample_ratio(fs_in, fs_out)
+    if up == 1 and down > 1:
+        ### same FIR decimation as before for the whole factors
+        return decimate_chunked(data, down, dtype, chunk, out, raw_dtype)
+    resampler = StreamResampler(fs_in, fs_out, dtype)
+    return _stream_chunked(resampler, lambda n: resampled_length(n, fs_in, fs_out), data, chunk, out, raw_dtype)
+
+
+##################### save_channels_to_csv_chunked ############################
+### same file as save_channels_to_csv (one row per channel), but each channel
+### (array or raw file of `dtype`, see read_chunks) is read `chunk` samples at
+### a time and formatted `batch` samples at a time: as Python numbers and
+### strings a sample takes ~100 bytes, so the batch bounds the memory whatever
+### the chunk
+###############################################################################
+def save_channels_to_csv_chunked(datas,path,chunk=1 << 18,dtype=np.int16,batch=1 << 15):
+    with open(path,'w',newline='') as f:
+        for data in datas:
+            first = True
+            for block in read_chunks(data, chunk, dtype):
+                block = np.asarray(block)
+                for start in range(0, len(block), batch):
+                    if not first:
+                        f.write(',')
+                    first = False
+                    part = block[start:start+batch]
+                    ### csv.writer writes str() of the numpy scalars; for float32 that is the short float32 repr
+                    f.write(','.join(map(str, part if part.dtype == np.float32 else part.tolist())))
+            f.write('\r\n')
+
+
 ###################### overwriteCheck #########################################
 ### checks if the file name already exists, and if it does, prompts the user 
 ### with a pop up asking for explicit overwrite permission. Returns boolean of
@@ -101,102 +550,2066 @@ def unsigned_to_signed(number, maxbits):
         return number
     else:
         return number - maxn
-def get_doocs_data(chans,start,stop,daq="/daq_data/alps",server="TTF2.DAQ/DAQ.SERVER5/DAQ.DATA.SVR/"):
+
+
+###################### convert_to_signed ######################################
+### vectorized version of unsigned_to_signed, converting a whole DAQ frame at
+### once. For 16 bit data this is a reinterpretation of the bits, no arithmetic.
+###############################################################################
+def convert_to_signed(data, maxbits=16):
+    data = np.asarray(data)
+    if maxbits == 16:
+        return data.astype(np.uint16).view(np.int16)
+    maxn = 1 << maxbits
+    data = data.astype(np.int64)
+    return np.where(data < (maxn >> 1), data, data - maxn)
+
+
+############################ ChannelBuffer ####################################
+### growable int16 buffer replacing repeated np.append, which copies the whole
+### channel for every macropulse. Capacity doubles when full, so appending a
+### long acquisition costs amortized O(1) per sample.
+###############################################################################
+class ChannelBuffer(object):
+    def __init__(self, capacity=16000, dtype=np.int16):
+        self._data = np.empty(max(int(capacity), 1), dtype=dtype)
+        self.size = 0
+
+    def append(self, block):
+        n = len(block)
+        if self.size + n > len(self._data):
+            grown = np.empty(max(2*len(self._data), self.size + n), dtype=self._data.dtype)
+            grown[:self.size] = self._data[:self.size]
+            self._data = grown
+        self._data[self.size:self.size+n] = block
+        self.size += n
+
+    def array(self):
+        return self._data[:self.size]
+
+    def __len__(self):
+        return self.size
+
+
+############################## calibrate ######################################
+### Applies the polynomial scale a*x + b to raw data, converting straight into
+### the requested float dtype (np.float32 halves the memory of the result) with
+### no intermediate float64 copy. With a=1, b=0 it is only a dtype conversion.
+###############################################################################
+def calibrate(data, a=1.0, b=0.0, dtype=np.float64):
+    if np.all(np.asarray(a) == 1) and np.all(np.asarray(b) == 0):
+        return np.asarray(data).astype(dtype, copy=False)
+    out = np.multiply(data, np.asarray(a, dtype=dtype), dtype=dtype)
+    out += np.asarray(b, dtype=dtype)
+    return out
+
+
+############################# plot_reduce #####################################
+### Reduces a channel to a min/max envelope of at most 2*npoints values for
+### plotting. The reduction runs on the raw samples and the calibration is
+### applied to the small result only; a negative scale swaps min and max.
+### Returns (sample index of each bin, lower envelope, upper envelope).
+###############################################################################
+def plot_reduce(data, npoints=2000, a=1.0, b=0.0, dtype=np.float64):
+    data = np.asarray(data)
+    binsize = max(int(np.ceil(len(data)/npoints)), 1)
+    nbins = len(data)//binsize
+    blocks = data[:nbins*binsize].reshape(nbins, binsize)
+    low, high = blocks.min(axis=1), blocks.max(axis=1)
+    if nbins*binsize < len(data):
+        low = np.append(low, data[nbins*binsize:].min())
+        high = np.append(high, data[nbins*binsize:].max())
+    low, high = calibrate(low, a, b, dtype), calibrate(high, a, b, dtype)
+    if a < 0:
+        low, high = high, low
+    return np.arange(len(low))*binsize, low, high
+
+
+############################## Recording ######################################
+### Time-aligned multi-channel recording: one C-contiguous (channels x samples)
+### array (int16 straight from the DAQ) plus fs, t0 (unix time of sample 0),
+### the DAQ channel names and the user labels. `gaps` lists the zero-filled
+### (channel index, first sample, number of samples) stretches where the DAQ
+### skipped blocks. channel() and time_slice()/sample_slice() return views
+### into the same buffer, never copies, so vectorized multi-channel operations
+### (and the per-channel pool in map_channels) all work on one array.
+### Calibration is kept as per-channel metadata (scale_a, scale_b for a*x + b)
+### and only applied by calibrated() or by the consuming operation, so the raw
+### int16 buffer stays at 2 bytes per sample.
+###############################################################################
+class Recording(object):
+    __slots__ = ('data', 'fs', 't0', 'names', 'labels', 'gaps', 'scale_a', 'scale_b')
+
+    def __init__(self, data, fs=16000, t0=0.0, names=None, labels=None, gaps=None, scale_a=None, scale_b=None):
+        data = np.asarray(data)
+        if data.ndim == 1:
+            data = data[np.newaxis, :]
+        self.data = data
+        self.fs = fs
+        self.t0 = t0
+        self.names = list(names) if names is not None else [f'channel{i+1}' for i in range(len(data))]
+        self.labels = list(labels) if labels is not None else ['']*len(self.names)
+        self.gaps = list(gaps) if gaps is not None else []
+        self.scale_a = np.ones(len(self.names)) if scale_a is None else np.broadcast_to(np.asarray(scale_a, float), (len(self.names),)).copy()
+        self.scale_b = np.zeros(len(self.names)) if scale_b is None else np.broadcast_to(np.asarray(scale_b, float), (len(self.names),)).copy()
+
+    ### builds a recording from separate 1-D channel arrays that all start at t0,
+    ### trimmed to the shortest channel
+    @classmethod
+    def from_channels(cls, datas, names, labels=None, fs=16000, t0=0.0, dtype=None):
+        n = min(len(d) for d in datas)
+        data = np.empty((len(datas), n), dtype=dtype or np.result_type(*datas))
+        for i, d in enumerate(datas):
+            data[i] = d[:n]
+        return cls(data, fs, t0, names, labels)
+
+    ### consumes (daqname, macropulse, timestamp, data) blocks, e.g. straight from iter_doocs_data
+    @classmethod
+    def from_blocks(cls, blocks, names, labels=None, fs=16000):
+        builder = RecordingBuilder(names, labels, fs)
+        for block in blocks:
+            builder.append(*block)
+        return builder.build()
+
+    @property
+    def shape(self):
+        return self.data.shape
+
+    @property
+    def nsamples(self):
+        return self.data.shape[1]
+
+    @property
+    def duration(self):
+        return self.nsamples/self.fs
+
+    def __len__(self):
+        return len(self.names)
+
+    def index(self, key):
+        return key if isinstance(key, (int, np.integer)) else self.names.index(key)
+
+    ### 1-D view of one channel, by DAQ name or index
+    def channel(self, key):
+        return self.data[self.index(key)]
+
+    def times(self):
+        return self.t0 + np.arange(self.nsamples)/self.fs
+
+    ### view of samples [start, stop) on every channel, as a Recording
+    def sample_slice(self, start, stop):
+        start, stop, step = slice(start, stop).indices(self.nsamples)
+        gaps = [(c, max(s - start, 0), min(s + n, stop) - max(s, start)) for c, s, n in self.gaps
+                if s < stop and s + n > start]
+        return Recording(self.data[:, start:stop], self.fs, self.t0 + start/self.fs, self.names, self.labels, gaps,
+                         self.scale_a, self.scale_b)
+
+    ### view between two unix times (either may be None for the start / end)
+    def time_slice(self, tstart=None, tstop=None):
+        start = 0 if tstart is None else int(np.ceil(round((tstart - self.t0)*self.fs, 6)))
+        stop = self.nsamples if tstop is None else int(np.ceil(round((tstop - self.t0)*self.fs, 6)))
+        return self.sample_slice(max(start, 0), max(stop, 0))
+
+    ### recording of a subset of channels; a view when the channels are adjacent and in order
+    def select(self, keys):
+        idx = [self.index(k) for k in keys]
+        if idx == list(range(idx[0], idx[0] + len(idx))):
+            data = self.data[idx[0]:idx[0] + len(idx)]
+        else:
+            data = self.data[idx]
+        gaps = [(idx.index(c), s, n) for c, s, n in self.gaps if c in idx]
+        return Recording(data, self.fs, self.t0, [self.names[i] for i in idx], [self.labels[i] for i in idx], gaps,
+                         self.scale_a[idx], self.scale_b[idx])
+
+    ### same channels and start time with new sample data, e.g. after decimation
+    def with_data(self, data, fs=None):
+        data = np.asarray(data)
+        factor = (fs or self.fs)/self.fs
+        gaps = [(c, int(s*factor), max(int(n*factor), 1)) for c, s, n in self.gaps]
+        return Recording(data, fs or self.fs, self.t0, self.names, self.labels, gaps, self.scale_a, self.scale_b)
+
+    ### sets the a*x + b calibration of one channel; the data is not touched
+    def set_scale(self, key, a=1.0, b=0.0):
+        i = self.index(key)
+        self.scale_a[i] = a
+        self.scale_b[i] = b
+
+    ### calibrated copy of one channel (or of all channels when key is None),
+    ### computed in a single pass in the requested float dtype
+    def calibrated(self, key=None, dtype=np.float64):
+        if key is not None:
+            i = self.index(key)
+            return calibrate(self.data[i], self.scale_a[i], self.scale_b[i], dtype)
+        return calibrate(self.data, self.scale_a[:, np.newaxis], self.scale_b[:, np.newaxis], dtype)
+
+
+### number of zeros to put before a block at `timestamp` of a channel that
+### started at `first` and holds `filled` samples: a block later than expected
+### by more than half its length means the DAQ skipped frames
+def _gap_length(first, filled, timestamp, n, fs):
+    missing = int(round((timestamp - first)*fs)) - filled
+    return missing if missing > n//2 else 0
+
+
+### time span the channels have in common: (t0, sample offset of t0 into each
+### channel, number of samples). Channels without data (first None) do not
+### limit the span; they get offset 0.
+def _common_span(firsts, lengths, fs):
+    present = [i for i, f in enumerate(firsts) if f is not None]
+    if not present:
+        raise ValueError("no data received for any channel")
+    t0 = max(firsts[i] for i in present)
+    offsets = [int(round((t0 - f)*fs)) if f is not None else 0 for f in firsts]
+    n = max(min(lengths[i] - offsets[i] for i in present), 0)
+    return t0, offsets, n
+
+
+### gaps (channel, start, length) moved to a span starting `offsets` samples
+### into the channels and `n` samples long
+def _span_gaps(gaps, offsets, n):
+    return [(c, s - offsets[c], min(m, n - (s - offsets[c]))) for c, s, m in gaps
+            if 0 <= s - offsets[c] < n]
+
+
+########################## RecordingBuilder ###################################
+### Collects streamed blocks into a Recording. Blocks are placed by timestamp:
+### each channel keeps a ChannelBuffer from its first block on, and a block
+### arriving later than expected by more than half a block means the DAQ
+### skipped frames, so the hole is zero-filled and noted in `gaps`. build()
+### cuts all channels to the time span they have in common and copies them
+### into the single (channels x samples) array. A channel that got no data at
+### all is zero over the whole span, noted as one gap and listed in `missing`.
+###############################################################################
+class RecordingBuilder(object):
+    def __init__(self, names, labels=None, fs=16000, capacity=16000):
+        self.names = list(names)
+        self.labels = labels
+        self.fs = fs
+        self.buffers = [ChannelBuffer(capacity) for n in self.names]
+        self.first = [None]*len(self.names)
+        self.gaps = []
+
+    def append(self, daqname, macropulse, timestamp, data):
+        if daqname not in self.names:
+            return
+        i = self.names.index(daqname)
+        buffer = self.buffers[i]
+        if self.first[i] is None:
+            self.first[i] = timestamp
+        else:
+            missing = _gap_length(self.first[i], len(buffer), timestamp, len(data), self.fs)
+            if missing:
+                self.gaps.append((i, len(buffer), missing))
+                buffer.append(np.zeros(missing, dtype=buffer.array().dtype))
+        buffer.append(data)
+
+    @property
+    def missing(self):
+        return [n for n, f in zip(self.names, self.first) if f is None]
+
+    ### `allocate(shape, dtype)` provides the output array, e.g. in shared memory (publish_recording)
+    def build(self, allocate=np.empty):
+        t0, offsets, n = _common_span(self.first, [len(b) for b in self.buffers], self.fs)
+        data = allocate((len(self.names), n), np.int16)
+        gaps = _span_gaps(self.gaps, offsets, n)
+        for i, (b, o) in enumerate(zip(self.buffers, offsets)):
+            if self.first[i] is None:
+                data[i] = 0
+                if n:
+                    gaps.append((i, 0, n))
+            else:
+                data[i] = b.array()[o:o+n]
+        return Recording(data, self.fs, t0, self.names, self.labels, sorted(gaps))
+
+
+########################### SavedRecording ####################################
+### A recording written by the save tools (.mat or .csv), opened lazily: only
+### the metadata is read up front, and channel()/time_window() read just the
+### samples asked for, so a few seconds out of a file of many GB come back in
+### milliseconds.
+###  - .mat (v5, as written by save_to_mat): the file is walked tag by tag to
+###    find where each channelN_data array starts, and channels are np.memmap
+###    views of it. Compressed variables are loaded whole (loadmat).
+###  - .mat v7.3 (HDF5, e.g. re-saved from MATLAB): slices are read through
+###    h5py, which only touches the HDF5 chunks in the window.
+###  - .csv (one row per channel): one pass over the file records the byte
+###    offset of every `step`-th sample of each row; a window is then parsed
+###    from its own bytes only. A CSV has no metadata, so fs, t0, names and
+###    labels come from the <filename>_config_file.txt next to it when it
+###    exists, else from the arguments (default 16 kHz, t0 = 0).
+### Samples are returned raw (as stored), with the a*x + b calibration in
+### scale_a/scale_b as in Recording.
+###############################################################################
+_matTypes = {1: 'i1', 2: 'u1', 3: 'i2', 4: 'u2', 5: 'i4', 6: 'u4', 7: 'f4', 9: 'f8', 12: 'i8', 13: 'u8'}
+
+
+### name -> (dtype, number of elements, file offset) of the uncompressed, real
+### numeric variables of a v5 .mat file, plus the set of compressed variables
+def _mat_variables(path):
+    variables, compressed = {}, set()
+    with open(path, 'rb') as f:
+        header = f.read(128)
+        order = '<' if header[126:128] == b'IM' else '>'
+        def element(body, pos):
+            mtype, nbytes = struct.unpack_from(order+'II', body, pos)
+            if mtype >> 16:     ### small data element: type, size and up to 4 bytes of data in one tag
+                return mtype & 0xffff, mtype >> 16, pos + 4, pos + 8
+            return mtype, nbytes, pos + 8, pos + 8 + nbytes + (-nbytes % 8)
+        while True:
+            tag = f.read(8)
+            if len(tag) < 8:
+                break
+            mtype, nbytes = struct.unpack(order+'II', tag)
+            start = f.tell()
+            if mtype == 15:
+                compressed.add(start)
+            elif mtype == 14:
+                body = f.read(min(nbytes, 4096))
+                _, _, data, pos = element(body, 0)
+                flags = struct.unpack_from(order+'I', body, data)[0]
+                _, _, _, pos = element(body, pos)                   ### dimensions
+                _, n, data, pos = element(body, pos)                ### array name
+                name = body[data:data+n].decode('latin-1')
+                rtype, n, data, pos = element(body, pos)            ### real part
+                if 6 <= flags & 0xff <= 15 and not flags & 0x800 and rtype in _matTypes:
+                    dtype = np.dtype(order + _matTypes[rtype])
+                    variables[name] = (dtype, n//dtype.itemsize, start + data)
+            f.seek(start + nbytes + (-nbytes % 8))
+    return variables, compressed
+
+
+def _mat_string(value):
+    value = np.ravel(value)
+    return str(value[0]) if value.size else ''
+
+
+class SavedRecording(object):
+    def __init__(self, path, fs=None, t0=None, names=None, labels=None, step=16000):
+        self.path = path
+        self.step = step
+        self._h5 = None
+        with open(path, 'rb') as f:
+            header = f.read(128)
+        if path.lower().endswith('.csv'):
+            self._open_csv(fs, t0, names, labels)
+        elif header.startswith(b'MATLAB 7.3') or b'HDF' in header[:8]:
+            self._open_hdf5()
+        else:
+            self._open_mat()
+
+    def _open_mat(self):
+        from scipy.io import loadmat
+        self._variables, compressed = _mat_variables(self.path)
+        meta = loadmat(self.path, variable_names=['fs', 't0'] + [f'channel{i+1}_{key}' for i in range(64)
+                                                                  for key in ('label', 'channelname', 'scaleA', 'scaleB')])
+        n = 0
+        while f'channel{n+1}_channelname' in meta:
+            n += 1
+        self.fs = float(np.ravel(meta['fs'])[0])
+        self.t0 = float(np.ravel(meta['t0'])[0])
+        self.names = [_mat_string(meta[f'channel{i+1}_channelname']) for i in range(n)]
+        self.labels = [_mat_string(meta.get(f'channel{i+1}_label', '')) for i in range(n)]
+        self.scale_a = np.array([float(np.ravel(meta.get(f'channel{i+1}_scaleA', 1.0))[0]) for i in range(n)])
+        self.scale_b = np.array([float(np.ravel(meta.get(f'channel{i+1}_scaleB', 0.0))[0]) for i in range(n)])
+        self._channels = []
+        for i in range(n):
+            name = f'channel{i+1}_data'
+            if name in self._variables:
+                dtype, count, offset = self._variables[name]
+                self._channels.append(np.memmap(self.path, dtype=dtype, mode='r', offset=offset, shape=(count,))
+                                      if count else np.zeros(0, dtype=dtype))
+            else:               ### compressed or unusual layout: no way around loading it
+                self._channels.append(np.ravel(loadmat(self.path, variable_names=[name])[name]))
+        self.nsamples = [len(c) for c in self._channels]
+
+    def _open_hdf5(self):
+        try:
+            import h5py
+        except ImportError:
+            raise ImportError(f"{self.path} is a MATLAB v7.3 (HDF5) file, reading it needs h5py")
+        self._h5 = h5py.File(self.path, 'r')
+        def text(key):
+            if key not in self._h5 or self._h5[key].attrs.get('MATLAB_empty', 0):
+                return ''
+            return ''.join(map(chr, np.ravel(self._h5[key][()])))
+        def number(key, default):
+            return float(np.ravel(self._h5[key][()])[0]) if key in self._h5 else default
+        n = 0
+        while f'channel{n+1}_data' in self._h5:
+            n += 1
+        self.fs = number('fs', 16000.0)
+        self.t0 = number('t0', 0.0)
+        self.names = [text(f'channel{i+1}_channelname') for i in range(n)]
+        self.labels = [text(f'channel{i+1}_label') for i in range(n)]
+        self.scale_a = np.array([number(f'channel{i+1}_scaleA', 1.0) for i in range(n)])
+        self.scale_b = np.array([number(f'channel{i+1}_scaleB', 0.0) for i in range(n)])
+        self._channels = [self._h5[f'channel{i+1}_data'] for i in range(n)]
+        self.nsamples = [c.size for c in self._channels]
+
+    def _open_csv(self, fs, t0, names, labels):
+        config = {}
+        summary = os.path.splitext(self.path)[0] + '_config_file.txt'
+        if os.path.exists(summary):
+            with open(summary) as f:
+                for line in f:
+                    line = line.strip()
+                    if line.startswith('Sampling rate:'):
+                        try:
+                            config['fs'] = parse_rate(line.split(':', 1)[1].strip())
+                        except ValueError:
+                            pass
+                    elif line.startswith('Data start time:'):
+                        config['t0'] = datetime.strptime(line.split(':', 1)[1].strip(), '%Y-%m-%d %H:%M:%S').timestamp()
+                    elif line.startswith('Saving on Channel') and '..... channel label:' in line:
+                        channel, label = line.split(':', 1)[1].split('..... channel label:')
+                        if channel.strip() != 'None':
+                            config.setdefault('names', []).append(channel.strip())
+                            config.setdefault('labels', []).append(label.strip())
+        self._rows = self._csv_index()
+        n = len(self._rows)
+        self.fs = float(fs or config.get('fs') or 16000)
+        self.t0 = float(t0 if t0 is not None else config.get('t0', 0.0))
+        self.names = list(names or config.get('names', []))[:n]
+        self.names += [f'channel{i+1}' for i in range(len(self.names), n)]
+        self.labels = list(labels or config.get('labels', []))[:n]
+        self.labels += ['']*(n - len(self.labels))
+        self.scale_a = np.ones(n)
+        self.scale_b = np.zeros(n)
+        self.nsamples = [count for checkpoints, end, count in self._rows]
+
+    ### per row: (byte offsets of samples 0, step, 2*step, ..., byte offset of the row end, samples)
+    def _csv_index(self, chunk=1 << 24):
+        rows = []
+        checkpoints, count, position = [0], 0, 0
+        with open(self.path, 'rb') as f:
+            while True:
+                buf = np.frombuffer(f.read(chunk), dtype=np.uint8)
+                if len(buf) == 0:
+                    break
+                newlines = np.flatnonzero(buf == 10)
+                commas = np.flatnonzero(buf == 44)
+                lo = 0
+                for end in list(newlines) + [len(buf)]:
+                    row = commas[np.searchsorted(commas, lo):np.searchsorted(commas, end)]
+                    index = count + 1 + np.arange(len(row))
+                    checkpoints.extend((position + row[index % self.step == 0] + 1).tolist())
+                    count += len(row)
+                    if end < len(buf):
+                        rowend = position + end - (end > 0 and buf[end-1] == 13)
+                        ### an empty channel is an empty row, which still takes its place
+                        rows.append((np.array(checkpoints, dtype=np.int64), rowend, count + 1 if rowend > checkpoints[0] else 0))
+                        checkpoints, count = [position + end + 1], 0
+                    lo = end + 1
+                position += len(buf)
+        if position > checkpoints[0]:
+            rows.append((np.array(checkpoints, dtype=np.int64), position, count + 1))
+        return rows
+
+    ### byte offset of sample i of a CSV row (i == samples: the row end)
+    def _csv_offset(self, f, row, i):
+        checkpoints, end, count = self._rows[row]
+        if i >= count:
+            return end + 1
+        k = i//self.step
+        if i == k*self.step:
+            return int(checkpoints[k])
+        stop = int(checkpoints[k+1]) if k + 1 < len(checkpoints) else end
+        f.seek(int(checkpoints[k]))
+        buf = np.frombuffer(f.read(stop - int(checkpoints[k])), dtype=np.uint8)
+        return int(checkpoints[k]) + int(np.flatnonzero(buf == 44)[i - k*self.step - 1]) + 1
+
+    def __len__(self):
+        return len(self.names)
+
+    def index(self, key):
+        return key if isinstance(key, (int, np.integer)) else self.names.index(key)
+
+    ### samples [start, stop) of one channel: a memmap view for .mat v5 files, read for HDF5 and CSV
+    def channel(self, key, start=0, stop=None):
+        i = self.index(key)
+        start, stop, _ = slice(start, stop).indices(self.nsamples[i])
+        stop = max(stop, start)
+        if self.path.lower().endswith('.csv'):
+            if stop == start:
+                return np.zeros(0)
+            with open(self.path, 'rb') as f:
+                first, last = self._csv_offset(f, i, start), self._csv_offset(f, i, stop)
+                f.seek(first)
+                return np.array(f.read(last - 1 - first).split(b','), dtype=np.float64)
+        data = self._channels[i]
+        if self._h5 is not None:
+            return data[0, start:stop] if data.shape[0] == 1 else data[start:stop, 0]
+        return data[start:stop]
+
+    ### (time of the first sample, samples) of one channel between two unix times
+    def time_window(self, key, tstart=None, tstop=None):
+        i = self.index(key)
+        start = 0 if tstart is None else max(int(np.ceil(round((tstart - self.t0)*self.fs, 6))), 0)
+        stop = self.nsamples[i] if tstop is None else max(int(np.ceil(round((tstop - self.t0)*self.fs, 6))), 0)
+        start = min(start, self.nsamples[i])
+        return self.t0 + start/self.fs, self.channel(i, start, stop)
+
+    ### in-memory Recording of the given channels (default all) between two unix times
+    def window(self, tstart=None, tstop=None, keys=None):
+        idx = [self.index(k) for k in keys] if keys is not None else list(range(len(self)))
+        parts = [self.time_window(i, tstart, tstop) for i in idx]
+        recording = Recording.from_channels([np.asarray(data) for t, data in parts], [self.names[i] for i in idx],
+                                            [self.labels[i] for i in idx], self.fs, parts[0][0] if parts else self.t0)
+        recording.scale_a = self.scale_a[idx]
+        recording.scale_b = self.scale_b[idx]
+        return recording
+
+    def close(self):
+        self._channels = []
+        if self._h5 is not None:
+            self._h5.close()
+            self._h5 = None
+
+
+############################## TrendTable #####################################
+### Per-interval min/max/mean/RMS summaries, computed while the data streams in
+### so that long-term overviews never need the full rate data. Feed it the same
+### (daqname, macropulse, timestamp, data) blocks as RecordingBuilder; complete
+### intervals are reduced with vectorized reshape reductions. Each row keeps
+### n, sum and sum of squares, so tables can be merged into coarser intervals
+### exactly (rebin_trend). Interval starts are whole multiples of the interval
+### in unix time, so tables of different pulls can be joined row by row.
+### Values are in raw ADC units; the calibration is stored with the table and
+### applied when plotting.
+###############################################################################
+trendDtype = np.dtype([('t', 'f8'), ('n', 'i8'), ('min', 'f8'), ('max', 'f8'), ('sum', 'f8'), ('sumsq', 'f8')])
+
+
+class _TrendChannel(object):
+    def __init__(self, nper, fs):
+        self.nper = nper
+        self.fs = fs
+        self.interval = nper/fs
+        self.pending = np.empty(nper, dtype=np.float64)
+        self.filled = 0
+        self.t0 = None
+        self.count = 0
+        self.k = 0              ### unix interval number of the interval being filled
+        self.room = nper        ### samples that interval holds (fewer for the first one after a (re)start)
+        self.rows = []
+
+    def _reduce(self, blocks, t):
+        rows = np.empty(len(blocks), dtype=trendDtype)
+        rows['t'] = t
+        rows['n'] = blocks.shape[1]
+        rows['min'] = blocks.min(axis=1)
+        rows['max'] = blocks.max(axis=1)
+        rows['sum'] = blocks.sum(axis=1, dtype=np.float64)
+        rows['sumsq'] = np.einsum('ij,ij->i', blocks, blocks, dtype=np.float64)
+        self.rows.append(rows)
+
+    def flush(self):
+        if self.filled:
+            self._reduce(self.pending[np.newaxis, :self.filled], [self.k*self.interval])
+            self.k += 1
+        self.filled = 0
+        self.room = self.nper
+
+    def append(self, timestamp, data):
+        ### at the start, and when the DAQ skipped frames, realign: intervals start
+        ### on whole multiples of the interval in unix time, so tables of different
+        ### pulls line up; the interval a block starts in only holds the samples
+        ### from there up to the next boundary
+        if self.t0 is None or abs(timestamp - (self.t0 + self.count/self.fs)) > len(data)/(2*self.fs):
+            k = int(np.floor(timestamp/self.interval + 0.5/self.nper))
+            if self.filled and k != self.k:
+                self.flush()
+            self.t0, self.count, self.k = timestamp, 0, k
+            self.room = self.filled + int(round(((k + 1)*self.interval - timestamp)*self.fs))
+            if self.room <= self.filled:
+                self.flush()
+                self.k = k + 1
+        self.count += len(data)
+        i = 0
+        if self.filled or self.room != self.nper:
+            i = min(self.room - self.filled, len(data))
+            self.pending[self.filled:self.filled+i] = data[:i]
+            self.filled += i
+            if self.filled == self.room:
+                self.flush()
+        k = (len(data) - i)//self.nper
+        if k:
+            blocks = data[i:i+k*self.nper].reshape(k, self.nper).astype(np.float64)
+            self._reduce(blocks, (self.k + np.arange(k))*self.interval)
+            self.k += k
+            i += k*self.nper
+        rest = len(data) - i
+        if rest:
+            self.pending[:rest] = data[i:]
+            self.filled = rest
+
+    def table(self):
+        return np.concatenate(self.rows) if self.rows else np.zeros(0, dtype=trendDtype)
+
+
+class TrendTable(object):
+    def __init__(self, names, labels=None, fs=16000, interval=1.0, scales=None):
+        self.names = list(names)
+        self.labels = list(labels) if labels is not None else ['']*len(self.names)
+        self.scales = list(scales) if scales is not None else [(1.0, 0.0)]*len(self.names)
+        self.fs = fs
+        self.interval = interval
+        self.channels = [_TrendChannel(int(round(interval*fs)), fs) for n in self.names]
+
+    def append(self, daqname, macropulse, timestamp, data):
+        if daqname in self.names:
+            self.channels[self.names.index(daqname)].append(timestamp, data)
+
+    ### rows of one channel at the base interval, or merged to a coarser one
+    def table(self, key, interval=None):
+        channel = self.channels[key if isinstance(key, int) else self.names.index(key)]
+        channel.flush()
+        rows = channel.table()
+        return rows if interval is None else rebin_trend(rows, interval)
+
+    ### writes the side table as .npz: per channel the base interval table and
+    ### one per extra interval (default per minute), plus names, labels, scales
+    def save(self, path, intervals=(60,)):
+        tables = {'names': np.array(self.names), 'labels': np.array(self.labels),
+                  'scales': np.array(self.scales, dtype=np.float64), 'intervals': np.array((self.interval,) + tuple(intervals))}
+        for i in range(len(self.names)):
+            tables[f'channel{i+1}_{self.interval:g}s'] = self.table(i)
+            for interval in intervals:
+                tables[f'channel{i+1}_{interval:g}s'] = self.table(i, interval)
+        np.savez(path, **tables)
+
+
+############################# QualityFlags ####################################
+### Data-quality pass run on the raw int16 blocks as they arrive. Every
+### `blocksize` stretch of the data is checked with a handful of vectorized
+### reductions (min, max, mean, std), `batch` stretches per call, for
+###   clip: samples sitting on the int16 rails
+###   flat: a constant block, i.e. a stuck or disconnected ADC
+###   gap:  the DAQ skipped frames (filled with zeros downstream)
+###   jump: the block mean moved by more than jump_threshold standard
+###         deviations (and at least min_jump counts) from the previous block
+### Flagged blocks are merged into (flag, t_start, t_stop) segments per channel,
+### which stay small even for days of data. A stretch shorter than blocksize
+### before a gap or at the end is checked on its own; segment_table(),
+### metadata() and summary() check whatever is still collected first.
+###############################################################################
+qualityFlagNames = ('clip', 'flat', 'gap', 'jump')
+
+
+class QualityFlags(object):
+    def __init__(self, names, fs=16000, blocksize=500, jump_threshold=8.0, min_jump=50, batch=64):
+        self.names = list(names)
+        self.fs = fs
+        self.blocksize = blocksize
+        self.jump_threshold = jump_threshold
+        self.min_jump = min_jump
+        self.batch = batch
+        self.segments = [[] for n in self.names]
+        self._expected = [None]*len(self.names)
+        self._previous = [None]*len(self.names)
+        self._last = [{} for n in self.names]
+        self._pending = [[] for n in self.names]   ### contiguous data not checked yet, from time _start
+        self._count = [0]*len(self.names)
+        self._start = [None]*len(self.names)
+
+    def _flag(self, i, flag, tstart, tstop):
+        last = self._last[i].get(flag)
+        if last is not None and tstart - last[2] < 0.5*self.blocksize/self.fs:
+            last[2] = float(tstop)
+        else:
+            self._last[i][flag] = [flag, float(tstart), float(tstop)]
+            self.segments[i].append(self._last[i][flag])
+
+    def append(self, daqname, macropulse, timestamp, data):
+        if daqname not in self.names:
+            return
+        i = self.names.index(daqname)
+        ### getdata() blocks are (1, n) images
+        data = np.ravel(data)
+        if len(data) == 0:
+            return
+        if self._expected[i] is not None and timestamp - self._expected[i] > 0.5*len(data)/self.fs:
+            self._check(i, final=True)
+            self._flag(i, 'gap', self._expected[i], timestamp)
+        self._expected[i] = timestamp + len(data)/self.fs
+        ### blocks are collected and checked `batch` at a time, so the reductions
+        ### run over a (blocks x blocksize) array instead of once per DAQ block
+        if not self._pending[i]:
+            self._start[i] = timestamp
+        self._pending[i].append(data)
+        self._count[i] += len(data)
+        if self._count[i] >= self.batch*self.blocksize:
+            self._check(i)
+
+    ### checks the whole blocks collected for channel i; the samples left over
+    ### wait for the next append, unless `final` (a gap or the end) checks them
+    ### as one short block
+    def _check(self, i, final=False):
+        if not self._pending[i]:
+            return
+        data = self._pending[i][0] if len(self._pending[i]) == 1 else np.concatenate(self._pending[i])
+        m = len(data)//self.blocksize
+        if m:
+            self._check_blocks(i, self._start[i], data[:m*self.blocksize].reshape(m, self.blocksize))
+        rest = data[m*self.blocksize:]
+        if final and len(rest):
+            self._check_blocks(i, self._start[i] + m*self.blocksize/self.fs, rest[np.newaxis, :])
+            rest = rest[:0]
+        self._pending[i] = [rest] if len(rest) else []
+        self._count[i] = len(rest)
+        self._start[i] += m*self.blocksize/self.fs
+
+    def _check_blocks(self, i, timestamp, blocks):
+        length = blocks.shape[1]/self.fs
+        low, high = blocks.min(axis=1), blocks.max(axis=1)
+        mean = blocks.mean(axis=1)
+        std = blocks.std(axis=1)
+        flags = {'clip': (low == -32768) | (high == 32767), 'flat': low == high}
+        prev_mean = np.r_[np.nan if self._previous[i] is None else self._previous[i][0], mean[:-1]]
+        prev_std = np.r_[np.nan if self._previous[i] is None else self._previous[i][1], std[:-1]]
+        with np.errstate(invalid='ignore'):
+            flags['jump'] = np.abs(mean - prev_mean) > np.maximum(self.min_jump, self.jump_threshold*np.maximum(std, prev_std))
+        self._previous[i] = (mean[-1], std[-1])
+        for flag in ('clip', 'flat', 'jump'):
+            for j in np.flatnonzero(flags[flag]):
+                self._flag(i, flag, timestamp + j*length, timestamp + (j + 1)*length)
+
+    ### checks everything still collected, including a last partial block
+    def flush(self):
+        for i in range(len(self.names)):
+            self._check(i, final=True)
+
+    ### segments of one channel as an N x 3 array of (flag index into qualityFlagNames, t_start, t_stop)
+    def segment_table(self, key):
+        self.flush()
+        segments = self.segments[key if isinstance(key, int) else self.names.index(key)]
+        return np.array([[qualityFlagNames.index(f), t0, t1] for f, t0, t1 in segments], dtype=np.float64).reshape(-1, 3)
+
+    ### extra .mat variables: the flag names and a channeln_quality segment table per channel
+    def metadata(self):
+        meta = {'quality_flags': ','.join(qualityFlagNames)}
+        for i in range(len(self.names)):
+            meta[f'channel{i+1}_quality'] = self.segment_table(i)
+        return meta
+
+    ### one line per channel: number of segments and flagged seconds per flag
+    def summary(self):
+        self.flush()
+        lines = []
+        for name, segments in zip(self.names, self.segments):
+            parts = []
+            for flag in qualityFlagNames:
+                found = [t1 - t0 for f, t0, t1 in segments if f == flag]
+                if found:
+                    parts.append(f"{flag}: {len(found)} segments, {sum(found):.2f} s")
+            lines.append(f"Data quality {name}: " + ("; ".join(parts) if parts else "no flags"))
+        return lines
+
+
+########################### QuantileSketch ####################################
+### Mergeable quantile sketch (KLL) of a stream of float values in O(k) memory,
+### whatever the length of the stream. Values are collected in levels where an
+### item of level h stands for 2**h values; a level over its capacity is
+### sorted and every other item (from a random offset) moves up one level.
+### Quantiles come with a rank error of about 1/k (k=1000: ~0.2 %), and two
+### sketches of parts of a stream merge into one of the whole stream. table()
+### and from_table() store a sketch as (value, weight) rows.
+###############################################################################
+class QuantileSketch(object):
+    def __init__(self, k=1000, seed=None):
+        self.k = k
+        self.levels = [np.zeros(0)]
+        self.count = 0
+        self.min = np.inf
+        self.max = -np.inf
+        self._rng = np.random.default_rng(seed)
+
+    def _capacity(self, h):
+        return max(2, int(np.ceil(self.k*(2/3)**(len(self.levels) - 1 - h))))
+
+    def update(self, values):
+        values = np.ravel(np.asarray(values, dtype=np.float64))
+        if len(values) == 0:
+            return
+        self.count += len(values)
+        self.min = min(self.min, values.min())
+        self.max = max(self.max, values.max())
+        self.levels[0] = np.concatenate([self.levels[0], values])
+        self._compress()
+
+    def _compress(self):
+        h = 0
+        while h < len(self.levels):
+            if len(self.levels[h]) > self._capacity(h):
+                if h + 1 == len(self.levels):
+                    self.levels.append(np.zeros(0))
+                items = np.sort(self.levels[h])
+                odd = len(items) % 2
+                self.levels[h] = items[len(items) - odd:]
+                promoted = items[self._rng.integers(2):len(items) - odd:2]
+                self.levels[h+1] = np.concatenate([self.levels[h+1], promoted])
+            h += 1
+
+    def merge(self, other):
+        while len(self.levels) < len(other.levels):
+            self.levels.append(np.zeros(0))
+        for h, items in enumerate(other.levels):
+            self.levels[h] = np.concatenate([self.levels[h], items])
+        self.count += other.count
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+        self._compress()
+        return self
+
+    ### (values, weights), sorted by value
+    def items(self):
+        values = np.concatenate(self.levels)
+        weights = np.concatenate([np.full(len(items), 2.0**h) for h, items in enumerate(self.levels)])
+        order = np.argsort(values, kind='stable')
+        return values[order], weights[order]
+
+    def quantile(self, q):
+        q = np.asarray(q, dtype=np.float64)
+        if self.count == 0:
+            return np.full(q.shape, np.nan)
+        values, weights = self.items()
+        cumulative = np.cumsum(weights)
+        out = values[np.minimum(np.searchsorted(cumulative, q*cumulative[-1], side='left'), len(values) - 1)]
+        return np.where(q <= 0, self.min, np.where(q >= 1, self.max, out))
+
+    def table(self):
+        values, weights = self.items()
+        return np.column_stack([values, weights])
+
+    @classmethod
+    def from_table(cls, table, k=1000):
+        sketch = cls(k)
+        table = np.asarray(table, dtype=np.float64).reshape(-1, 2)
+        for weight in np.unique(table[:, 1]):
+            h = int(round(np.log2(weight)))
+            while len(sketch.levels) <= h:
+                sketch.levels.append(np.zeros(0))
+            sketch.levels[h] = table[table[:, 1] == weight, 0]
+        sketch.count = int(table[:, 1].sum())
+        if len(table):
+            sketch.min, sketch.max = table[:, 0].min(), table[:, 0].max()
+        return sketch
+
+
+########################### AmplitudeStats ####################################
+### Amplitude distribution per channel over a whole pull, fed with the blocks
+### as they arrive like QualityFlags, in constant memory. Raw int16 blocks go
+### into an exact histogram with one counter per ADC code (65,536 counters,
+### 512 kB per channel, filled by np.bincount), float blocks (decimated,
+### filtered or read back from a file) into a QuantileSketch. Both merge
+### (merge()), so the statistics of several pulls combine into one.
+### quantiles() and histogram() are in raw units; summary() applies the
+### channel calibration. metadata() gives the .mat variables:
+###   amplitude_quantiles: the probabilities of amplitudeQuantiles
+###   channeln_amplitude_quantiles: the quantiles of channel n
+###   channeln_histogram: (ADC code, count) rows of the non-empty codes, or
+###   channeln_sketch: (value, weight) rows of the sketch, for float channels
+###############################################################################
+amplitudeQuantiles = (0.001, 0.01, 0.05, 0.25, 0.5, 0.75, 0.95, 0.99, 0.999)
+
+
+class AmplitudeStats(object):
+    def __init__(self, names, labels=None, scales=None, k=1000):
+        self.names = list(names)
+        self.labels = list(labels) if labels is not None else ['']*len(self.names)
+        self.scales = list(scales) if scales is not None else [(1.0, 0.0)]*len(self.names)
+        self.k = k
+        self.histograms = [None]*len(self.names)
+        self.sketches = [None]*len(self.names)
+
+    def _index(self, key):
+        return key if isinstance(key, int) else self.names.index(key)
+
+    def append(self, daqname, macropulse, timestamp, data):
+        if daqname not in self.names:
+            return
+        i = self.names.index(daqname)
+        data = np.asarray(data)
+        if data.dtype.kind in 'iu':
+            if self.histograms[i] is None:
+                self.histograms[i] = np.zeros(65536, dtype=np.int64)
+            ### offset binary: code -32768 is bin 0; counted over the block's own
+            ### range rather than all 65536 bins
+            codes = np.ravel(data).astype(np.int16).view(np.uint16) ^ 0x8000
+            if len(codes):
+                low = int(codes.min())
+                counts = np.bincount(codes - low)
+                self.histograms[i][low:low+len(counts)] += counts
+        else:
+            if self.sketches[i] is None:
+                self.sketches[i] = QuantileSketch(self.k)
+            self.sketches[i].update(data)
+
+    def merge(self, other):
+        for j, name in enumerate(other.names):
+            if name not in self.names:
+                self.names.append(name)
+                self.labels.append(other.labels[j])
+                self.scales.append(other.scales[j])
+                self.histograms.append(None)
+                self.sketches.append(None)
+            i = self.names.index(name)
+            if other.histograms[j] is not None:
+                self.histograms[i] = other.histograms[j].copy() if self.histograms[i] is None else self.histograms[i] + other.histograms[j]
+            if other.sketches[j] is not None:
+                if self.sketches[i] is None:
+                    self.sketches[i] = QuantileSketch(self.k)
+                self.sketches[i].merge(other.sketches[j])
+        return self
+
+    def count(self, key):
+        i = self._index(key)
+        histogram, sketch = self.histograms[i], self.sketches[i]
+        return (int(histogram.sum()) if histogram is not None else 0) + (sketch.count if sketch is not None else 0)
+
+    ### quantiles of one channel (exact from the histogram, inverted CDF)
+    def quantiles(self, key, q=amplitudeQuantiles):
+        i = self._index(key)
+        q = np.asarray(q, dtype=np.float64)
+        histogram = self.histograms[i]
+        if histogram is not None and histogram.any():
+            cumulative = np.cumsum(histogram)
+            ### ceil(q*N) in integers (q to 1e-9), so q*N landing on a whole number is not pushed up a rank
+            n = int(cumulative[-1])
+            rank = np.array([max(-(-int(round(x*10**9))*n // 10**9), 1) for x in q.ravel()]).reshape(q.shape)
+            return np.searchsorted(cumulative, rank, side='left').astype(np.float64) - 32768
+        if self.sketches[i] is not None:
+            return self.sketches[i].quantile(q)
+        return np.full(q.shape, np.nan)
+
+    ### (bin edges, counts) of one channel over the occupied range in at most
+    ### `bins` bins; int16 bins hold whole ADC codes, so the counts are exact
+    def histogram(self, key, bins=256):
+        i = self._index(key)
+        histogram = self.histograms[i]
+        if histogram is not None and histogram.any():
+            codes = np.flatnonzero(histogram)
+            low, high = codes[0], codes[-1] + 1
+            width = -(-(high - low)//bins)
+            counts = np.add.reduceat(histogram[low:high], np.arange(0, high - low, width))
+            return np.arange(low, low + (len(counts) + 1)*width, width, dtype=np.float64) - 32768, counts
+        if self.sketches[i] is not None and self.sketches[i].count:
+            values, weights = self.sketches[i].items()
+            counts, edges = np.histogram(values, bins, weights=weights)
+            return edges, counts
+        return np.zeros(1), np.zeros(0)
+
+    def metadata(self):
+        meta = {'amplitude_quantiles': np.array(amplitudeQuantiles)}
+        for i in range(len(self.names)):
+            meta[f'channel{i+1}_amplitude_quantiles'] = self.quantiles(i)
+            if self.histograms[i] is not None:
+                codes = np.flatnonzero(self.histograms[i])
+                meta[f'channel{i+1}_histogram'] = np.column_stack([codes - 32768, self.histograms[i][codes]]).astype(np.int64)
+            if self.sketches[i] is not None:
+                meta[f'channel{i+1}_sketch'] = self.sketches[i].table()
+        return meta
+
+    ### one line per channel: median, the 1-99 % and 0.1-99.9 % ranges, calibrated
+    def summary(self):
+        lines = []
+        for i, name in enumerate(self.names):
+            if not self.count(i):
+                lines.append(f"Amplitude {name}: no data")
+                continue
+            a, b = self.scales[i]
+            p = dict(zip(amplitudeQuantiles, a*self.quantiles(i) + b))
+            lines.append(f"Amplitude {name}: median {p[0.5]:.6g}, 1-99 % {p[0.01]:.6g} to {p[0.99]:.6g}, "
+                         f"0.1-99.9 % {p[0.001]:.6g} to {p[0.999]:.6g}")
+        return lines
+
+
+############################## rebin_trend ####################################
+### merges trend rows into intervals of `interval` seconds aligned to unix time
+###############################################################################
+def rebin_trend(rows, interval):
+    if len(rows) == 0:
+        return rows
+    bucket = np.floor(rows['t']/interval)
+    starts = np.flatnonzero(np.r_[True, bucket[1:] != bucket[:-1]])
+    out = np.empty(len(starts), dtype=trendDtype)
+    out['t'] = bucket[starts]*interval
+    out['n'] = np.add.reduceat(rows['n'], starts)
+    out['min'] = np.minimum.reduceat(rows['min'], starts)
+    out['max'] = np.maximum.reduceat(rows['max'], starts)
+    out['sum'] = np.add.reduceat(rows['sum'], starts)
+    out['sumsq'] = np.add.reduceat(rows['sumsq'], starts)
+    return out
+
+
+############################## load_trend #####################################
+### Reads one channel from one or more trend side tables (a list of paths or a
+### glob pattern), e.g. every daily file of several weeks, and returns the rows
+### in time order with the calibration applied: a dict of arrays t, min, max,
+### mean and rms. Only the small .npz tables are read, never the data files.
+###############################################################################
+def load_trend(paths, channel, interval=60):
+    import glob
+    if isinstance(paths, str):
+        paths = sorted(glob.glob(paths))
+    tables = []
+    for path in paths:
+        with np.load(path) as f:
+            names = list(f['names'])
+            if channel not in names:
+                continue
+            i = names.index(channel)
+            key = f'channel{i+1}_{interval:g}s'
+            rows = f[key] if key in f.files else rebin_trend(f[f'channel{i+1}_{f["intervals"][0]:g}s'], interval)
+            a, b = f['scales'][i]
+            tables.append((rows, a, b))
+    if not tables:
+        raise ValueError(f"no trend data for {channel} in {paths}")
+    t, low, high, mean, rms = [], [], [], [], []
+    for rows, a, b in tables:
+        n = np.maximum(rows['n'], 1)
+        mu = rows['sum']/n
+        t.append(rows['t'])
+        low.append(a*(rows['min'] if a >= 0 else rows['max']) + b)
+        high.append(a*(rows['max'] if a >= 0 else rows['min']) + b)
+        mean.append(a*mu + b)
+        ### RMS of a*x + b from the raw moments
+        rms.append(np.sqrt(np.maximum(a*a*rows['sumsq']/n + 2*a*b*mu + b*b, 0)))
+    t = np.concatenate(t)
+    order = np.argsort(t, kind='stable')
+    return {'t': t[order], 'min': np.concatenate(low)[order], 'max': np.concatenate(high)[order],
+            'mean': np.concatenate(mean)[order], 'rms': np.concatenate(rms)[order]}
+
+
+########################### TriggeredCapture ##################################
+### Event-windowed capture: instead of keeping the whole range, only windows of
+### `pre` seconds before to `post` seconds after a trigger are kept, from all
+### channels. The trigger is a threshold crossing on one channel (calibrated
+### with its a*x + b scale), found per block with a vectorized test:
+###   edge='rising': x goes from < threshold to >= threshold
+###   edge='falling': x goes from > threshold to <= threshold (e.g. lock loss)
+###   edge='either': any of the two
+### A trigger inside an open window extends it (retrigger), so bursts give one
+### window with several trigger times, up to `max_window` seconds; after that
+### a trigger opens a new (overlapping) window. Each channel keeps only `pre` seconds
+### of history (plus whatever the trigger channel lags behind, at most `stall`
+### seconds), so memory does not grow with the range. Samples are placed by
+### timestamp, DAQ holes stay zero. Every finished window is handed to
+### sink(event), with event a dict
+###   {'t_start', 't_stop', 'triggers': [trigger times], 'datas': [int16 arrays]}
+### as soon as all channels have passed its end; flush() ends the open ones.
+### A channel more than `stall` seconds (of data time) behind the others is
+### taken as stalled and not waited for: its part of the windows stays zero.
+###############################################################################
+class _CaptureEvent(object):
+    def __init__(self, start, stop, nchannels):
+        self.start = start
+        self.stop = stop
+        self.triggers = []
+        self._data = [np.zeros(stop - start, dtype=np.int16) for i in range(nchannels)]
+
+    ### retriggering grows the window; capacity doubles like ChannelBuffer
+    def extend(self, stop):
+        if stop - self.start > len(self._data[0]):
+            size = max(2*len(self._data[0]), stop - self.start)
+            self._data = [np.concatenate([d, np.zeros(size - len(d), dtype=np.int16)]) for d in self._data]
+        self.stop = max(self.stop, stop)
+
+    def fill(self, c, start, block):
+        lo, hi = max(start, self.start), min(start + len(block), self.stop)
+        if lo < hi:
+            self._data[c][lo-self.start:hi-self.start] = block[lo-start:hi-start]
+
+    @property
+    def datas(self):
+        return [d[:self.stop-self.start] for d in self._data]
+
+
+class TriggeredCapture(object):
+    edges = ('rising', 'falling', 'either')
+
+    def __init__(self, names, trigger, threshold, pre=1.0, post=1.0, edge='rising', fs=16000, scale=(1.0, 0.0),
+                 max_window=60.0, sink=None, stall=10.0):
+        if edge not in self.edges:
+            raise ValueError(f"trigger edge must be one of {self.edges}, not '{edge}'")
+        self.names = list(names)
+        self.trigger = self.names.index(trigger)
+        self.threshold = threshold
+        self.pre = int(round(pre*fs))
+        self.post = int(round(post*fs))
+        self.max_window = max(int(round(max_window*fs)), self.pre + self.post)
+        self.edge = edge
+        self.fs = fs
+        self.scale = scale
+        self.sink = sink
+        self.stall = int(round(stall*fs))
+        self.t0 = None
+        self.history = [[] for n in self.names]        ### (start index, block) per channel
+        self.received = [0]*len(self.names)            ### sample index after the last block per channel
+        self.previous = None                           ### last calibrated sample of the trigger channel
+        self.open = []
+        self.count = 0
+
+    def append(self, daqname, macropulse, timestamp, data):
+        if daqname not in self.names or len(data) == 0:
+            return
+        c = self.names.index(daqname)
+        if self.t0 is None:
+            self.t0 = timestamp
+        start = int(round((timestamp - self.t0)*self.fs))
+        self.history[c].append((start, data))
+        self.received[c] = max(self.received[c], start + len(data))
+        for event in self.open:
+            event.fill(c, start, data)
+        if c == self.trigger:
+            for k in self._crossings(data):
+                self._trigger(start + k)
+        ### later triggers start at or after the trigger channel's last block (or
+        ### where it stalled), so older history is not needed
+        latest = max(self.received)
+        horizon = max(self.received[self.trigger], latest - self.stall) - self.pre
+        blocks = self.history[c]
+        while blocks and blocks[0][0] + len(blocks[0][1]) <= horizon:
+            blocks.pop(0)
+        self._emit(min(r for r in self.received if r >= latest - self.stall))
+
+    def _crossings(self, data):
+        a, b = self.scale
+        x = calibrate(data, a, b)
+        before = np.r_[x[0] if self.previous is None else self.previous, x[:-1]]
+        self.previous = x[-1]
+        rising = (before < self.threshold) & (x >= self.threshold)
+        falling = (before > self.threshold) & (x <= self.threshold)
+        hits = rising if self.edge == 'rising' else falling if self.edge == 'falling' else rising | falling
+        return np.flatnonzero(hits)
+
+    def _trigger(self, k):
+        if self.open and k - self.pre <= self.open[-1].stop and k + self.post - self.open[-1].start <= self.max_window:
+            event = self.open[-1]
+            old_stop = event.stop
+            event.extend(k + self.post)
+            fill_from = old_stop
+        else:
+            event = _CaptureEvent(max(k - self.pre, 0), k + self.post, len(self.names))
+            self.open.append(event)
+            fill_from = event.start
+        event.triggers.append(float(self.t0 + k/self.fs))
+        for c, blocks in enumerate(self.history):
+            for s, b in blocks:
+                if s + len(b) > fill_from:
+                    event.fill(c, s, b)
+
+    def _emit(self, done):
+        while self.open and self.open[0].stop <= done:
+            self._hand_over(self.open.pop(0))
+
+    def _hand_over(self, event):
+        self.count += 1
+        if self.sink is not None:
+            self.sink({'t_start': float(self.t0 + event.start/self.fs), 't_stop': float(self.t0 + event.stop/self.fs),
+                       'triggers': event.triggers, 'datas': event.datas})
+
+    ### hands over the windows still open at the end of the range, cut to the data received
+    def flush(self):
+        end = max(self.received)
+        for event in self.open:
+            event.stop = max(min(event.stop, end), event.start)
+            self._hand_over(event)
+        self.open = []
+
+
+############################ memory helpers ###################################
+### current_rss_mb / peak_rss_mb: resident memory of this process in MB.
+### estimate_memory_mb: projected extra memory of an in-memory pull of
+### `seconds` of data: the raw int16 channels, the float copies made while
+### decimating `workers` channels at once, and the decimated output.
+###############################################################################
+def current_rss_mb():
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1])*os.sysconf('SC_PAGE_SIZE')/1e6
+    except (OSError, ValueError, AttributeError):
+        return peak_rss_mb()
+
+
+def peak_rss_mb():
+    import resource
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak/1e6 if sys.platform == 'darwin' else peak/1e3
+
+
+def estimate_memory_mb(nchannels, seconds, factor=1, dtype=None, fs=16000, workers=1):
+    samples = seconds*fs
+    itemsize = np.dtype(dtype or floatDtype).itemsize
+    raw = nchannels*samples*2
+    decimating = 2*min(workers, nchannels)*samples*itemsize if factor > 1 else 0
+    output = nchannels*samples/factor*itemsize if factor > 1 else 0
+    return (raw + decimating + output)/1e6
+
+
+######################### AcquisitionStats ####################################
+### Counters and per-stage timers for the acquisition path, replacing the
+### per-event prints. Stages are timed with
+###     with stats.stage('convert'):
+###         ...
+### and counts added with stats.add(samples=500). 'summarize' covers the side
+### tables computed per block. report() hands a one line summary (events/s,
+### samples/s, MB/s, empty poll ratio) to the reporter callback at most once
+### every `interval` seconds, so it is cheap to call for every block;
+### save_json() writes the full summary at the end of a pull.
+###############################################################################
+class AcquisitionStats(object):
+    stages = ('poll', 'convert', 'buffer', 'summarize', 'decimate', 'filter', 'write')
+
+    def __init__(self, reporter=None, interval=5.0):
+        self.reporter = reporter
+        self.interval = interval
+        self.timers = {name: 0.0 for name in self.stages}
+        self.counts = {'polls': 0, 'empty_polls': 0, 'events': 0, 'blocks': 0, 'samples': 0, 'bytes': 0}
+        self.started = time.perf_counter()
+        self._last_report = self.started
+
+    @contextmanager
+    def stage(self, name):
+        t = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.timers[name] = self.timers.get(name, 0.0) + time.perf_counter() - t
+
+    def add(self, **counts):
+        for key, value in counts.items():
+            self.counts[key] = self.counts.get(key, 0) + value
+
+    def summary(self):
+        elapsed = max(time.perf_counter() - self.started, 1e-9)
+        return {'elapsed_s': elapsed,
+                'counts': dict(self.counts),
+                'stage_s': dict(self.timers),
+                'events_per_s': self.counts['events']/elapsed,
+                'samples_per_s': self.counts['samples']/elapsed,
+                'bytes_per_s': self.counts['bytes']/elapsed,
+                'empty_poll_ratio': self.counts['empty_polls']/max(self.counts['polls'], 1),
+                'peak_rss_mb': peak_rss_mb()}
+
+    def format(self):
+        s = self.summary()
+        busiest = max(s['stage_s'], key=s['stage_s'].get)
+        return (f"{s['counts']['events']} events in {s['elapsed_s']:.1f} s: {s['events_per_s']:.1f} events/s, "
+                f"{s['samples_per_s']:.0f} samples/s, {s['bytes_per_s']/1e6:.2f} MB/s, "
+                f"empty polls {100*s['empty_poll_ratio']:.0f}%, most time in '{busiest}' ({s['stage_s'][busiest]:.1f} s)")
+
+    def report(self, force=False):
+        now = time.perf_counter()
+        if self.reporter is not None and (force or now - self._last_report >= self.interval):
+            self._last_report = now
+            self.reporter(self.format())
+
+    def save_json(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.summary(), f, indent=2)
+
+
+######################### CheckpointedSpill ###################################
+### Writes the raw int16 blocks of an acquisition straight to one file per
+### channel in a "partial" directory, and periodically records a checkpoint:
+### for each channel the last macropulse and timestamp written and the number
+### of samples and blocks committed. If the pull dies (or the machine restarts), creating
+### a CheckpointedSpill again with the same key picks up from the checkpoint:
+### anything written after the last checkpoint is truncated away,
+### resume_groups() gives the times to reconnect from, and write() drops blocks
+### that were already committed, so completed intervals are never fetched twice.
+### As in RecordingBuilder, a block later than expected by more than half a
+### block is preceded by zeros for the frames the DAQ skipped (noted in the
+### channel's 'gaps'), so sample k of a channel file is at first + k/fs, and
+### align() finally cuts the files to the time span all channels share.
+###############################################################################
+class CheckpointedSpill(object):
+    def __init__(self, directory, chans, key, interval=60.0, fs=16000):
+        self.directory = directory
+        self.chans = list(chans)
+        self.key = hashlib.sha1(key.encode()).hexdigest()
+        self.interval = interval
+        self.fs = fs
+        self.state_path = os.path.join(directory, 'checkpoint.json')
+        os.makedirs(directory, exist_ok=True)
+        self.channels = {c: {'macropulse': None, 'timestamp': None, 'samples': 0, 'blocks': 0, 'first': None, 'gaps': []}
+                         for c in self.chans}
+        self.resumed = False
+        if os.path.exists(self.state_path):
+            with open(self.state_path) as f:
+                state = json.load(f)
+            if state['key'] == self.key:
+                self.channels = state['channels']
+                for c in self.chans:
+                    self.channels[c].setdefault('gaps', [])
+                    self.channels[c].setdefault('blocks', 0)
+                self.resumed = True
+        self.files = {}
+        for i, c in enumerate(self.chans):
+            path = self.channel_path(i)
+            if not os.path.exists(path):
+                open(path, 'wb').close()
+            os.truncate(path, 2*self.channels[c]['samples'])
+            self.files[c] = open(path, 'ab')
+        self._last_checkpoint = time.monotonic()
+        self.checkpoint()
+
+    def channel_path(self, i):
+        return os.path.join(self.directory, f'channel{i+1}.int16')
+
+    ### where to reconnect from, as (start timestamp, channels) pairs: channels
+    ### that committed something continue from the oldest of their last
+    ### timestamps, channels that did not from `start`, the start of the range
+    def resume_groups(self, start):
+        done = [c for c in self.chans if self.channels[c]['timestamp'] is not None]
+        fresh = [c for c in self.chans if c not in done]
+        groups = [(start, fresh)] if fresh else []
+        if done:
+            groups.append((min(self.channels[c]['timestamp'] for c in done), done))
+        return groups
+
+    def write(self, daqname, macropulse, timestamp, data):
+        state = self.channels[daqname]
+        if state['macropulse'] is not None and macropulse <= state['macropulse']:
+            return False
+        if state['first'] is None:
+            state['first'] = float(timestamp)
+        else:
+            missing = _gap_length(state['first'], state['samples'], timestamp, len(data), self.fs)
+            if missing:
+                ### (start sample, length, timestamp of the block after the hole)
+                state['gaps'].append([state['samples'], missing, float(timestamp)])
+                np.zeros(missing, dtype=np.int16).tofile(self.files[daqname])
+                state['samples'] += missing
+        np.asarray(data, dtype=np.int16).tofile(self.files[daqname])
+        state['macropulse'] = int(macropulse)
+        state['timestamp'] = float(timestamp)
+        state['samples'] += len(data)
+        state['blocks'] += 1
+        if time.monotonic() - self._last_checkpoint >= self.interval:
+            self.checkpoint()
+        return True
+
+    ### macropulses committed over all runs of the job, counted like AcquisitionStats
+    ### (one per macropulse, whichever channels it carried)
+    @property
+    def events(self):
+        return max(state['blocks'] for state in self.channels.values())
+
+    def checkpoint(self):
+        for f in self.files.values():
+            f.flush()
+            os.fsync(f.fileno())
+        tmp = self.state_path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump({'key': self.key, 'channels': self.channels}, f)
+        os.replace(tmp, self.state_path)
+        self._last_checkpoint = time.monotonic()
+
+    def close(self):
+        if self.files:
+            self.checkpoint()
+            for f in self.files.values():
+                f.close()
+            self.files = {}
+
+    ### reads channel i back as (timestamp, data) pieces of at most `chunk`
+    ### samples, leaving out the zero-filled holes. Each contiguous run is timed
+    ### from the timestamp of its first block, and its first piece is one DAQ
+    ### block (`head` samples) long, so that consumers judging gaps against the
+    ### block length (side tables) see the holes just as they did live
+    def runs(self, i, chunk=1 << 20, head=500):
+        state = self.channels[self.chans[i]]
+        if state['first'] is None:
+            return
+        starts = [(0, state['first'])] + [(s + m, t) for s, m, t in state['gaps']]
+        stops = [s for s, m, t in state['gaps']] + [state['samples']]
+        with open(self.channel_path(i), 'rb') as f:
+            for (start, t), stop in zip(starts, stops):
+                f.seek(2*start)
+                k = start
+                while k < stop:
+                    n = min(head if k == start else chunk, stop - k)
+                    yield t + (k - start)/self.fs, np.fromfile(f, dtype=np.int16, count=n)
+                    k += n
+
+    ### closes the spill and cuts the channel files to the time span they have in
+    ### common, like RecordingBuilder.build(). Returns (t0, samples, gaps, missing):
+    ### gaps as (channel index, start, length) in the aligned files, and the
+    ### channels that got no data at all, which are zero over the whole span
+    def align(self, chunk=1 << 20):
+        self.close()
+        states = [self.channels[c] for c in self.chans]
+        t0, offsets, n = _common_span([s['first'] for s in states], [s['samples'] for s in states], self.fs)
+        for i, (state, offset) in enumerate(zip(states, offsets)):
+            if state['first'] is None or (offset == 0 and state['samples'] == n):
+                continue
+            path = self.channel_path(i)
+            if offset:
+                with open(path, 'rb') as src, open(path + '.tmp', 'wb') as dst:
+                    src.seek(2*offset)
+                    for k in range(0, n, chunk):
+                        np.fromfile(src, dtype=np.int16, count=min(chunk, n - k)).tofile(dst)
+                os.replace(path + '.tmp', path)
+            else:
+                os.truncate(path, 2*n)
+            state['gaps'] = [[s - offset, m, t] for s, m, t in state['gaps'] if 0 <= s - offset < n]
+            state['first'] += offset/self.fs
+            state['samples'] = n
+            self.checkpoint()
+        gaps = [(i, s, min(m, n - s)) for i, state in enumerate(states) if state['first'] is not None
+                for s, m, t in state['gaps']]
+        missing = [c for c, state in zip(self.chans, states) if state['first'] is None]
+        gaps += [(self.chans.index(c), 0, n) for c in missing if n]
+        self.t0, self.nsamples = t0, n
+        return t0, n, sorted(gaps), missing
+
+    ### the aligned channels, for streaming: the file of every channel that has
+    ### data, and a read-only array of zeros (no memory) for the others
+    def aligned_paths(self):
+        return [self.channel_path(i) if self.channels[c]['first'] is not None
+                else np.broadcast_to(np.int16(0), (self.nsamples,)) for i, c in enumerate(self.chans)]
+
+    ### the aligned channels as read-only memory maps, in the order of chans
+    def arrays(self):
+        return [np.memmap(self.channel_path(i), dtype=np.int16, mode='r') if self.channels[c]['first'] is not None and self.nsamples
+                else np.zeros(self.nsamples, dtype=np.int16) for i, c in enumerate(self.chans)]
+
+    def remove(self):
+        self.close()
+        shutil.rmtree(self.directory)
+
+
+############################### Archive #######################################
+### Time-partitioned local archive. Raw int16 samples are written into fixed
+### duration chunk files per channel (hourly by default, UTC), e.g.
+###     <root>/ALPS.DIAG_ALPS.ADC.NR_CH_1.03/20220103T020000.int16
+### and every contiguous run of samples in a chunk file is one row of the
+### compact index <root>/index.csv:
+###     channel, t_start, t_stop, file, offset (samples into the file)
+### append() has the same signature as the other side tables, so a pull can be
+### archived as it streams. Only the parts of a block not yet in the archive
+### are written, so pulling a range twice (or resuming) does not duplicate
+### data, and holes and earlier ranges can be backfilled later. The index is
+### rewritten atomically every `interval` seconds and on close(), under a lock
+### and merged with the rows on disk, so several processes can archive into
+### the same root; chunk files are locked while a block is appended.
+### query(channel, t_start, t_stop) reads the index, opens only the chunk files
+### overlapping the range and reads just the needed samples with file offsets.
+###############################################################################
+archiveIndexFields = ('channel', 't_start', 't_stop', 'file', 'offset')
+
+
+@contextmanager
+def _file_lock(path):
+    with open(path, 'w') as f:
+        try:
+            import fcntl
+            fcntl.flock(f, fcntl.LOCK_EX)
+        except ImportError:
+            pass
+        yield
+
+
+class Archive(object):
+    def __init__(self, root, chunk=3600, fs=16000, interval=60.0):
+        self.root = root
+        self.chunk = chunk
+        self.fs = fs
+        self.interval = interval
+        self.index_path = os.path.join(root, 'index.csv')
+        os.makedirs(root, exist_ok=True)
+        self.rows = {}              ### channel -> index rows sorted by t_start (they never overlap)
+        self.starts = {}            ### channel -> their t_start, for bisect
+        self._merge(self._read_index())
+        self.open_rows = {}         ### channel -> index row still being extended
+        self._last_flush = time.monotonic()
+
+    def _read_index(self):
+        if not os.path.exists(self.index_path):
+            return []
+        with open(self.index_path, newline='') as f:
+            return [{'channel': row['channel'], 't_start': float(row['t_start']), 't_stop': float(row['t_stop']),
+                     'file': row['file'], 'offset': int(row['offset'])} for row in csv.DictReader(f)]
+
+    ### adds rows written by other processes; a row is known by its place in a chunk file
+    def _merge(self, rows):
+        known = {(r['file'], r['offset']): r for channel in self.rows for r in self.rows[channel]}
+        for row in rows:
+            mine = known.get((row['file'], row['offset']))
+            if mine is None:
+                self._add_row(row)
+            elif row['t_stop'] > mine['t_stop']:
+                mine['t_stop'] = row['t_stop']
+
+    def chunk_file(self, channel, t):
+        start = np.floor(t/self.chunk)*self.chunk
+        name = time.strftime('%Y%m%dT%H%M%S', time.gmtime(start))
+        return os.path.join(channel.replace('/', '_'), name + '.int16'), start
+
+    def _add_row(self, row):
+        starts = self.starts.setdefault(row['channel'], [])
+        i = bisect.bisect(starts, row['t_start'])
+        starts.insert(i, row['t_start'])
+        self.rows.setdefault(row['channel'], []).insert(i, row)
+
+    ### whether any archived row of `channel` overlaps [t_start, t_stop): rows
+    ### are sorted and disjoint, so only the last one starting before t_stop can
+    def covered(self, channel, t_start, t_stop):
+        i = bisect.bisect_left(self.starts.get(channel, []), t_stop)
+        return i > 0 and self.rows[channel][i-1]['t_stop'] > t_start
+
+    ### the parts of [t_start, t_stop) no archived row of `channel` covers, as (start, stop) pairs
+    def uncovered(self, channel, t_start, t_stop):
+        starts = self.starts.get(channel, [])
+        rows = self.rows.get(channel, [])
+        ranges, t = [], t_start
+        for row in rows[max(bisect.bisect_right(starts, t_start) - 1, 0):bisect.bisect_left(starts, t_stop)]:
+            if row['t_stop'] <= t:
+                continue
+            if row['t_start'] > t:
+                ranges.append((t, row['t_start']))
+            t = max(t, row['t_stop'])
+            if t >= t_stop:
+                break
+        if t < t_stop:
+            ranges.append((t, t_stop))
+        return ranges
+
+    def append(self, daqname, macropulse, timestamp, data):
+        if len(data) == 0:
+            return
+        for a, b in self.uncovered(daqname, timestamp, timestamp + len(data)/self.fs):
+            ### on the block's sample grid; timestamp jitter of under half a sample
+            ### against the neighbouring rows rounds away
+            lo, hi = int(round((a - timestamp)*self.fs)), int(round((b - timestamp)*self.fs))
+            i = lo
+            while i < hi:
+                t = timestamp + i/self.fs
+                name, start = self.chunk_file(daqname, t)
+                n = min(hi - i, max(int(round((start + self.chunk - t)*self.fs)), 1))
+                self._write(daqname, name, t, data[i:i+n])
+                i += n
+        if time.monotonic() - self._last_flush >= self.interval:
+            self.flush()
+
+    def _write(self, channel, name, t, block):
+        path = os.path.join(self.root, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'ab') as f:
+            try:
+                import fcntl
+                fcntl.flock(f, fcntl.LOCK_EX)
+            except ImportError:
+                pass
+            offset = f.seek(0, os.SEEK_END)//2
+            np.asarray(block, dtype=np.int16).tofile(f)
+        row = self.open_rows.get(channel)
+        t_stop = t + len(block)/self.fs
+        if (row is not None and row['file'] == name and abs(row['t_stop'] - t) < 0.5*len(block)/self.fs
+                and row['offset'] + int(round((row['t_stop'] - row['t_start'])*self.fs)) == offset):
+            row['t_stop'] = t_stop
+        else:
+            row = {'channel': channel, 't_start': t, 't_stop': t_stop, 'file': name, 'offset': offset}
+            self._add_row(row)
+            self.open_rows[channel] = row
+
+    def flush(self):
+        with _file_lock(self.index_path + '.lock'):
+            self._merge(self._read_index())
+            tmp = self.index_path + f'.{os.getpid()}.tmp'
+            with open(tmp, 'w', newline='') as f:
+                writer = csv.DictWriter(f, fieldnames=archiveIndexFields)
+                writer.writeheader()
+                for row in (row for channel in sorted(self.rows) for row in self.rows[channel]):
+                    writer.writerow({k: repr(v) if isinstance(v, float) else v for k, v in row.items()})
+            os.replace(tmp, self.index_path)
+        self._last_flush = time.monotonic()
+
+    def close(self):
+        self.flush()
+        self.open_rows = {}
+
+    def channels(self):
+        return sorted(self.rows)
+
+    ### index rows of `channel` overlapping [t_start, t_stop), in time order
+    def segments(self, channel, t_start, t_stop):
+        rows = self.rows.get(channel, [])
+        i = max(bisect.bisect_left(self.starts.get(channel, []), t_start) - 1, 0)
+        j = bisect.bisect_left(self.starts.get(channel, []), t_stop)
+        return [r for r in rows[i:j] if r['t_stop'] > t_start]
+
+    ### samples of `channel` from t_start to t_stop (seconds since the epoch) on
+    ### the archive's sample grid, as (t0, int16 array); holes are zero
+    def query(self, channel, t_start, t_stop):
+        n = int(round((t_stop - t_start)*self.fs))
+        out = np.zeros(max(n, 0), dtype=np.int16)
+        for row in self.segments(channel, t_start, t_stop):
+            first = int(round((row['t_start'] - t_start)*self.fs))
+            length = int(round((row['t_stop'] - row['t_start'])*self.fs))
+            lo, hi = max(first, 0), min(first + length, n)
+            if lo >= hi:
+                continue
+            with open(os.path.join(self.root, row['file']), 'rb') as f:
+                f.seek(2*(row['offset'] + lo - first))
+                block = np.fromfile(f, dtype=np.int16, count=hi - lo)
+            out[lo:lo+len(block)] = block
+        return t_start, out
+
+
+########################### shared recordings #################################
+### Local shared-memory bus for handing a Recording from one process to another
+### (e.g. from alpsdoocs_save.py to alpsdoocs_analyze.py) without writing it to
+### disk. The (channels x samples) array lives in a named shared memory block,
+### and its metadata (shape, dtype, fs, t0, names, labels, gaps, scales) in
+### <sharedBusDir>/<name>.json, which also lists the pids holding a reference.
+###     shared = publish_recording(builder_or_recording, 'run42')    # process A
+###     shared = attach_recording('run42')                          # process B
+###     plot(shared.recording.channel(0)); shared.release()
+### attach_recording() maps the block zero-copy. Every publish/attach adds a
+### reference and release() drops it; the last release unlinks the block and
+### the metadata. References of processes that died without releasing are
+### dropped by cleanup_shared_recordings(), run on every publish/list.
+### Publishing a RecordingBuilder builds straight into shared memory, so a
+### fresh pull is never held twice.
+###############################################################################
+sharedBusDir = os.path.join(tempfile.gettempdir(), 'alpsdoocs_bus')
+
+
+def _open_shared_memory(name, create=False, size=0):
+    from multiprocessing import shared_memory, resource_tracker
+    try:
+        return shared_memory.SharedMemory(name=name, create=create, size=size, track=False)
+    except TypeError:
+        ### Python < 3.13 always tracks the block and unlinks it when this process
+        ### exits, even if others still use it; the reference count here decides
+        shm = shared_memory.SharedMemory(name=name, create=create, size=size)
+        resource_tracker.unregister(shm._name, 'shared_memory')
+        return shm
+
+
+def _bus_lock(name):
+    os.makedirs(sharedBusDir, exist_ok=True)
+    return _file_lock(os.path.join(sharedBusDir, name + '.lock'))
+
+
+def _bus_meta_path(name):
+    return os.path.join(sharedBusDir, name + '.json')
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except OSError:
+        pass
+    return True
+
+
+class SharedRecording(object):
+    def __init__(self, name, shm, recording):
+        self.name = name
+        self.shm = shm
+        self.recording = recording
+
+    def release(self):
+        if self.shm is None:
+            return
+        self.recording = None
+        with _bus_lock(self.name):
+            meta = _read_bus_meta(self.name)
+            if meta is not None and os.getpid() in meta['holders']:
+                meta['holders'].remove(os.getpid())
+                _write_bus_meta(self.name, meta)
+            last = meta is None or not meta['holders']
+            try:
+                self.shm.close()
+            except BufferError:
+                pass        ### views still in use here; the mapping goes when they do
+            if last:
+                _unlink_shared(self.name, self.shm)
+        self.shm = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+
+
+def _read_bus_meta(name):
+    try:
+        with open(_bus_meta_path(name)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _write_bus_meta(name, meta):
+    tmp = _bus_meta_path(name) + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(meta, f)
+    os.replace(tmp, _bus_meta_path(name))
+
+
+def _unlink_shared(name, shm=None):
+    from multiprocessing import resource_tracker
+    try:
+        shm = shm or _open_shared_memory('alpsdoocs_' + name)
+        if not hasattr(shm, '_track'):
+            ### before 3.13 unlink() also unregisters from the tracker, which _open_shared_memory already did
+            resource_tracker.register(shm._name, 'shared_memory')
+        shm.unlink()
+    except FileNotFoundError:
+        pass
+    try:
+        os.remove(_bus_meta_path(name))
+    except FileNotFoundError:
+        pass
+
+
+def publish_recording(recording, name):
+    cleanup_shared_recordings()
+    with _bus_lock(name):
+        if _read_bus_meta(name) is not None:
+            raise FileExistsError(f"a shared recording '{name}' is already published")
+    blocks = []
+
+    def allocate(shape, dtype):
+        size = max(int(np.prod(shape))*np.dtype(dtype).itemsize, 1)
+        blocks.append(_open_shared_memory('alpsdoocs_' + name, create=True, size=size))
+        return np.ndarray(shape, dtype=dtype, buffer=blocks[0].buf)
+
+    if isinstance(recording, RecordingBuilder):
+        recording = recording.build(allocate)
+    else:
+        data = allocate(recording.data.shape, recording.data.dtype)
+        data[...] = recording.data
+        recording = Recording(data, recording.fs, recording.t0, recording.names, recording.labels, recording.gaps,
+                              recording.scale_a, recording.scale_b)
+    meta = {'shm': 'alpsdoocs_' + name, 'shape': list(recording.data.shape), 'dtype': recording.data.dtype.str,
+            'fs': recording.fs, 't0': recording.t0, 'names': recording.names, 'labels': recording.labels,
+            'gaps': [list(map(int, g)) for g in recording.gaps], 'scale_a': recording.scale_a.tolist(),
+            'scale_b': recording.scale_b.tolist(), 'holders': [os.getpid()], 'published': time.time()}
+    with _bus_lock(name):
+        _write_bus_meta(name, meta)
+    return SharedRecording(name, blocks[0], recording)
+
+
+def attach_recording(name):
+    with _bus_lock(name):
+        meta = _read_bus_meta(name)
+        if meta is None:
+            raise KeyError(f"no shared recording '{name}'")
+        shm = _open_shared_memory(meta['shm'])
+        meta['holders'].append(os.getpid())
+        _write_bus_meta(name, meta)
+    data = np.ndarray(meta['shape'], dtype=np.dtype(meta['dtype']), buffer=shm.buf)
+    recording = Recording(data, meta['fs'], meta['t0'], meta['names'], meta['labels'],
+                          [tuple(g) for g in meta['gaps']], meta['scale_a'], meta['scale_b'])
+    return SharedRecording(name, shm, recording)
+
+
+### drops the references of processes that no longer exist and frees the
+### recordings nobody holds any more
+def cleanup_shared_recordings():
+    if not os.path.isdir(sharedBusDir):
+        return
+    for entry in os.listdir(sharedBusDir):
+        if not entry.endswith('.json'):
+            continue
+        name = entry[:-len('.json')]
+        with _bus_lock(name):
+            meta = _read_bus_meta(name)
+            if meta is None:
+                continue
+            holders = [pid for pid in meta['holders'] if _pid_alive(pid)]
+            if not holders:
+                _unlink_shared(name)
+            elif holders != meta['holders']:
+                meta['holders'] = holders
+                _write_bus_meta(name, meta)
+
+
+### names of the published recordings with their metadata
+def list_shared_recordings():
+    cleanup_shared_recordings()
+    if not os.path.isdir(sharedBusDir):
+        return {}
+    metas = {entry[:-len('.json')]: _read_bus_meta(entry[:-len('.json')])
+             for entry in sorted(os.listdir(sharedBusDir)) if entry.endswith('.json')}
+    return {name: meta for name, meta in metas.items() if meta is not None}
+
+
+############################ PollScheduler ####################################
+### Decides how long to wait between pydaq.getdata() polls and when to give up.
+### After a block arrives the next poll is immediate, so bursts are drained
+### without delay. Each empty poll doubles the wait, from min_sleep up to half
+### the expected macropulse period (500 samples at 16 kHz = 31.25 ms), so an
+### idle DAQ costs a few polls per macropulse instead of a spinning core.
+### The pull is complete once data has been seen up to the stop time, and the
+### polling loops stop right there (reached_stop) instead of waiting for the
+### server to end the stream; it is given up when nothing has arrived for
+### idle_timeout seconds, independent of how long the requested range is.
+### After the pull, `completed`, `reason` and `last_timestamp` say how far
+### it got.
+###############################################################################
+class PollScheduler(object):
+    def __init__(self, stop_timestamp=None, period=500/16000, idle_timeout=300.0, min_sleep=0.0005):
+        self.stop_timestamp = stop_timestamp
+        self.period = period
+        self.idle_timeout = idle_timeout
+        self.min_sleep = min_sleep
+        self.max_sleep = max(period/2, min_sleep)
+        self.sleep = 0.0
+        self.last_timestamp = None
+        self.last_data = time.monotonic()
+        self.reason = 'interrupted'
+
+    def got_data(self, timestamp):
+        self.sleep = 0.0
+        self.last_data = time.monotonic()
+        if self.last_timestamp is None or timestamp > self.last_timestamp:
+            self.last_timestamp = timestamp
+
+    def empty(self):
+        self.sleep = min(max(2*self.sleep, self.min_sleep), self.max_sleep)
+        return self.sleep
+
+    def expired(self):
+        return time.monotonic() - self.last_data > self.idle_timeout
+
+    ### whether the last block seen ends at or after the stop time
+    def reached_stop(self):
+        return (self.stop_timestamp is not None and self.last_timestamp is not None
+                and self.last_timestamp + self.period >= self.stop_timestamp)
+
+    def finish(self, reason):
+        self.reason = reason
+
+    @property
+    def completed(self):
+        if self.stop_timestamp is None:
+            return self.reason == 'end of data'
+        return self.last_timestamp is not None and self.last_timestamp + 2*self.period >= self.stop_timestamp
+
+    def describe(self):
+        if self.completed:
+            return 'requested range complete'
+        reached = 'no data' if self.last_timestamp is None else f'data up to {datetime.fromtimestamp(self.last_timestamp)}'
+        return f'range incomplete ({self.reason}), {reached}'
+
+
+### timezone the DAQ time strings (YYYY-MM-DDTHH:MM:SS) are given in, as an IANA
+### name such as 'Europe/Berlin' (environment variable ALPS_DAQ_TZ); None means
+### the local time of this machine
+daqTimezone = os.environ.get('ALPS_DAQ_TZ') or None
+
+
+def _daq_tzinfo():
+    if daqTimezone is None:
+        return None
+    from zoneinfo import ZoneInfo
+    return ZoneInfo(daqTimezone)
+
+
+### converts a DAQ time string (YYYY-MM-DDTHH:MM:SS) to a unix timestamp
+def daq_timestamp(timestring):
+    return datetime.strptime(timestring, '%Y-%m-%dT%H:%M:%S').replace(tzinfo=_daq_tzinfo()).timestamp()
+
+
+### converts a unix timestamp back to a DAQ time string, rounded down to the
+### whole second the strings resolve
+def daq_timestring(timestamp):
+    return datetime.fromtimestamp(int(np.floor(timestamp)), _daq_tzinfo()).strftime('%Y-%m-%dT%H:%M:%S')
+
+
+### splits one getdata() result into (daqname, macropulse, timestamp, data) blocks
+def _daq_blocks(channels, stats):
+    for chan in channels:
+        daqname = chan[0]['miscellaneous']['daqname']
+        macropulse = chan[0]['macropulse']
+        timestamp = chan[0]['timestamp']
+        # !!! IMPORTANT !!! convert from unsigned to signed.
+        with stats.stage('convert'):
+            data = convert_to_signed(chan[0]['data'][0], 16)
+        stats.add(blocks=1, samples=len(data), bytes=data.nbytes)
+        yield daqname, macropulse, timestamp, data
+
+
+########################### iter_doocs_data ###################################
+### Streaming form of get_doocs_data. Connects to the DAQ server and yields one
+### (daqname, macropulse, timestamp, data) tuple per channel per event, with data
+### already converted to a signed int16 array. Nothing is accumulated here, so
+### callers decide whether to buffer, decimate or write each block straight away.
+### Errors are raised rather than printed; the connection is always closed.
+### Progress goes to the optional AcquisitionStats, which times the poll and
+### convert stages; consumers time their own buffer/decimate/write stages.
+### Polling is paced by a PollScheduler (one is made from `stop` if none is
+### given); pass your own to check scheduler.completed afterwards. `backend` is
+### anything with pydaq's connect/getdata/disconnect, by default pydaq itself.
+###############################################################################
+def iter_doocs_data(chans,start,stop,daq="/daq_data/alps",server="TTF2.DAQ/DAQ.SERVER5/DAQ.DATA.SVR/",stats=None,scheduler=None,backend=None):
+    backend = pydaq if backend is None else backend
+    if backend is None:
+        raise DAQError('pydaq is not available on this machine')
+    if stats is None:
+        stats = AcquisitionStats()
+    if scheduler is None:
+        scheduler = PollScheduler(daq_timestamp(stop))
+    err = backend.connect(start=start, stop=stop, ddir=daq, exp='alps', chans=chans, daqservers=server)
+    if err != []:
+        raise DAQError(err)
+    try:
+        while True:
+            with stats.stage('poll'):
+                channels = backend.getdata()
+                stats.add(polls=1)
+                if channels == []:
+                    stats.add(empty_polls=1)
+                    if scheduler.expired():
+                        scheduler.finish('idle timeout')
+                        break
+                    time.sleep(scheduler.empty())
+                    continue
+            if channels == None:
+                scheduler.finish('end of data')
+                break
+            stats.add(events=1)
+            for block in _daq_blocks(channels, stats):
+                scheduler.got_data(block[2])
+                yield block
+            stats.report()
+            if scheduler.reached_stop():
+                scheduler.finish('end of range')
+                break
+    finally:
+        backend.disconnect()
+
+
+########################## aiter_doocs_data ###################################
+### asyncio version of iter_doocs_data: an async generator yielding the same
+### blocks. The blocking pydaq calls run in a worker thread and the backoff is
+### an asyncio sleep, so several pulls (channel groups or sessions, each with
+### its own backend) can be serviced concurrently from one event loop.
+###############################################################################
+async def aiter_doocs_data(chans,start,stop,daq="/daq_data/alps",server="TTF2.DAQ/DAQ.SERVER5/DAQ.DATA.SVR/",stats=None,scheduler=None,backend=None):
+    import asyncio
+    backend = pydaq if backend is None else backend
+    if backend is None:
+        raise DAQError('pydaq is not available on this machine')
+    if stats is None:
+        stats = AcquisitionStats()
+    if scheduler is None:
+        scheduler = PollScheduler(daq_timestamp(stop))
+    err = await asyncio.to_thread(backend.connect, start=start, stop=stop, ddir=daq, exp='alps', chans=chans, daqservers=server)
+    if err != []:
+        raise DAQError(err)
+    try:
+        while True:
+            with stats.stage('poll'):
+                channels = await asyncio.to_thread(backend.getdata)
+                stats.add(polls=1)
+            if channels == []:
+                stats.add(empty_polls=1)
+                if scheduler.expired():
+                    scheduler.finish('idle timeout')
+                    break
+                await asyncio.sleep(scheduler.empty())
+                continue
+            if channels == None:
+                scheduler.finish('end of data')
+                break
+            stats.add(events=1)
+            for block in _daq_blocks(channels, stats):
+                scheduler.got_data(block[2])
+                yield block
+            stats.report()
+            if scheduler.reached_stop():
+                scheduler.finish('end of range')
+                break
+    finally:
+        await asyncio.to_thread(backend.disconnect)
+
+
+########################## fetch_concurrently #################################
+### Pulls several channel groups at once on one asyncio event loop. `groups` is
+### a list of dicts with the keyword arguments of aiter_doocs_data (at least
+### chans, start and stop; give each its own backend to run separate sessions).
+### Returns, in the order of groups, a ({daqname: int16 array}, scheduler) pair.
+###############################################################################
+def fetch_concurrently(groups):
+    import asyncio
+    async def collect(group):
+        group = dict(group)
+        scheduler = group.pop('scheduler', None) or PollScheduler(daq_timestamp(group['stop']))
+        buffers = {c: ChannelBuffer() for c in group['chans']}
+        async for daqname, macropulse, timestamp, data in aiter_doocs_data(scheduler=scheduler, **group):
+            if daqname in buffers:
+                buffers[daqname].append(data)
+        return {c: b.array() for c, b in buffers.items()}, scheduler
+
+    async def collect_all():
+        return await asyncio.gather(*[collect(group) for group in groups])
+
+    return asyncio.run(collect_all())
+
+
+def get_doocs_data(chans,start,stop,daq="/daq_data/alps",server="TTF2.DAQ/DAQ.SERVER5/DAQ.DATA.SVR/",stats=None):
 #    chans=['ALPS.DIAG/ALPS.ADC.HN/CH_1.00','ALPS.DIAG/ALPS.ADC.HN/CH_1.01']
 #    start_time="2022-01-03T12:23:00"
 #    stop_time= "2022-01-03T12:23:01"  
+    if stats is None:
+        stats = AcquisitionStats(reporter=print)
+    scheduler = PollScheduler(daq_timestamp(stop))
+    buffers = [ChannelBuffer() for i in range(4)]
+    stats_list = []
     try:
-       # for NAF environment on NAF cluster
-        err = pydaq.connect(start=start, stop=stop, ddir=daq_taking_data, exp='alps', chans=chans, daqservers=daqservers)
-            
-    except pydaq.PyDaqException as err:
+        for daqname, macropulse, timestamp, data_array_int in iter_doocs_data(chans,start,stop,daq,server,stats,scheduler):
+            found = False
+            for entry in stats_list:
+                if entry['daqname'] == daqname:
+                    entry['events'] += 1
+                    found = True
+                    break
+            if not found:
+                stats_list.append({'daqname': daqname, 'events': 1})
+            if daqname in chans[:4]:
+                with stats.stage('buffer'):
+                    buffers[chans.index(daqname)].append(data_array_int)
+    except DAQError as err:
+        print('DAQ server refused the request: %s'%str(err))
+    except PyDaqException as err:
         print('Something wrong with daqconnect... exiting')
         print(err)
         sys.exit(-1)
-    
-    
-    if err == []:
-        stop = False
-        emptycount = 0
-        total = 0
-        stats_list = []
-        chan1_all = []
-        chan2_all = []
-        chan3_all = []
-        chan4_all = []
-        while not stop and (emptycount < 1000000):    
-            try:
-                channels = pydaq.getdata()
-                if channels == []:
-                    emptycount += 1
-                    time.sleep(0.001)
-                    continue
-                if channels == None:
-                    break
-                total += 1
-                
-                print("\nEvent: %d"%total)
-                for chan in channels:
-                    subchan  = len(chan)
-                    daqname = chan[0]['miscellaneous']['daqname']
-                    macropulse = chan[0]['macropulse']
-                    timestamp = chan[0]['timestamp']
-                    found = False
-                    chtotal = 0
-                    for stats in stats_list:
-                        if stats['daqname'] == daqname:
-                            stats['events'] += 1
-                            chtotal = stats['events']
-                            found = True
-                            break
-                    if not found:
-                        entry = {}
-                        entry['daqname'] = daqname
-                        entry['events'] = 1
-                        chtotal = entry['events']
-                        stats_list.append(entry)
-                        
-                    #print("daqname = " + daqname)
-                    print("\nmacropulse = " + str(macropulse) + "  prop:" + daqname + "  time:"+ str(timestamp))
-                    data_array=chan[0]['data']
-                    data_array_int = np.zeros(len(data_array[0]),int)
-                    i=0
-                    
-                    # !!! IMPORTANT !!! convert from unsigned to signed.
-                    for x in data_array[0]:
-                        data_array_int[i] = unsigned_to_signed(x, 16)
-                        i=i+1
-                    
-                    if daqname == chans[0]:
-                        chan1_all = np.append(chan1_all,data_array_int)
-                    if daqname == chans[1]:
-                        chan2_all = np.append(chan2_all,data_array_int)
-                    if daqname == chans[2]:
-                        chan3_all = np.append(chan3_all,data_array_int)
-                    if daqname == chans[3]:
-                        chan4_all = np.append(chan4_all,data_array_int)
-                    print('length of macropulse data = ' + str(len(data_array_int)))
-                emptycount = 0
-            except Exception as err:    
-                print('Something wrong ... stopping %s'%str(err))
-                stop = True
-    
-    
-        print('\nSummary:\nTotal events: %d emptycount %d'% (total, emptycount))
-        for stats in stats_list:
-            print(stats['daqname'], ':\t', stats['events'], 'events')
-        pydaq.disconnect()
+    except Exception as err:    
+        print('Something wrong ... stopping %s'%str(err))
+
+    stats.report(force=True)
+    print('\nSummary: ' + scheduler.describe())
+    for entry in stats_list:
+        print(entry['daqname'], ':\t', entry['events'], 'events')
         
-    return chan1_all,chan2_all,chan3_all,chan4_all,stats_list
+    return buffers[0].array(),buffers[1].array(),buffers[2].array(),buffers[3].array(),stats_list
 
 
 ########################## signal_process #####################################
 ### Uses the GWpy library of signal processing tools to filter and analyze data
 ### by converting to a TimeSeries object, then subjecting it to GWpy function to
 ### filter or generate FrequencySeries objects. Returns raw data for plotting.
+### Works on a single channel, so several channels can go through map_channels.
 ###############################################################################
-def signal_process(data,fs=16000,t0=0,process="None",filtertype="None",filterfreq=0,flow=0,fhigh=0,zeros=[],poles=[],gain=0):
-    myTS = TimeSeries(data=data[0])
+def signal_process(data,fs=16000,t0=0,process="None",filtertype="None",filterfreq=0,flow=0,fhigh=0,zeros=[],poles=[],gain=0,
+                   fftlength=None,overlap=None,window='hann',scale_a=1.0,scale_b=0.0,dtype=None):
+    from gwpy.timeseries import TimeSeries
+    dtype = dtype or floatDtype
+    ### the a*x + b calibration is fused into building the TimeSeries, so the raw
+    ### int16 data is converted once, directly into the working dtype
+    myTS = TimeSeries(data=calibrate(np.ravel(data),scale_a,scale_b,dtype),dt=1/fs,t0=t0)
     if filtertype=="lowpass":
         myTS = myTS.lowpass(frequency=filterfreq)
     if filtertype=="highpass":
@@ -207,12 +2620,407 @@ def signal_process(data,fs=16000,t0=0,process="None",filtertype="None",filterfre
         myTS = myTS.zpk(zeros=zeros,poles=poles,gain=gain)
         
     if process=="None":
-        print('Plotting a time series')
         return myTS
-    if process=="ASD":
-        myASD = myTS.asd(fftlength,overlap,window,method)
-        return myASD
-    if process=="PSD":
-        myPSD = myTS.psd(fftlength,overlap,window,method)
-        return myPSD
+    if process in ("ASD","PSD"):
+        ### through the FFT backend (fast lengths, fftWorkers threads) instead of
+        ### gwpy; float64 keeps gwpy's median average, float32 averages the mean
+        ### in float64 as before
+        from gwpy.frequencyseries import FrequencySeries
+        nperseg = int(fftlength*fs) if fftlength else None
+        noverlap = int(overlap*fs) if overlap is not None else None
+        average = 'median' if np.dtype(dtype) == np.float64 else 'mean'
+        freqs, psd = welch_psd(myTS.value,fs,nperseg,noverlap,window,dtype,average=average)
+        spectrum = psd if process=="PSD" else np.sqrt(psd)
+        return FrequencySeries(spectrum.astype(dtype),f0=0,df=freqs[1]-freqs[0])
+
+
+############################## Demodulator ####################################
+### Streaming heterodyne (lock-in) demodulation of one channel at a reference
+### `frequency`: each block is mixed down with a complex oscillator whose phase
+### carries over from block to block, then low-pass filtered and decimated in
+### the same pass by a cascade of StreamDecimators (stages of at most ~10).
+### The total decimation is the largest divisor of fs that keeps the output
+### rate fs_out at least 2*bandwidth, so the band kept is about +-fs_out/2
+### around the reference. The output is complex: for a line A*cos(2 pi f t + p)
+### it is A*exp(i p), with the phase relative to the oscillator at the first
+### sample. Output sample k belongs to input sample k*factor (group delays are
+### removed). Call flush() after the last block.
+###############################################################################
+def _stage_factors(factor):
+    primes, n, p = [], int(factor), 2
+    while n > 1:
+        while n % p == 0:
+            primes.append(p)
+            n //= p
+        p += 1
+    stages = []
+    for p in sorted(primes, reverse=True):
+        fitting = [i for i, q in enumerate(stages) if q*p <= 10]
+        if fitting:
+            stages[fitting[0]] *= p
+        else:
+            stages.append(p)
+    return stages
+
+
+class Demodulator(object):
+    def __init__(self, frequency, bandwidth, fs=16000, dtype=None):
+        self.frequency = float(frequency)
+        self.fs = fs
+        self.real = np.dtype(dtype or floatDtype)
+        self.dtype = np.result_type(self.real, np.complex64)
+        target = max(1, int(fs//(2*bandwidth)))
+        self.factor = max(d for d in range(1, target + 1) if int(fs) % d == 0)
+        self.fs_out = fs/self.factor
+        self.stages = [StreamDecimator(q, self.dtype) for q in _stage_factors(self.factor)]
+        self.step = 2*np.pi*self.frequency/fs
+        self.phase = 0.0        ### oscillator phase at the next input sample, in [0, 2 pi)
+
+    def process(self, block):
+        n = len(block)
+        oscillator = np.exp(-1j*(self.phase + self.step*np.arange(n))).astype(self.dtype)
+        self.phase = (self.phase + self.step*n) % (2*np.pi)
+        out = 2*np.asarray(block, dtype=self.real)*oscillator
+        for stage in self.stages:
+            out = stage.process(out)
+        return out
+
+    def flush(self):
+        out = np.zeros(0, dtype=self.dtype)
+        for stage in self.stages:
+            out = np.concatenate([stage.process(out), stage.flush()])
+        return out
+
+
+### splits complex demodulator output into two real channels, I/Q or amplitude/phase
+def demod_components(z, output='iq'):
+    if output == 'iq':
+        return z.real.copy(), z.imag.copy()
+    if output == 'polar':
+        return np.abs(z), np.angle(z)
+    raise ValueError(f"demodulation output must be 'iq' or 'polar', not '{output}'")
+
+
+############################## demodulate #####################################
+### Demodulates a whole (possibly memory mapped) channel through a Demodulator
+### `chunk` samples at a time, applying the a*x + b calibration per chunk.
+### Returns (fs_out, I, Q) or, with output='polar', (fs_out, amplitude, phase).
+###############################################################################
+def demodulate(data,frequency,bandwidth,fs=16000,output='iq',scale_a=1.0,scale_b=0.0,dtype=None,chunk=1 << 20):
+    demodulator = Demodulator(frequency, bandwidth, fs, dtype)
+    blocks = [demodulator.process(calibrate(block, scale_a, scale_b, demodulator.real)) for block in read_chunks(data, chunk)]
+    blocks.append(demodulator.flush())
+    return (demodulator.fs_out,) + demod_components(np.concatenate(blocks), output)
+
+
+################################ LockIn #######################################
+### Side table for the streaming pull: demodulates every channel block by
+### block as it arrives (append() like TrendTable), keeping only the low rate
+### output. Blocks are taken back to back; a gap in the DAQ data shifts the
+### phase reference of everything after it. save() writes the result as .mat
+### or .csv with two channels (I/Q or amplitude/phase) per input channel.
+###############################################################################
+class LockIn(object):
+    def __init__(self, names, frequency, bandwidth, labels=None, fs=16000, scales=None, dtype=None):
+        self.names = list(names)
+        self.labels = list(labels) if labels is not None else ['']*len(self.names)
+        self.scales = list(scales) if scales is not None else [(1.0, 0.0)]*len(self.names)
+        self.frequency = frequency
+        self.bandwidth = bandwidth
+        self.demodulators = [Demodulator(frequency, bandwidth, fs, dtype) for n in self.names]
+        self.fs_out = self.demodulators[0].fs_out
+        self.buffers = [ChannelBuffer(dtype=d.dtype) for d in self.demodulators]
+        self.t0 = None
+        self._flushed = False
+
+    def append(self, daqname, macropulse, timestamp, data):
+        if daqname not in self.names or len(data) == 0:
+            return
+        i = self.names.index(daqname)
+        if self.t0 is None:
+            self.t0 = timestamp
+        a, b = self.scales[i]
+        demodulator = self.demodulators[i]
+        self.buffers[i].append(demodulator.process(calibrate(data, a, b, demodulator.real)))
+
+    ### complex output per channel
+    def result(self):
+        if not self._flushed:
+            for buffer, demodulator in zip(self.buffers, self.demodulators):
+                buffer.append(demodulator.flush())
+            self._flushed = True
+        return [buffer.array() for buffer in self.buffers]
+
+    def save(self, path, output='iq'):
+        names, labels, datas = [], [], []
+        suffixes = ('I', 'Q') if output == 'iq' else ('amplitude', 'phase')
+        for name, label, z in zip(self.names, self.labels, self.result()):
+            for suffix, data in zip(suffixes, demod_components(z, output)):
+                names.append(f"{name} {suffix}")
+                labels.append(f"{label} {suffix}".strip())
+                datas.append(data)
+        if path.endswith('.csv'):
+            save_channels_to_csv(datas, path)
+        else:
+            metadata = {'demod_frequency': self.frequency, 'demod_bandwidth': self.bandwidth, 'demod_output': output}
+            save_to_mat(datas, names, path, 0, labels, fs=self.fs_out, starttime=self.t0 or 0,
+                        dtype=self.demodulators[0].real, metadata=metadata)
+
+
+############################## ZoomSpectrum ###################################
+### Narrowband high resolution spectrum (zoom FFT) of the band center +- span/2
+### over arbitrarily long data. Blocks are mixed down to baseband and decimated
+### by a Demodulator, and Welch averaging (no detrend, the carrier sits at 0 Hz)
+### runs on the low rate complex stream, so a segment of 1/resolution seconds
+### is only a few times span/resolution points: resolving millihertz needs
+### hours long segments but only that much memory, however long the data.
+### result() returns (frequencies, one-sided PSD) over the band, scaled like
+### welch_psd of the real signal; `averages` counts the segments so far, and
+### result() raises ValueError while there is not one full segment yet.
+###############################################################################
+class ZoomSpectrum(object):
+    def __init__(self, center, span, resolution, fs=16000, window='hann', overlap=0.5, dtype=None):
+        self.center = float(center)
+        self.span = float(span)
+        self.demodulator = Demodulator(center, span, fs, dtype)
+        self.fs_out = self.demodulator.fs_out
+        self.nperseg = max(int(round(self.fs_out/resolution)), 1)
+        self.step = max(self.nperseg - int(round(overlap*self.nperseg)), 1)
+        self.window = fft_window(window, self.nperseg, self.demodulator.real)
+        self.pending = np.zeros(0, dtype=self.demodulator.dtype)
+        self.sum = np.zeros(self.nperseg, dtype=np.float64)
+        self.averages = 0
+
+    def append(self, block):
+        z = np.concatenate([self.pending, self.demodulator.process(block)])
+        if len(z) < self.nperseg:
+            self.pending = z
+            return
+        segments = np.lib.stride_tricks.sliding_window_view(z, self.nperseg)[::self.step]
+        spectra = cfft(segments*self.window, axis=1)
+        self.sum += (spectra.real**2 + spectra.imag**2).sum(axis=0, dtype=np.float64)
+        self.averages += len(segments)
+        self.pending = z[len(segments)*self.step:]
+
+    def result(self):
+        from scipy import fft
+        if self.averages == 0:
+            raise ValueError(f"no full segment of {self.nperseg/self.fs_out:g} s (1/resolution) in the data, "
+                             f"use a coarser resolution or more data")
+        ### the complex baseband carries the power of both sidebands of the real signal once, hence the 2
+        psd = self.sum/self.averages/(2*self.fs_out*np.sum(self.window.astype(np.float64)**2))
+        freqs = fft.fftfreq(self.nperseg, 1/self.fs_out)
+        order = np.argsort(freqs)
+        freqs, psd = freqs[order], psd[order]
+        band = np.abs(freqs) <= self.span/2
+        return self.center + freqs[band], psd[band]
+
+
+### zoom spectrum of a whole (possibly memory mapped or raw file) channel, chunk by chunk
+def zoom_spectrum(data,center,span,resolution,fs=16000,window='hann',overlap=0.5,scale_a=1.0,scale_b=0.0,dtype=None,chunk=1 << 20):
+    zoom = ZoomSpectrum(center, span, resolution, fs, window, overlap, dtype)
+    for block in read_chunks(data, chunk):
+        zoom.append(calibrate(block, scale_a, scale_b, zoom.demodulator.real))
+    return zoom.result()
+
+
+########################## CrossCorrelation ###################################
+### Cross-correlation of two time aligned channels a and b for lags of up to
+### +-max_lag samples, fed block by block, e.g. to measure the delay between
+### two ADC crates. r[l] = sum_n a[n]*b[n + l] is accumulated over the whole
+### range with overlap-save FFT blocks: a is cut into blocks of `block`
+### samples, each correlated (through the FFT backend, many blocks per call)
+### against the stretch of b reaching max_lag beyond it on both sides, so
+### nothing wraps around and only max_lag samples of b are carried over. The
+### spectra of all blocks are summed before one inverse FFT. Memory stays at a
+### few blocks, whatever the length of the range.
+### Beyond both ends b is padded with zeros after the first block's means are
+### subtracted, so the padding adds nothing and lag l sums n - |l| products.
+### result() gives the correlation coefficient per lag (means removed, each
+### lag normalized by its own overlap) and the peak: its lag between samples
+### from the band limited (sinc) interpolation of the coefficients around the
+### largest one, to 1/1000 of a sample, and its coefficient there. A positive
+### lag means b is behind a (b[n] ~ a[n - lag]).
+###############################################################################
+class CrossCorrelation(object):
+    def __init__(self, max_lag, fs=16000, block=None, dtype=None, workers=None):
+        self.max_lag = int(max_lag)
+        self.fs = fs
+        self.dtype = np.dtype(dtype or floatDtype)
+        self.block = int(block or max(8*self.max_lag, 1 << 14))
+        self.nfft = fast_length(self.block + 2*self.max_lag)
+        self.workers = workers
+        self.sum = np.zeros(2*self.max_lag + 1, dtype=np.float64)
+        self.moments = np.zeros(5, dtype=np.float64)   ### sum a, sum b, sum a^2, sum b^2, samples
+        self.offsets = None     ### first block means, subtracted to keep the FFTs well conditioned
+        self._a = np.zeros(0, dtype=self.dtype)
+        self._b = np.zeros(self.max_lag, dtype=self.dtype)  ### b from max_lag before the first pending a
+
+    def append(self, a, b):
+        a = np.asarray(a, dtype=np.float64)
+        b = np.asarray(b, dtype=np.float64)
+        if len(a) != len(b):
+            raise ValueError(f"blocks of {len(a)} and {len(b)} samples, the channels must be time aligned")
+        if len(a) == 0:
+            return
+        if self.offsets is None:
+            self.offsets = (a.mean(), b.mean())
+        a = a - self.offsets[0]
+        b = b - self.offsets[1]
+        self.moments += (a.sum(), b.sum(), np.dot(a, a), np.dot(b, b), len(a))
+        self._a = np.concatenate([self._a, a.astype(self.dtype)])
+        self._b = np.concatenate([self._b, b.astype(self.dtype)])
+        self._correlate((len(self._b) - 2*self.max_lag)//self.block)
+
+    def _correlate(self, blocks):
+        from scipy import fft
+        span = self.block + 2*self.max_lag
+        batch = max(1, (1 << 22)//self.nfft)
+        for i in range(0, blocks, batch):
+            k = min(batch, blocks - i)
+            a = self._a[:k*self.block].reshape(k, self.block)
+            b = np.lib.stride_tricks.sliding_window_view(self._b[:(k - 1)*self.block + span], span)[::self.block]
+            spectrum = (np.conj(rfft(a, self.nfft, axis=1, workers=self.workers))
+                        *rfft(b, self.nfft, axis=1, workers=self.workers)).sum(axis=0)
+            self.sum += fft.irfft(spectrum, self.nfft, workers=self.workers or fftWorkers)[:2*self.max_lag + 1]
+            self._a = self._a[k*self.block:]
+            self._b = self._b[k*self.block:]
+
+    ### correlates the last partial block, a and b padded with zeros (the first
+    ### block's means) beyond the end
+    def flush(self):
+        if len(self._a):
+            n = len(self._a)
+            self._a = np.concatenate([self._a, np.zeros(self.block - n, dtype=self.dtype)])
+            self._b = np.concatenate([self._b, np.zeros(self.block + 2*self.max_lag - len(self._b), dtype=self.dtype)])
+            self._correlate(1)
+        self._a = np.zeros(0, dtype=self.dtype)
+
+    def result(self):
+        sum_a, sum_b, sum_aa, sum_bb, n = self.moments
+        lags = np.arange(-self.max_lag, self.max_lag + 1)
+        if n == 0:
+            coefficient = np.full(len(lags), np.nan)
+        else:
+            mean_a, mean_b = sum_a/n, sum_b/n
+            with np.errstate(divide='ignore', invalid='ignore'):
+                coefficient = (self.sum/np.maximum(n - np.abs(lags), 1) - mean_a*mean_b)/np.sqrt((sum_aa/n - mean_a**2)*(sum_bb/n - mean_b**2))
+        if not np.isfinite(coefficient).any():
+            return {'lags': lags/self.fs, 'coefficient': coefficient, 'peak_lag': np.nan, 'peak_lag_samples': np.nan,
+                    'peak_coefficient': np.nan, 'zero_lag_coefficient': np.nan, 'samples': int(n)}
+        k = int(np.nanargmax(np.abs(coefficient)))
+        sign = np.sign(coefficient[k]) or 1.0
+        ### sinc interpolation from the 32 coefficients on either side, within a sample of the largest
+        near = np.arange(max(k - 32, 0), min(k + 33, len(lags)))
+        offsets = np.linspace(-1, 1, 2001)
+        fine = sign*np.sinc(k + offsets[:, np.newaxis] - near) @ np.nan_to_num(coefficient[near])
+        best = int(np.argmax(fine))
+        shift, peak = offsets[best], fine[best]
+        return {'lags': lags/self.fs, 'coefficient': coefficient, 'peak_lag': (lags[k] + shift)/self.fs,
+                'peak_lag_samples': lags[k] + shift, 'peak_coefficient': sign*peak,
+                'zero_lag_coefficient': coefficient[self.max_lag], 'samples': int(n)}
+
+
+########################### cross_correlate ###################################
+### CrossCorrelation of every (i, j) pair of channels in `datas` (arrays or
+### raw int16 files, see read_chunks), read `chunk` samples at a time, for lags
+### of up to max_lag seconds. Returns one result dict per pair, with the pair's
+### 'channels' names added when `names` are given. correlation_metadata turns
+### the results into .mat variables (xcorrk_channels, xcorrk_lags,
+### xcorrk_coefficient, xcorrk_peak_lag, xcorrk_peak_coefficient per pair k),
+### correlation_summary into one line per pair.
+###############################################################################
+def cross_correlate(datas, pairs, max_lag, fs=16000, names=None, chunk=1 << 20, dtype=None, workers=None):
+    results = []
+    for i, j in pairs:
+        correlation = CrossCorrelation(int(round(max_lag*fs)), fs, dtype=dtype, workers=workers)
+        for a, b in zip(read_chunks(datas[i], chunk), read_chunks(datas[j], chunk)):
+            n = min(len(a), len(b))
+            correlation.append(a[:n], b[:n])
+        correlation.flush()
+        result = correlation.result()
+        if names is not None:
+            result['channels'] = (names[i], names[j])
+        results.append(result)
+    return results
+
+
+def correlation_metadata(results):
+    meta = {}
+    for k, result in enumerate(results):
+        if 'channels' in result:
+            meta[f'xcorr{k+1}_channels'] = ' x '.join(result['channels'])
+        meta[f'xcorr{k+1}_lags'] = result['lags']
+        meta[f'xcorr{k+1}_coefficient'] = result['coefficient']
+        meta[f'xcorr{k+1}_peak_lag'] = result['peak_lag']
+        meta[f'xcorr{k+1}_peak_coefficient'] = result['peak_coefficient']
+    return meta
+
+
+def correlation_summary(results):
+    return [f"Correlation {' x '.join(result.get('channels', (f'pair {k+1}',)))}: peak {result['peak_coefficient']:.4f}"
+            f" at {result['peak_lag']*1e6:+.2f} us ({result['peak_lag_samples']:+.3f} samples),"
+            f" {result['zero_lag_coefficient']:.4f} at zero lag"
+            for k, result in enumerate(results)]
+
+
+############################ map_channels #####################################
+### Runs func(data, **kwargs) for every channel in datas on a pool of `workers`
+### and returns the results in the same channel order as datas. Used for the
+### post-processing stages (decimation, filtering, spectra), which are
+### independent per channel. Processes (the default) sidestep the GIL for the
+### pure Python parts of scipy/gwpy, at the cost of pickling each channel; pass
+### processes=False for cheap functions or when func is not picklable.
+###############################################################################
+def map_channels(func,datas,workers=None,processes=True,**kwargs):
+    workers = processingWorkers if workers is None else workers
+    workers = min(workers, len(datas))
+    if workers <= 1:
+        return [func(data, **kwargs) for data in datas]
+    pool = ProcessPoolExecutor if processes else ThreadPoolExecutor
+    with pool(max_workers=workers) as executor:
+        futures = [executor.submit(func, data, **kwargs) for data in datas]
+        return [future.result() for future in futures]
+
+
+############################## fan_out ########################################
+### Feeds one fetched set of channels to several output sinks at once. Each
+### sink is a dict with
+###   'channels':   indices into datas (default: all)
+###   'decimation': integer decimation factor (default 1), or
+###   'rate':       output sampling rate, any rate parse_rate takes
+###   'dtype':      working float dtype (default floatDtype)
+###   'filter':     None or filter_data keyword arguments, e.g.
+###                 {'filtertype': 'lowpass', 'filterfreq': 100}
+###   'stream':     True to resample with the filters of resample_chunked (FIR
+###                 for whole factors) instead of resample_data (IIR), giving
+###                 the same samples as streaming the channel from a file
+### and gets back the list of its processed channels. The raw arrays are shared
+### by reference, not copied per sink: a channel a sink leaves at 16 kHz and
+### unfiltered is the raw array itself, and a (channel, filter, rate,
+### dtype) combination asked for by several sinks is computed once. The work
+### runs on a thread pool of `workers`, which sees the same arrays without
+### pickling them.
+###############################################################################
+def _sink_channel(data,rate=16000,dtype=None,filter=None,fs=16000,stream=False):
+    if filter:
+        data = filter_data(data,fs=fs,dtype=dtype,**filter)
+    if rate != fs:
+        data = (resample_chunked if stream else resample_data)(data,fs,rate,dtype=dtype)
+    return data
+
 
+def fan_out(datas,sinks,fs=16000,workers=None):
+    workers = processingWorkers if workers is None else workers
+    keys = []
+    for sink in sinks:
+        dtype = np.dtype(sink.get('dtype') or floatDtype).name
+        filt = tuple(sorted((sink.get('filter') or {}).items()))
+        rate = parse_rate(sink['rate']) if 'rate' in sink else parse_rate(fs/Fraction(int(sink.get('decimation', 1))))
+        stream = bool(sink.get('stream'))
+        keys.append([(i, rate, dtype, filt, stream) for i in sink.get('channels', range(len(datas)))])
+    jobs = {key for sinkkeys in keys for key in sinkkeys if key[1] != fs or key[3]}
+    with ThreadPoolExecutor(max_workers=max(1, min(workers, len(jobs)))) as executor:
+        futures = {key: executor.submit(_sink_channel, datas[key[0]], key[1], key[2], dict(key[3]), fs, key[4]) for key in jobs}
+        results = {key: future.result() for key, future in futures.items()}
+    return [[results[key] if key in results else datas[key[0]] for key in sinkkeys] for sinkkeys in keys]
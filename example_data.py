@@ -10,7 +10,7 @@ import sys
 #import pydaq
 import time
 import numpy as np
-from numpy import *
+from numpy import array
 
 getdata_sample = [{'data': array([[15559, 15740, 15909, 16072, 16239, 16410, 16558, 16720, 16871,
         17022, 17168, 17314, 17458, 17600, 17727, 17867, 17993, 18128,
@@ -69,6 +69,95 @@ getdata_sample = [{'data': array([[15559, 15740, 15909, 16072, 16239, 16410, 165
         12917, 13115, 13309, 13513, 13711, 13909, 14096, 14284, 14475,
         14658, 14846, 15028, 15198, 15382]]), 'type': 'IMAGE', 'timestamp': 1641208980.970772, 'macropulse': 1590942828, 'miscellaneous': {'width': 500, 'height': 1, 'aoi_width': 500, 'aoi_height': 1, 'x_start': 0, 'y_start': 0, 'hbin': 1, 'vbin': 1, 'bpp': 2, 'ebitpp': 16, 'source_format': 0, 'image_format': 0, 'frame': 414029268, 'event': 1590942828, 'scale_x': -1.0, 'scale_y': -1.0, 'image_rotation': 0.0, 'fspare2': 700.0, 'fspare3': 1.9200000762939453, 'fspare4': 0.0, 'ispare2': 1, 'ispare3': 500, 'ispare4': 1, 'length': 1000, 'image_flags': 3, 'status': 0, 'daqname': 'ALPS.DIAG/ALPS.ADC.HN/CH_1.01'}}]
 
-getdata_sample2 = [{'data': array([0.01*np.sin(320 *2*np.pi* np.linspace(0, 1, 1600000))])}]
-getdata_sample3 = [{'data': array([0.03*np.sin(122 *2*np.pi* np.linspace(0, 1, 1600000))])}]
-getdata_sample4 = [{'data': array(0.1*np.random.rand(1,1600000))+getdata_sample2[0]['data'][0]}]
\ No newline at end of file
+### the 1.6 M-sample test signals are built on first access (module __getattr__)
+### rather than at import, so importing this module stays cheap; being absent
+### from the module namespace until then, they are not part of `import *`
+_samples = {
+    'getdata_sample2': lambda: [{'data': array([0.01*np.sin(320 *2*np.pi* np.linspace(0, 1, 1600000))])}],
+    'getdata_sample3': lambda: [{'data': array([0.03*np.sin(122 *2*np.pi* np.linspace(0, 1, 1600000))])}],
+    'getdata_sample4': lambda: [{'data': array(0.1*np.random.rand(1,1600000))+__getattr__('getdata_sample2')[0]['data'][0]}],
+}
+
+def __getattr__(name):
+    if name not in _samples:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    globals()[name] = _samples[name]()
+    return globals()[name]
+
+
+###################### synthetic data generators ##############################
+### The same sine + noise test signals as getdata_sample2/getdata_sample4, at
+### any length, for benchmarks and long synthetic runs.
+### synthetic_signal gives the float signal, synthetic_adc the raw unsigned
+### 16 bit frames the DAQ delivers (full scale = `counts`), and
+### synthetic_daq_blocks the same split into getdata()-style macropulse blocks.
+###############################################################################
+def synthetic_signal(seconds, fs=16000, freq=320, amplitude=0.01, noise=0.1, seed=0):
+    rng = np.random.default_rng(seed)
+    t = np.arange(int(seconds*fs))/fs
+    return amplitude*np.sin(2*np.pi*freq*t) + noise*rng.random(len(t))
+
+def synthetic_adc(seconds, fs=16000, freq=320, amplitude=0.3, noise=0.05, counts=32767, seed=0):
+    x = synthetic_signal(seconds, fs, freq, amplitude, noise, seed)
+    return np.round(x*counts).astype(np.int16).view(np.uint16)
+
+def synthetic_daq_blocks(seconds, daqname='ALPS.DIAG/ALPS.ADC.HN/CH_1.01', fs=16000, blocksize=500,
+                         t0=1641208980.0, macropulse0=1590942828, **kwargs):
+    raw = synthetic_adc(seconds, fs, **kwargs)
+    for k in range(len(raw)//blocksize):
+        yield [{'data': raw[np.newaxis, k*blocksize:(k+1)*blocksize], 'type': 'IMAGE',
+                'timestamp': t0 + k*blocksize/fs, 'macropulse': macropulse0 + k,
+                'miscellaneous': {'daqname': daqname, 'ebitpp': 16}}]
+
+
+
+############################### FakeDAQ #######################################
+### Stand-in for the pydaq module with the same connect/getdata/disconnect
+### calls, serving synthetic_adc data for any channels and time range. Pass an
+### instance as `backend` to iter_doocs_data / run_job to exercise the whole
+### pipeline (e.g. multi-hour memory tests) without a DAQ server. Blocks are
+### cut from one precomputed second of data per channel, so serving hours of
+### data is cheap. Every `empty_every`-th poll returns [] like an idle DAQ, and
+### `delay` seconds of sleep per poll make it slow like a real server.
+###############################################################################
+class FakeDAQ(object):
+    def __init__(self, fs=16000, blocksize=500, empty_every=0, macropulse0=1590942828, delay=0):
+        self.fs = fs
+        self.blocksize = blocksize
+        self.empty_every = empty_every
+        self.delay = delay
+        self.macropulse0 = macropulse0
+        self.connected = False
+
+    def connect(self, start, stop, ddir=None, exp=None, chans=(), daqservers=None):
+        ### the strings are in the DAQ's time zone (ALPS_DAQ_TZ), as for pydaq
+        from alpsdoocslib import daq_timestamp
+        self.t0 = daq_timestamp(start)
+        t1 = daq_timestamp(stop)
+        self.nblocks = int(round((t1 - self.t0)*self.fs/self.blocksize))
+        self.chans = list(chans)
+        self.second = [synthetic_adc(1, self.fs, freq=320 + 10*i, seed=i) for i in range(len(self.chans))]
+        self.k = 0
+        self.polls = 0
+        self.connected = True
+        return []
+
+    def getdata(self):
+        self.polls += 1
+        if self.delay:
+            time.sleep(self.delay)
+        if self.empty_every and self.polls % self.empty_every == 0:
+            return []
+        if self.k >= self.nblocks:
+            return None
+        start = (self.k*self.blocksize) % (self.fs - self.fs % self.blocksize)
+        macropulse = self.macropulse0 + int(round(self.t0*self.fs/self.blocksize)) + self.k
+        channels = [[{'data': second[np.newaxis, start:start+self.blocksize], 'type': 'IMAGE',
+                      'timestamp': self.t0 + self.k*self.blocksize/self.fs, 'macropulse': macropulse,
+                      'miscellaneous': {'daqname': chan, 'ebitpp': 16}}]
+                    for chan, second in zip(self.chans, self.second)]
+        self.k += 1
+        return channels
+
+    def disconnect(self):
+        self.connected = False
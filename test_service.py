@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Tests of the data service (alpsdoocs_service) and of the batch job's memory
+budget (alpsdoocs_benchmark.memory_harness), against example_data.FakeDAQ.
+
+    python -m pytest -q test_service.py              # all but the slow cases
+    python -m pytest -q -m slow test_service.py      # the multi-hour memory run
+"""
+import functools
+import os
+import tempfile
+import threading
+
+import numpy as np
+import pytest
+
+import alpsdoocslib
+import alpsdoocs_service
+from example_data import FakeDAQ
+
+
+### FakeDAQ recording how many sessions are connected at once (processes=False
+### keeps all sessions in this process)
+class CountingDAQ(FakeDAQ):
+    lock = threading.Lock()
+    active = 0
+    most = 0
+
+    def connect(self, *args, **kwargs):
+        with CountingDAQ.lock:
+            CountingDAQ.active += 1
+            CountingDAQ.most = max(CountingDAQ.most, CountingDAQ.active)
+        return super().connect(*args, **kwargs)
+
+    def disconnect(self):
+        with CountingDAQ.lock:
+            CountingDAQ.active -= 1
+        super().disconnect()
+
+
+class FailingDAQ(FakeDAQ):
+    def getdata(self):
+        if self.polls >= 20:
+            raise alpsdoocslib.DAQError("server went away")
+        return super().getdata()
+
+
+### kills the upstream process without a result, like a crash of pydaq
+class DyingDAQ(FakeDAQ):
+    def getdata(self):
+        if self.polls >= 20:
+            os._exit(3)
+        return super().getdata()
+
+
+def start_service(backend_factory, **kwargs):
+    service = alpsdoocs_service.DataService(backend_factory, log=lambda line: None, **kwargs)
+    path = os.path.join(tempfile.mkdtemp(), 'service.sock')
+    alpsdoocs_service.start_service_thread(service, path)
+    return service, path
+
+
+def pull(path, chans, start, stop, status=None):
+    return list(alpsdoocs_service.iter_service_data(chans, start, stop, path, status=status))
+
+
+def pull_concurrently(path, requests):
+    results = [None]*len(requests)
+
+    def client(i, request):
+        try:
+            results[i] = pull(path, *request)
+        except Exception as e:
+            results[i] = e
+
+    threads = [threading.Thread(target=client, args=(i, request)) for i, request in enumerate(requests)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(60)
+    return results
+
+
+def same_blocks(a, b):
+    return len(a) == len(b) and all(x[:3] == y[:3] and np.array_equal(x[3], y[3]) for x, y in zip(a, b))
+
+
+def test_blocks_match_iter_doocs_data():
+    service, path = start_service(FakeDAQ, processes=False)
+    chans = ['c1', 'c2']
+    status = {}
+    via = pull(path, chans, '2022-01-03T00:00:00', '2022-01-03T00:00:05', status)
+    direct = list(alpsdoocslib.iter_doocs_data(chans, '2022-01-03T00:00:00', '2022-01-03T00:00:05', backend=FakeDAQ()))
+    ### the service streams channel by channel, so compare each channel's blocks
+    for c in chans:
+        assert same_blocks([b for b in via if b[0] == c], [b for b in direct if b[0] == c])
+    assert status == {'completed': True, 'range': 'complete'}
+
+
+def test_concurrent_clients_share_one_upstream_session():
+    service, path = start_service(functools.partial(FakeDAQ, delay=0.001), processes=False)
+    request = (['c1', 'c2'], '2022-01-03T00:00:00', '2022-01-03T00:00:05')
+    results = pull_concurrently(path, [request]*3)
+    assert service.counts['upstream_sessions'] == 1
+    assert all(same_blocks(result, results[0]) for result in results)
+    ### a request inside the cached range is served without a new session
+    inside = pull(path, ['c1'], '2022-01-03T00:00:01', '2022-01-03T00:00:03')
+    assert service.counts['upstream_sessions'] == 1
+    assert len(inside) == 2*16000//500
+
+
+def test_max_sessions_limits_concurrent_upstream_pulls():
+    CountingDAQ.active = CountingDAQ.most = 0
+    service, path = start_service(functools.partial(CountingDAQ, delay=0.001), processes=False, max_sessions=1)
+    results = pull_concurrently(path, [(['c1'], '2022-01-03T00:00:00', '2022-01-03T00:00:03'),
+                                       (['c1'], '2022-01-03T00:01:00', '2022-01-03T00:01:03')])
+    assert not any(isinstance(result, Exception) for result in results)
+    assert service.counts['upstream_sessions'] == 2
+    assert CountingDAQ.most == 1
+
+
+def test_cache_evicts_least_recently_used():
+    ### one 20 s pull of one channel is 0.64 MB: the cache holds two
+    service, path = start_service(FakeDAQ, processes=False, cache_mb=1.3)
+    for start, stop in (('00:00', '00:20'), ('00:20', '00:40'), ('00:00', '00:20'), ('00:40', '01:00')):
+        pull(path, ['c1'], f'2022-01-03T00:{start}', f'2022-01-03T00:{stop}')
+    kept = sorted(alpsdoocslib.daq_timestring(fetch.start) for fetch in service.fetches)
+    assert kept == ['2022-01-03T00:00:00', '2022-01-03T00:00:40']
+    assert service.counts['upstream_sessions'] == 3
+
+
+def test_upstream_error_reaches_every_client():
+    service, path = start_service(FailingDAQ, processes=False)
+    request = (['c1'], '2022-01-03T00:00:00', '2022-01-03T00:00:10')
+    results = pull_concurrently(path, [request]*2)
+    for result in results:
+        assert isinstance(result, alpsdoocslib.DAQError)
+        assert 'server went away' in str(result)
+    ### a failed pull is not cached: the next request starts a new session
+    with pytest.raises(alpsdoocslib.DAQError):
+        pull(path, *request)
+    assert service.counts['upstream_sessions'] == 2
+
+
+def test_dead_upstream_process_ends_the_pull():
+    service, path = start_service(DyingDAQ, upstream_timeout=0.2)
+    with pytest.raises(alpsdoocslib.DAQError, match='exited with code 3'):
+        pull(path, ['c1'], '2022-01-03T00:00:00', '2022-01-03T00:00:10')
+
+
+@pytest.mark.parametrize('hours, budget', [
+    (0.1, 256),
+    pytest.param(2, 256, marks=pytest.mark.slow),
+])
+def test_memory_harness_stays_within_budget(hours, budget):
+    import alpsdoocs_benchmark
+    assert alpsdoocs_benchmark.memory_harness(hours, budget) <= budget